@@ -1,18 +1,44 @@
+import time
 from flask import Flask
 from flask_cors import CORS
 from routes.auth_routes import auth_bp
 from routes.mapping_routes import mapping_bp
 from routes.playlist_routes import playlist_bp
 from routes.play_routes import play_bp
+from routes.metrics_routes import metrics_bp
+from utils.metrics import install_request_metrics
+from utils.mapping_store import mapping_repo
+from utils.playlist_store import playlist_repo
+from utils.auth import session_index
+from utils.play_rollup import play_rollups
+from config import PRELOAD_DATA
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 
+# 记录每个路由的耗时和状态码，通过 /v1/metrics 输出
+install_request_metrics(app)
+
 # 注册蓝图
 app.register_blueprint(auth_bp, url_prefix='/v1/auth')
 app.register_blueprint(mapping_bp, url_prefix='/v1/mappings')
 app.register_blueprint(playlist_bp, url_prefix='/v1/playlists')
 app.register_blueprint(play_bp, url_prefix='/v1/play')
+app.register_blueprint(metrics_bp, url_prefix='/v1/metrics')
+
+def preload_data():
+    """加载映射目录（含排序视图和搜索索引）、歌单元数据和会话索引，并在后台恢复热门榜计数"""
+    start = time.perf_counter()
+    # 播放记录可能很多，在后台读取，不阻塞启动和记录播放
+    play_rollups.start_loading()
+    mapping_repo.version()
+    playlist_repo.load()
+    session_index.preload()
+    print(f"Preloaded {mapping_repo.count()} mappings in {time.perf_counter() - start:.2f} s")
+
+# 启动时加载数据，首个请求不必等待解析和建索引
+if PRELOAD_DATA:
+    preload_data()
 
 @app.route('/v1/health', methods=['GET'])
 def health_check():
@@ -0,0 +1,332 @@
+"""HTTP API 压测基准：生成合成数据集，按路由统计吞吐量和延迟分位数
+
+用法（在 server 目录下运行）:
+    python bench/bench_api.py --mappings 100000 --requests 2000
+    python bench/bench_api.py --mode http --threads 8 --output results.json
+    python bench/bench_api.py --output new.json --compare old.json
+
+数据集生成在临时目录（或 --data-dir）下，使用 config.STORAGE_BACKEND 选择的存储后端；
+结果以JSON写入 --output，便于在不同提交之间比较。
+指定 --compare 时，任一路由的 p95 比基线变慢超过 --max-regression（百分比）且多出
+--min-delta-ms 毫秒以上则以状态码 1 退出；亚毫秒级路由的抖动在百分比上很大，只看比例会误报。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from bench_search import make_catalog, make_queries
+
+ROUTES = ('mappings_list', 'mappings_search', 'mappings_popular', 'play_record', 'playlists')
+
+def _timestamp(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(seconds))
+
+def generate_dataset(args, rng):
+    """通过存储后端写入合成数据，返回压测用的 bvid、会话令牌和搜索词"""
+    from utils.storage import get_backend
+    from utils.file_storage import save_data
+    from utils.json_backend import JsonBackend
+
+    backend = get_backend()
+    now = time.time()
+
+    catalog = make_catalog(args.mappings, rng)
+    uploaders = [str(10000000 + i) for i in range(max(args.sessions, 1))]
+    mappings = []
+    for i, item in enumerate(catalog):
+        created = _timestamp(now - rng.randrange(365 * 86400))
+        mappings.append({
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'bvid': f"BV{i:010d}",
+            'songName': item['songName'],
+            'artist': item['artist'],
+            'cover': '',
+            'neteasecloudId': str(100000 + i),
+            'uploader_uid': rng.choice(uploaders),
+            'play_count': int(rng.paretovariate(1.2)) - 1,
+            'created_at': created,
+            'updated_at': created,
+            'is_public': True
+        })
+    bvids = [m['bvid'] for m in mappings]
+
+    sessions = {}
+    for i in range(args.sessions):
+        token = uuid.UUID(int=rng.getrandbits(128)).hex
+        sessions[token] = {'uid': uploaders[i], 'created_at': now, 'nickname': f"user{i}", 'avatar': ''}
+
+    playlists = []
+    songs_by_playlist = {}
+    for i in range(args.playlists):
+        playlist_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        songs = [{'bvid': rng.choice(bvids)} for _ in range(rng.randint(0, args.songs_per_playlist))] if bvids else []
+        playlists.append({
+            'id': playlist_id, 'name': f"歌单{i}", 'description': '', 'cover': '',
+            'song_count': len(songs), 'version': 0, 'user_id': rng.choice(uploaders),
+            'created_at': _timestamp(now), 'updated_at': _timestamp(now)
+        })
+        songs_by_playlist[playlist_id] = songs
+
+    with backend.transaction():
+        backend.insert_mappings(mappings)
+        if isinstance(backend, JsonBackend):
+            # JSON 后端逐条保存是 O(n²)，直接写快照和各分片的文件
+            save_data(backend.sessions_file, sessions)
+            by_shard = {}
+            for playlist in playlists:
+                by_shard.setdefault(backend.playlist_shard(playlist['user_id']), []).append(playlist)
+            for shard, shard_playlists in by_shard.items():
+                save_data(backend._playlists_file(shard), shard_playlists)
+                for playlist in shard_playlists:
+                    save_data(backend._songs_file(shard, playlist['id']), songs_by_playlist[playlist['id']])
+        else:
+            for token, session in sessions.items():
+                backend.add_session(token, session)
+            for playlist in playlists:
+                backend.save_playlist(playlist, songs_by_playlist[playlist['id']])
+
+        batch = []
+        for _ in range(args.plays):
+            batch.append({
+                'user_id': rng.choice(uploaders), 'bvid': rng.choice(bvids) if bvids else 'BV0',
+                'duration': rng.randint(10, 300), 'timestamp': _timestamp(now - rng.randrange(30 * 86400))
+            })
+            if len(batch) >= 10000:
+                backend.append_play_records(batch)
+                batch = []
+        if batch:
+            backend.append_play_records(batch)
+
+    return bvids, list(sessions), make_queries(catalog, 200, rng) if catalog else ['x']
+
+def make_request(route, rng, bvids, tokens, queries, total_mappings):
+    """返回 (方法, 路径, 请求体, 请求头)"""
+    headers = {'Authorization': f"Bearer {rng.choice(tokens)}"} if tokens else {}
+    if route == 'mappings_list':
+        pages = max(total_mappings // 20, 1)
+        return 'GET', f"/v1/mappings?page={rng.randint(1, min(pages, 50))}&limit=20", None, {}
+    if route == 'mappings_search':
+        return 'GET', f"/v1/mappings?search={quote(rng.choice(queries))}&limit=20", None, {}
+    if route == 'mappings_popular':
+        return 'GET', "/v1/mappings?sort=popular&limit=20", None, {}
+    if route == 'play_record':
+        body = {'bvid': rng.choice(bvids) if bvids else 'BV0', 'duration': rng.randint(10, 300)}
+        return 'POST', "/v1/play/record", body, headers
+    return 'GET', "/v1/playlists", None, headers
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(int(round(p / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 1) if elapsed > 0 else None,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+    }
+
+def run_test_client(app, plans):
+    """用 Flask 测试客户端在当前线程顺序发送请求"""
+    client = app.test_client()
+    results = {}
+    for route, requests in plans.items():
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for method, path, body, headers in requests:
+            t0 = time.perf_counter()
+            response = client.open(path, method=method, json=body, headers=headers)
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code >= 400:
+                errors += 1
+        results[route] = summarize(latencies, errors, time.perf_counter() - started)
+    return results
+
+def start_http_server(app):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def run_http(app, plans, threads):
+    """启动本地多线程 HTTP 服务，用 threads 个保持连接的客户端并发压测"""
+    server = start_http_server(app)
+    port = server.server_port
+    local = threading.local()
+
+    def send(request):
+        method, path, body, headers = request
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        payload = json.dumps(body) if body is not None else None
+        headers = dict(headers, **({'Content-Type': 'application/json'} if payload else {}))
+        t0 = time.perf_counter()
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            local.conn = None
+            status = 599
+        return time.perf_counter() - t0, status
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for route, requests in plans.items():
+                started = time.perf_counter()
+                outcomes = list(pool.map(send, requests))
+                elapsed = time.perf_counter() - started
+                errors = sum(1 for _, status in outcomes if status >= 400)
+                results[route] = summarize([t for t, _ in outcomes], errors, elapsed)
+    finally:
+        server.shutdown()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None, max_regression=None, min_delta_ms=0.0):
+    """打印结果表，返回 p95 变慢超过 max_regression（百分比）且超过 min_delta_ms 的 (模式, 路由, 变化) 列表"""
+    regressions = []
+    for mode, routes in results.items():
+        print(f"\n[{mode}]")
+        print(f"{'路由':<18}{'请求数':>8}{'错误':>6}{'吞吐(rps)':>12}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+        for route, r in routes.items():
+            line = (f"{route:<18}{r['requests']:>8}{r['errors']:>6}{r['throughput_rps'] or 0:>12}"
+                    f"{r['p50_ms'] or 0:>10}{r['p95_ms'] or 0:>10}{r['p99_ms'] or 0:>10}")
+            old = (baseline or {}).get(mode, {}).get(route)
+            if old and old.get('p95_ms') and r['p95_ms']:
+                change = (r['p95_ms'] / old['p95_ms'] - 1) * 100
+                line += f"   p95 {change:+.1f}%"
+                if (max_regression is not None and change > max_regression
+                        and r['p95_ms'] - old['p95_ms'] > min_delta_ms):
+                    line += "  变慢"
+                    regressions.append((mode, route, change))
+            print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP API 压测基准')
+    parser.add_argument('--mappings', type=int, default=10000, help='映射数量（1k~1M）')
+    parser.add_argument('--sessions', type=int, default=1000, help='会话数量')
+    parser.add_argument('--playlists', type=int, default=1000, help='歌单数量')
+    parser.add_argument('--songs-per-playlist', type=int, default=50, help='每个歌单最多歌曲数')
+    parser.add_argument('--plays', type=int, default=100000, help='已有播放记录数量')
+    parser.add_argument('--requests', type=int, default=1000, help='每个路由的请求数')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='要压测的路由，逗号分隔')
+    parser.add_argument('--mode', default='both', choices=['test-client', 'http', 'both'])
+    parser.add_argument('--threads', type=int, default=8, help='HTTP 模式的并发客户端数')
+    parser.add_argument('--data-dir', default=None, help='数据集目录，默认使用新的临时目录')
+    parser.add_argument('--output', default=None, help='结果JSON输出路径')
+    parser.add_argument('--compare', default=None, help='与之前的结果JSON比较 p95')
+    parser.add_argument('--max-regression', type=float, default=30.0,
+                        help='与 --compare 比较时 p95 允许变慢的百分比，超过则以状态码 1 退出')
+    parser.add_argument('--min-delta-ms', type=float, default=0.2,
+                        help='p95 至少多出这么多毫秒才算变慢')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    routes = [r for r in args.routes.split(',') if r]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"未知的路由: {', '.join(sorted(unknown))}")
+
+    # 数据文件路径相对于当前目录，切换到数据集目录后再导入应用
+    output = os.path.abspath(args.output) if args.output else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='nb-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    bvids, tokens, queries = generate_dataset(args, rng)
+    generate_time = time.perf_counter() - start
+    print(f"数据集: {data_dir}（生成耗时 {generate_time:.1f} s）")
+
+    from app import app
+    from config import STORAGE_BACKEND
+
+    # 缩短 GIL 切换间隔，HTTP 模式下多线程的分位数不再被线程调度主导，两次结果才有可比性
+    sys.setswitchinterval(0.001)
+
+    plans = {route: [make_request(route, rng, bvids, tokens, queries, args.mappings)
+                     for _ in range(args.requests)] for route in routes}
+
+    results = {}
+    if args.mode in ('test-client', 'both'):
+        results['test_client'] = run_test_client(app, plans)
+    if args.mode in ('http', 'both'):
+        results['http'] = run_http(app, plans, args.threads)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'storage_backend': STORAGE_BACKEND,
+        'dataset': {
+            'mappings': args.mappings, 'sessions': args.sessions, 'playlists': args.playlists,
+            'songs_per_playlist': args.songs_per_playlist, 'plays': args.plays,
+            'generate_seconds': round(generate_time, 3)
+        },
+        'params': {'requests': args.requests, 'threads': args.threads, 'seed': args.seed},
+        'results': results
+    }
+
+    baseline = None
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get('results')
+    regressions = print_results(results, baseline, args.max_regression, args.min_delta_ms)
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {output}")
+
+    if regressions:
+        print(f"\np95 比基线变慢超过 {args.max_regression}%（且多出 {args.min_delta_ms} ms 以上）:")
+        for mode, route, change in regressions:
+            print(f"  [{mode}] {route}: {change:+.1f}%")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
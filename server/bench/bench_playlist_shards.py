@@ -0,0 +1,142 @@
+"""歌单分片存储压测：多个进程同时修改各自用户的歌单
+
+用法（在 server 目录下运行）:
+    python bench/bench_playlist_shards.py --workers 4 --ops 50 --existing 5000
+
+对每种分片数（默认 1 和 utils.user_shards.USER_SHARDS）各准备一个临时数据目录，
+预先写入 --existing 个分属 1000 个用户的歌单，然后启动 --workers 个进程，
+每个进程以一个独立用户的身份新建歌单并添加歌曲。
+分片数为 1 时所有用户共用一个歌单文件和一把锁，相当于分片之前的全局文件。
+输出每种分片数的总吞吐量和单次写入的延迟分位数。
+--shards 中第一个分片数作为基线，其余分片数的吞吐量低于基线的 --min-speedup 倍时以状态码 1 退出。
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def _timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+def prepare(shards, existing, songs, seed):
+    """在当前目录按分片直接写入已有歌单，不逐条保存"""
+    from utils.json_backend import JsonBackend
+    from utils.file_storage import save_data
+
+    rng = random.Random(seed)
+    backend = JsonBackend(user_shards=shards)
+    now = _timestamp()
+    by_shard = {}
+    for i in range(existing):
+        user_id = f"u{rng.randrange(1000)}"
+        playlist = {
+            'id': f"p{i:08d}", 'name': f"歌单{i}", 'description': '', 'cover': '',
+            'song_count': songs, 'version': 0, 'user_id': user_id, 'created_at': now, 'updated_at': now
+        }
+        by_shard.setdefault(backend.playlist_shard(user_id), []).append(playlist)
+    for shard, playlists in by_shard.items():
+        save_data(backend._playlists_file(shard), playlists)
+        for playlist in playlists:
+            save_data(backend._songs_file(shard, playlist['id']), [{'bvid': f"BV{j}"} for j in range(songs)])
+
+def worker_users(workers, shards):
+    """为每个进程选一个用户，分片足够时让它们落在不同分片"""
+    from utils.user_shards import user_shard
+    users, taken = [], set()
+    for index in range(workers):
+        for k in range(10000):
+            user_id = f"bench{index}-{k}"
+            shard = user_shard(user_id, shards)
+            if shard not in taken or len(taken) >= shards:
+                break
+        taken.add(shard)
+        users.append(user_id)
+    return users
+
+def worker(index, user_id, ops, data_dir, shards, barrier):
+    os.chdir(data_dir)
+    sys.path.insert(0, SERVER_DIR)
+    from utils.json_backend import JsonBackend
+    from utils.playlist_store import PlaylistRepository
+
+    repo = PlaylistRepository(JsonBackend(user_shards=shards))
+    repo.load()
+    barrier.wait()
+
+    latencies = []
+    for op in range(ops):
+        playlist_id = f"w{index}-{op}"
+        start = time.perf_counter()
+        repo.create({
+            'id': playlist_id, 'name': f"新歌单 {op}", 'description': '', 'cover': '',
+            'song_count': 0, 'version': 0, 'user_id': user_id,
+            'created_at': _timestamp(), 'updated_at': _timestamp()
+        }, [])
+        repo.change_songs(playlist_id, _timestamp(), add=[{'bvid': f"BVnew{op}"}])
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def _run_worker(args):
+    return worker(*args)
+
+def run(shards, args):
+    data_dir = tempfile.mkdtemp(prefix=f"nb-shards{shards}-")
+    os.chdir(data_dir)
+    prepare(shards, args.existing, args.songs, args.seed)
+
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    barrier = manager.Barrier(args.workers)
+    users = worker_users(args.workers, shards)
+    start = time.perf_counter()
+    with context.Pool(args.workers) as pool:
+        results = pool.map(_run_worker, [
+            (i, users[i], args.ops, data_dir, shards, barrier) for i in range(args.workers)
+        ])
+    elapsed = time.perf_counter() - start
+
+    latencies = [l for result in results for l in result]
+    print(f"分片 {shards:>3}: {len(latencies)} 次写入 {elapsed:.2f} s，{len(latencies) / elapsed:.0f} 次/s，"
+          f"p50 {_percentile(latencies, 50) * 1000:.1f} ms，p99 {_percentile(latencies, 99) * 1000:.1f} ms")
+    return len(latencies) / elapsed
+
+def main():
+    from utils.user_shards import USER_SHARDS
+
+    parser = argparse.ArgumentParser(description='歌单分片存储的并发写入吞吐量')
+    parser.add_argument('--workers', type=int, default=4, help='进程数，每个进程一个用户')
+    parser.add_argument('--ops', type=int, default=50, help='每个进程新建的歌单数')
+    parser.add_argument('--existing', type=int, default=5000, help='已有歌单数')
+    parser.add_argument('--songs', type=int, default=5, help='已有歌单的歌曲数')
+    parser.add_argument('--shards', default=f"1,{USER_SHARDS}", help='要比较的分片数，逗号分隔')
+    parser.add_argument('--min-speedup', type=float, default=3.0, help='其余分片数相对基线（第一个分片数）的吞吐量下限')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{args.workers} 个进程 x {args.ops} 次（新建歌单并添加歌曲），已有歌单 {args.existing} 个")
+    baseline, *others = [int(s) for s in args.shards.split(',')]
+    baseline_rate = run(baseline, args)
+    problems = []
+    for shards in others:
+        speedup = run(shards, args) / baseline_rate
+        print(f"分片 {shards} / 分片 {baseline} 吞吐量: {speedup:.1f} 倍")
+        if speedup < args.min_speedup:
+            problems.append(f"分片 {shards} 只有 {speedup:.1f} 倍")
+    if problems:
+        print(f"分片没有达到基线吞吐量的 {args.min_speedup} 倍: {'，'.join(problems)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""读写并发测试：写入整个映射目录期间，只读请求是否被阻塞
+
+用法（在 server 目录下运行）:
+    python bench/bench_read_stall.py --mappings 100000 --writes 10
+    python bench/bench_read_stall.py --locked-reads   # 对照：读取也持有仓库写锁（旧的加锁方式），应当失败
+
+在临时目录生成合成目录后，一个线程不断插入映射（JSON 存储下每次都要序列化并写入整个文件），
+同时若干线程按 bvid 查找、批量解析和取排序页，统计读取延迟。搜索本身是 CPU 密集的，
+多线程下的延迟主要取决于 GIL 竞争而不是锁，所以不计入。
+每次写入在持有仓库写锁和存储事务期间额外等待 --write-delay 秒，模拟慢速磁盘，
+使 SQLite 这类单次写入很快的后端也能看出读取是否在等待写入。
+读取等待写入时最长延迟接近单次写入耗时，不等待时只剩线程切换（GIL）带来的延迟。
+最长读取延迟不低于最短写入耗时的 --max-ratio 倍时以状态码 1 退出。
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from bench_search import make_catalog
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+def main():
+    parser = argparse.ArgumentParser(description='写入期间的读取延迟')
+    parser.add_argument('--mappings', type=int, default=100000, help='合成映射数')
+    parser.add_argument('--writes', type=int, default=10, help='写入次数')
+    parser.add_argument('--readers', type=int, default=4, help='读取线程数')
+    parser.add_argument('--locked-reads', action='store_true', help='读取时持有仓库写锁，对照旧的加锁方式')
+    parser.add_argument('--write-delay', type=float, default=0.2, help='每次写入在持锁期间额外等待的秒数')
+    parser.add_argument('--max-ratio', type=float, default=0.5, help='最长读取 / 最短写入 的上限')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='nb-read-stall-'))
+    rng = random.Random(args.seed)
+
+    from utils.storage import get_backend
+    from utils.mapping_store import mapping_repo
+    from config import STORAGE_BACKEND
+
+    now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    catalog = make_catalog(args.mappings, rng)
+    get_backend().insert_mappings([{
+        'id': f"m{i:08d}", 'bvid': f"BV{i:010d}", 'songName': item['songName'], 'artist': item['artist'],
+        'cover': '', 'neteasecloudId': str(i), 'uploader_uid': str(i % 1000), 'play_count': i % 997,
+        'created_at': now, 'updated_at': now, 'is_public': True
+    } for i, item in enumerate(catalog)])
+
+    # 模拟慢速磁盘：存储写入完成后仍在写锁和事务内等待
+    backend = get_backend()
+    insert_mapping = backend.insert_mapping
+
+    def slow_insert_mapping(mapping):
+        insert_mapping(mapping)
+        time.sleep(args.write_delay)
+
+    backend.insert_mapping = slow_insert_mapping
+    # 缩短 GIL 切换间隔，让读取延迟主要反映是否等待写入，而不是线程调度
+    sys.setswitchinterval(0.001)
+
+    start = time.perf_counter()
+    mapping_repo.count()
+    print(f"存储后端 {STORAGE_BACKEND}，{args.mappings} 条映射，建立快照 {time.perf_counter() - start:.2f} s")
+
+    def read_once(r):
+        op = r.randrange(3)
+        if op == 0:
+            mapping_repo.get_by_bvid(f"BV{r.randrange(args.mappings):010d}")
+        elif op == 1:
+            mapping_repo.page(r.choice(('newest', 'popular')), 20)
+        else:
+            mapping_repo.get_many_by_bvid([f"BV{r.randrange(args.mappings):010d}" for _ in range(50)])
+
+    stop = threading.Event()
+    latencies = []
+    lock = threading.Lock()
+
+    def reader(index):
+        r = random.Random(args.seed + index)
+        local = []
+        while not stop.is_set():
+            t = time.perf_counter()
+            if args.locked_reads:
+                with mapping_repo._lock:
+                    read_once(r)
+            else:
+                read_once(r)
+            local.append(time.perf_counter() - t)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    for t in threads:
+        t.start()
+
+    write_times = []
+    for i in range(args.writes):
+        time.sleep(0.05)
+        t = time.perf_counter()
+        mapping_repo.insert({
+            'id': f"w{i:08d}", 'bvid': f"BVwrite{i:06d}", 'songName': f"新歌 {i}", 'artist': 'bench',
+            'cover': '', 'neteasecloudId': str(i), 'uploader_uid': 'bench', 'play_count': 0,
+            'created_at': now, 'updated_at': now, 'is_public': True
+        })
+        write_times.append(time.perf_counter() - t)
+    time.sleep(0.05)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    assert mapping_repo.count() == args.mappings + args.writes
+    print(f"写入 {len(write_times)} 次: p50 {_ms(_percentile(write_times, 50))} ms, "
+          f"最短 {_ms(min(write_times))} ms, 最长 {_ms(max(write_times))} ms")
+    print(f"读取 {len(latencies)} 次: p50 {_ms(_percentile(latencies, 50))} ms, "
+          f"p99 {_ms(_percentile(latencies, 99))} ms, 最长 {_ms(max(latencies))} ms")
+    ratio = max(latencies) / min(write_times)
+    print(f"最长读取 / 最短写入: {ratio:.2f}")
+    if ratio >= args.max_ratio:
+        print(f"读取等待了写入: 比值不低于 {args.max_ratio}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
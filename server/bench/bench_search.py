@@ -0,0 +1,82 @@
+"""映射搜索基准：n-gram 倒排索引 vs 线性子串扫描
+
+用法（在 server 目录下运行）:
+    python bench/bench_search.py --size 100000 --queries 200
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.search_index import NGramIndex
+
+CJK_CHARS = '爱你我的心天晴雨夜星光梦想风花雪月海阳城春秋夏冬歌唱远方回忆青春时间'
+LATIN_WORDS = ['love', 'night', 'star', 'dream', 'rain', 'city', 'light', 'summer', 'song', 'blue']
+ARTISTS = ['周杰伦', '林俊杰', '陈奕迅', 'Taylor Swift', 'Coldplay', '邓紫棋', 'Eason', 'YOASOBI']
+
+def make_catalog(size, rng):
+    catalog = []
+    for i in range(size):
+        if rng.random() < 0.6:
+            name = ''.join(rng.choice(CJK_CHARS) for _ in range(rng.randint(2, 8)))
+        else:
+            name = ' '.join(rng.choice(LATIN_WORDS).title() for _ in range(rng.randint(1, 4)))
+        catalog.append({'id': str(i), 'songName': name, 'artist': rng.choice(ARTISTS)})
+    return catalog
+
+def make_queries(catalog, count, rng):
+    queries = []
+    for _ in range(count):
+        text = rng.choice(catalog)[rng.choice(['songName', 'artist'])]
+        start = rng.randrange(len(text))
+        queries.append(text[start:start + rng.randint(1, 4)])
+    return queries
+
+def linear_search(catalog, query):
+    query = query.lower()
+    return {
+        m['id'] for m in catalog
+        if query in m.get('songName', '').lower() or query in m.get('artist', '').lower()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='映射搜索基准')
+    parser.add_argument('--size', type=int, default=100000, help='映射数量')
+    parser.add_argument('--queries', type=int, default=200, help='查询次数')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    catalog = make_catalog(args.size, rng)
+    queries = make_queries(catalog, args.queries, rng)
+
+    start = time.perf_counter()
+    index = NGramIndex()
+    for m in catalog:
+        index.add(m['id'], m['songName'], m['artist'])
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    linear_results = [linear_search(catalog, q) for q in queries]
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index_results = [index.search(q) for q in queries]
+    index_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(linear_results, index_results) if a != b)
+
+    print(f"映射数量: {args.size}, 查询次数: {args.queries}")
+    print(f"建索引耗时: {build_time * 1000:.1f} ms")
+    print(f"线性扫描: {linear_time / len(queries) * 1000:.3f} ms/次")
+    print(f"倒排索引: {index_time / len(queries) * 1000:.3f} ms/次")
+    print(f"加速比: {linear_time / max(index_time, 1e-9):.1f}x")
+    print(f"结果不一致的查询: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""登录风暴演示：B站接口变慢时，登录请求是否拖慢目录读取
+
+用法（在 server 目录下运行）:
+    python bench/login_storm.py
+    python bench/login_storm.py --concurrency 0       # 对照：在请求线程中直接请求B站
+    python bench/login_storm.py --stub-delay 2 --logins 200 --server-threads 8
+
+启动一个本地慢速B站桩服务（每次验证耗时 --stub-delay 秒），应用运行在只有
+--server-threads 个请求线程的 WSGI 服务器上（相当于 gunicorn gthread worker）。
+先单独压测 GET /v1/mappings 得到基线，再在持续的登录风暴中重复压测，
+输出两次的吞吐量和延迟分位数以及登录结果（成功 / 503 拒绝）。
+风暴中的吞吐量低于基线的 --min-ratio 倍，或 p99 延迟不低于桩服务延迟的 --max-p99-ratio 倍
+（说明目录读取在排队等待B站验证）时以状态码 1 退出，--concurrency 0 的对照应当失败。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+class SlowNavHandler(BaseHTTPRequestHandler):
+    """模拟 /x/web-interface/nav，SESSDATA 形如 <mid>-<任意>，返回对应的用户"""
+
+    protocol_version = 'HTTP/1.1'
+    delay = 1.0
+    calls = 0
+
+    def do_GET(self):
+        SlowNavHandler.calls += 1
+        time.sleep(self.delay)
+        sessdata = self.headers.get('Cookie', '').replace('SESSDATA=', '')
+        mid = sessdata.split('-')[0]
+        if mid.isdigit():
+            body = {'code': 0, 'data': {'mid': int(mid), 'uname': f"user{mid}", 'face': ''}}
+        else:
+            body = {'code': -101, 'message': '账号未登录'}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+def start_stub(delay):
+    SlowNavHandler.delay = delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowNavHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def start_app(threads):
+    """在固定数量请求线程的 WSGI 服务器上运行应用"""
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+    from app import app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    class PooledWSGIServer(BaseWSGIServer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+        def process_request(self, request, client_address):
+            self._pool.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    server = PooledWSGIServer('127.0.0.1', 0, app, handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+def _request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def measure_catalog(port, duration, clients):
+    """在 duration 秒内用 clients 个并发客户端请求目录列表"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def loop():
+        while time.time() < deadline:
+            status, elapsed = _request(port, 'GET', '/v1/mappings?limit=20')
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=loop) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+    }
+
+def login_storm(port, logins, clients, distinct, stop):
+    """持续发送登录请求，其中只有 distinct 个不同的 SESSDATA，用于观察请求合并"""
+    results = {}
+    lock = threading.Lock()
+    counter = [0]
+
+    def loop():
+        rng = random.Random()
+        while not stop.is_set():
+            with lock:
+                if counter[0] >= logins:
+                    return
+                counter[0] += 1
+            mid = 1000 + rng.randrange(distinct)
+            status, _ = _request(port, 'POST', '/v1/auth/login', {
+                'bilibili_uid': str(mid), 'token': f"{mid}-{rng.randrange(3)}", 'timestamp': int(time.time())
+            })
+            with lock:
+                results[status] = results.get(status, 0) + 1
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    return threads, results
+
+def main():
+    parser = argparse.ArgumentParser(description='登录风暴下的目录读取吞吐量')
+    parser.add_argument('--stub-delay', type=float, default=1.0, help='桩服务每次验证的耗时（秒）')
+    parser.add_argument('--server-threads', type=int, default=8, help='应用的请求线程数')
+    parser.add_argument('--concurrency', type=int, default=2, help='同时请求B站的验证数，0 为在请求线程中直接请求')
+    parser.add_argument('--pending', type=int, default=4, help='排队和执行中的验证上限，应小于请求线程数')
+    parser.add_argument('--logins', type=int, default=400, help='登录请求总数')
+    parser.add_argument('--login-clients', type=int, default=32, help='并发登录的客户端数')
+    parser.add_argument('--distinct', type=int, default=200, help='不同 SESSDATA 的数量')
+    parser.add_argument('--catalog-clients', type=int, default=4, help='并发读取目录的客户端数')
+    parser.add_argument('--duration', type=float, default=3.0, help='每次目录压测的时长（秒）')
+    parser.add_argument('--mappings', type=int, default=1000, help='合成映射数')
+    parser.add_argument('--min-ratio', type=float, default=0.5, help='风暴中 / 基线 目录读取吞吐量的下限')
+    parser.add_argument('--max-p99-ratio', type=float, default=0.5, help='风暴中目录读取 p99 / 桩服务延迟 的上限')
+    args = parser.parse_args()
+
+    stub, base_url = start_stub(args.stub_delay)
+    os.environ['NB_BILIBILI_API_BASE'] = base_url
+    os.environ['NB_BILIBILI_MAX_CONCURRENCY'] = str(args.concurrency)
+    os.environ['NB_BILIBILI_MAX_PENDING'] = str(args.pending)
+    os.chdir(tempfile.mkdtemp(prefix='nb-login-storm-'))
+    # 缩短 GIL 切换间隔，让延迟主要反映是否等待验证，而不是线程调度
+    sys.setswitchinterval(0.001)
+
+    from utils.storage import get_backend
+    now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    get_backend().insert_mappings([{
+        'id': f"m{i}", 'bvid': f"BV{i:010d}", 'songName': f"song {i}", 'artist': 'storm',
+        'cover': '', 'neteasecloudId': str(i), 'uploader_uid': 'seed', 'play_count': i,
+        'created_at': now, 'updated_at': now, 'is_public': True
+    } for i in range(args.mappings)])
+
+    server, port = start_app(args.server_threads)
+    print(f"桩服务延迟 {args.stub_delay}s，请求线程 {args.server_threads}，"
+          f"验证并发 {args.concurrency or '不限（请求线程内直接请求）'}，排队上限 {args.pending}")
+
+    _request(port, 'GET', '/v1/mappings?limit=20')
+    baseline = measure_catalog(port, args.duration, args.catalog_clients)
+    print(f"基线目录读取:     {baseline}")
+
+    stop = threading.Event()
+    threads, results = login_storm(port, args.logins, args.login_clients, args.distinct, stop)
+    time.sleep(0.2)
+    storm = measure_catalog(port, args.duration, args.catalog_clients)
+    stop.set()
+    for t in threads:
+        t.join(timeout=args.stub_delay * 3 + 20)
+    print(f"登录风暴中目录读取: {storm}")
+    print(f"登录结果（状态码: 次数）: {dict(sorted(results.items()))}，桩服务收到 {SlowNavHandler.calls} 次验证")
+
+    server.shutdown()
+    stub.shutdown()
+
+    ratio = storm['rps'] / baseline['rps'] if baseline['rps'] else 0.0
+    p99_ratio = storm['p99_ms'] / (args.stub_delay * 1000)
+    print(f"风暴中 / 基线 吞吐量: {ratio:.2f}，风暴中 p99 / 桩服务延迟: {p99_ratio:.2f}")
+    problems = []
+    if ratio < args.min_ratio:
+        problems.append(f"吞吐量比值低于 {args.min_ratio}")
+    if p99_ratio >= args.max_p99_ratio:
+        problems.append(f"p99 延迟不低于桩服务延迟的 {args.max_p99_ratio} 倍")
+    if problems:
+        print(f"登录风暴拖慢了目录读取: {'，'.join(problems)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
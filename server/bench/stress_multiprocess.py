@@ -0,0 +1,178 @@
+"""多进程压力测试：模拟多个 gunicorn worker 同时写入，检查是否丢失更新
+
+用法（在 server 目录下运行）:
+    python bench/stress_multiprocess.py --workers 4 --ops 200
+    python bench/stress_multiprocess.py --no-locks   # 关闭跨进程锁，对照丢失更新的情况
+
+每个进程独立导入应用（各自的缓存和索引），在同一个数据目录上并发地
+创建映射、创建歌单、记录播放，并用其他进程登录的会话访问需要认证的接口。
+结束后用新的存储后端实例核对:
+- 每个进程创建的映射都存在且只有一条
+- 每个进程创建的歌单都存在且只有一个
+- 共享映射的 play_count 之和等于全部进程记录的播放次数
+- 播放记录条数等于记录的播放次数
+- 任何进程都能验证其他进程创建的会话
+使用 config.STORAGE_BACKEND 选择的存储后端，发现丢失更新时以状态码 1 退出。
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+SHARED_BVIDS = [f"BVshared{i:02d}" for i in range(10)]
+
+def worker(index, workers, ops, data_dir, barrier, no_locks, seed):
+    os.chdir(data_dir)
+    sys.path.insert(0, SERVER_DIR)
+    from utils import file_storage
+    if no_locks:
+        file_storage.CROSS_PROCESS_LOCKS = False
+
+    from app import app
+    from utils.auth import session_index
+    from utils.play_counter import play_counts
+
+    rng = random.Random(seed + index)
+    client = app.test_client()
+    session_index.add(f"tok-w{index}", {
+        'uid': f"w{index}", 'nickname': f"worker{index}", 'avatar': '', 'created_at': time.time()
+    })
+    own = {'Authorization': f"Bearer tok-w{index}"}
+    # 所有进程都登录后再开始
+    barrier.wait()
+
+    stats = {'created': 0, 'create_errors': 0, 'playlists': [], 'playlist_errors': 0,
+             'plays': {}, 'play_errors': 0, 'auth_failures': 0}
+    for op in range(ops):
+        r = client.post('/v1/mappings', json={
+            'bvid': f"BVw{index}x{op}", 'songName': f"song {index}-{op}",
+            'artist': 'stress', 'neteasecloudId': str(op)
+        }, headers=own)
+        if r.status_code == 200:
+            stats['created'] += 1
+        else:
+            stats['create_errors'] += 1
+
+        r = client.post('/v1/playlists', json={
+            'name': f"list {index}-{op}", 'songs': [{'bvid': f"BVw{index}x{op}"}]
+        }, headers=own)
+        if r.status_code == 200:
+            stats['playlists'].append(r.get_json()['data']['id'])
+        else:
+            stats['playlist_errors'] += 1
+
+        bvid = rng.choice(SHARED_BVIDS)
+        r = client.post('/v1/play/record', json={'bvid': bvid, 'duration': 1}, headers=own)
+        if r.status_code == 200:
+            stats['plays'][bvid] = stats['plays'].get(bvid, 0) + 1
+        else:
+            stats['play_errors'] += 1
+
+        # 用其他进程登录的会话访问
+        other = {'Authorization': f"Bearer tok-w{rng.randrange(workers)}"}
+        if client.get('/v1/playlists', headers=other).status_code != 200:
+            stats['auth_failures'] += 1
+
+        if op % 10 == 0:
+            client.get('/v1/mappings?sort=popular&limit=5')
+
+    play_counts.flush()
+    return stats
+
+def _run_worker(args):
+    return worker(*args)
+
+def main():
+    parser = argparse.ArgumentParser(description='多进程写入压力测试')
+    parser.add_argument('--workers', type=int, default=4, help='进程数')
+    parser.add_argument('--ops', type=int, default=200, help='每个进程的操作轮数')
+    parser.add_argument('--data-dir', default=None, help='数据目录，默认使用新的临时目录')
+    parser.add_argument('--no-locks', action='store_true', help='关闭跨进程文件锁')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='nb-stress-')
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+
+    from utils.storage import get_backend
+    from config import STORAGE_BACKEND
+    backend = get_backend()
+    now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    backend.insert_mappings([{
+        'id': f"shared-{i}", 'bvid': bvid, 'songName': bvid, 'artist': 'stress',
+        'cover': '', 'neteasecloudId': '0', 'uploader_uid': 'seed', 'play_count': 0,
+        'created_at': now, 'updated_at': now, 'is_public': True
+    } for i, bvid in enumerate(SHARED_BVIDS)])
+
+    print(f"数据目录: {data_dir}，存储后端: {STORAGE_BACKEND}，"
+          f"{args.workers} 个进程 x {args.ops} 轮，跨进程锁: {'关闭' if args.no_locks else '开启'}")
+
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    barrier = manager.Barrier(args.workers)
+    start = time.perf_counter()
+    with context.Pool(args.workers) as pool:
+        results = pool.map(_run_worker, [
+            (i, args.workers, args.ops, data_dir, barrier, args.no_locks, args.seed)
+            for i in range(args.workers)
+        ])
+    elapsed = time.perf_counter() - start
+
+    # 用新的后端实例从存储读取，不依赖任何进程的缓存
+    from utils.storage import create_backend
+    verify = create_backend(STORAGE_BACKEND)
+    mappings = verify.load_mappings()
+    by_bvid = {}
+    for mapping in mappings:
+        by_bvid[mapping['bvid']] = by_bvid.get(mapping['bvid'], 0) + 1
+
+    expected_plays = {}
+    for stats in results:
+        for bvid, count in stats['plays'].items():
+            expected_plays[bvid] = expected_plays.get(bvid, 0) + count
+    total_plays = sum(expected_plays.values())
+    stored_counts = {m['bvid']: m.get('play_count', 0) for m in mappings if m['bvid'] in SHARED_BVIDS}
+    stored_records = sum(1 for _ in verify.iter_play_records())
+    playlist_ids = {}
+    for playlist in verify.load_playlists():
+        playlist_ids[playlist['id']] = playlist_ids.get(playlist['id'], 0) + 1
+
+    problems = []
+    created = sum(s['created'] for s in results)
+    missing = [f"BVw{i}x{op}" for i in range(args.workers) for op in range(args.ops)
+               if by_bvid.get(f"BVw{i}x{op}", 0) != 1]
+    if missing:
+        problems.append(f"丢失或重复的映射: {len(missing)} 条（例如 {missing[:3]}）")
+    missing = [i for s in results for i in s['playlists'] if playlist_ids.get(i, 0) != 1]
+    if missing:
+        problems.append(f"丢失或重复的歌单: {len(missing)} 个（例如 {missing[:3]}）")
+    for bvid in SHARED_BVIDS:
+        if stored_counts.get(bvid, 0) != expected_plays.get(bvid, 0):
+            problems.append(f"{bvid} 播放次数: 存储 {stored_counts.get(bvid, 0)}，"
+                            f"实际 {expected_plays.get(bvid, 0)}")
+    if stored_records != total_plays:
+        problems.append(f"播放记录条数: 存储 {stored_records}，实际 {total_plays}")
+    errors = {k: sum(s[k] for s in results)
+              for k in ('create_errors', 'playlist_errors', 'play_errors', 'auth_failures')}
+    for key, value in errors.items():
+        if value:
+            problems.append(f"{key}: {value}")
+
+    print(f"耗时 {elapsed:.1f} s，创建映射 {created} 条，"
+          f"歌单 {sum(len(s['playlists']) for s in results)} 个，记录播放 {total_plays} 次")
+    if problems:
+        print("发现问题:")
+        for problem in problems:
+            print(f"  - {problem}")
+        sys.exit(1)
+    print("未发现丢失的更新")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import os
+
+# 存储后端: json（data/ 下的JSON文件）或 sqlite
+STORAGE_BACKEND = os.environ.get('NB_STORAGE_BACKEND', 'json')
+
+# SQLite 数据库文件路径
+SQLITE_PATH = os.environ.get('NB_SQLITE_PATH', 'data/nb_music.db')
+
+# B站API地址，测试时可指向本地桩服务
+BILIBILI_API_BASE = os.environ.get('NB_BILIBILI_API_BASE', 'https://api.bilibili.com')
+
+# 同时请求B站验证登录的线程数，0 表示在请求线程中直接调用
+BILIBILI_MAX_CONCURRENCY = int(os.environ.get('NB_BILIBILI_MAX_CONCURRENCY', '8'))
+
+# 排队和执行中的登录验证上限，超过后新的登录直接返回 503；
+# 应小于每个进程的请求线程数，为目录读取等请求留出空闲线程
+BILIBILI_MAX_PENDING = int(os.environ.get('NB_BILIBILI_MAX_PENDING', '16'))
+
+# 启动时是否预先加载映射、歌单和会话（JSON存储优先读取二进制快照），0 表示首个请求时再加载
+PRELOAD_DATA = os.environ.get('NB_PRELOAD_DATA', '1') == '1'
+
+# 慢请求日志阈值（毫秒），0 表示不输出
+SLOW_REQUEST_MS = float(os.environ.get('NB_SLOW_REQUEST_MS', '0'))
+
+# /v1/metrics 的访问令牌，设置后请求需带 Authorization: Bearer <令牌>
+METRICS_TOKEN = os.environ.get('NB_METRICS_TOKEN', '')
@@ -0,0 +1,118 @@
+"""NB Music 服务器维护命令
+
+用法（在 server 目录下运行）:
+    python manage.py migrate-play-log
+    python manage.py split-user-data
+    python manage.py migrate-storage --target sqlite
+    python manage.py convert-snapshot --to snapshot
+    python manage.py convert-snapshot --to json data/mappings.json
+"""
+import os
+import argparse
+from utils.play_log import migrate_legacy_records, LEGACY_PLAY_RECORDS_FILE
+from utils.storage import create_backend, migrate
+from utils.user_shards import USERS_DIR
+from utils import binary_snapshot
+from utils.file_storage import SNAPSHOT_MIN_BYTES
+
+def cmd_migrate_play_log(args):
+    count = migrate_legacy_records(args.source)
+    if count:
+        print(f"已导入 {count} 条播放记录，旧文件已重命名为 {args.source}.migrated")
+    else:
+        print(f"未找到旧版播放记录文件 {args.source}，无需迁移")
+
+def cmd_split_user_data(args):
+    # 旧版 play_records.json 直接导入分片播放日志
+    legacy = migrate_legacy_records()
+    if legacy:
+        print(f"已把 {legacy} 条旧版播放记录导入分片播放日志")
+
+    playlists, records = create_backend('json').split_legacy_data()
+    if not playlists and not records:
+        print("没有需要拆分的全局歌单文件或播放日志")
+        return
+    print(f"已按用户拆分到 {USERS_DIR}: 歌单 {playlists} 个, 播放记录 {records} 条")
+
+def cmd_migrate_storage(args):
+    # 旧版 play_records.json 先并入JSON播放日志
+    legacy = migrate_legacy_records()
+    if legacy:
+        print(f"已把 {legacy} 条旧版播放记录并入播放日志")
+
+    source = create_backend('json')
+    target = create_backend(args.target, **({'path': args.path} if args.path else {}))
+
+    if target.load_mappings() or target.load_playlists():
+        print("目标存储中已有数据，为避免重复导入已中止")
+        return
+
+    counts = migrate(source, target)
+    print(f"已导入到 {args.target}: "
+          f"映射 {counts['mappings']} 条, 会话 {counts['sessions']} 个, "
+          f"歌单 {counts['playlists']} 个, 播放记录 {counts['play_records']} 条")
+    print(f"设置环境变量 NB_STORAGE_BACKEND={args.target} 后重启服务即可切换")
+
+def _data_files(directory, suffix):
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.endswith(suffix) and not name.startswith('.'):
+                yield os.path.join(root, name)
+
+def cmd_convert_snapshot(args):
+    if args.to == 'snapshot':
+        # 未指定文件时转换数据目录下达到快照阈值的全部JSON文件
+        files = args.files or [f for f in _data_files(args.data_dir, '.json')
+                               if os.path.getsize(f) >= SNAPSHOT_MIN_BYTES]
+        for filename in files:
+            path, size = binary_snapshot.build_from_json(filename)
+            print(f"{filename} -> {path} ({size} 字节)")
+        if not files:
+            print(f"没有需要转换的文件（小于 {SNAPSHOT_MIN_BYTES} 字节的JSON文件直接解析更快）")
+        return
+
+    files = args.files or [f[:-len(binary_snapshot.SUFFIX)] + '.json'
+                           for f in _data_files(args.data_dir, binary_snapshot.SUFFIX)]
+    for filename in files:
+        try:
+            count = binary_snapshot.restore_json(filename)
+        except binary_snapshot.SnapshotError as e:
+            print(f"{binary_snapshot.snapshot_path(filename)}: {str(e)}")
+            continue
+        print(f"{binary_snapshot.snapshot_path(filename)} -> {filename} ({count} 条)")
+
+def main():
+    parser = argparse.ArgumentParser(description='NB Music 服务器维护命令')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_play_log = subparsers.add_parser(
+        'migrate-play-log', help='把旧版 play_records.json 导入按用户分片的播放日志')
+    migrate_play_log.add_argument('--source', default=LEGACY_PLAY_RECORDS_FILE,
+                                  help='旧版播放记录文件路径')
+    migrate_play_log.set_defaults(func=cmd_migrate_play_log)
+
+    split_user_data = subparsers.add_parser(
+        'split-user-data', help='把全局歌单文件和播放日志按用户拆分到分片目录（离线执行）')
+    split_user_data.set_defaults(func=cmd_split_user_data)
+
+    migrate_storage = subparsers.add_parser(
+        'migrate-storage', help='把 data/ 下的JSON数据导入其他存储后端（离线执行）')
+    migrate_storage.add_argument('--target', default='sqlite', choices=['sqlite'],
+                                 help='目标存储后端')
+    migrate_storage.add_argument('--path', default=None,
+                                 help='目标数据库路径，默认使用 config.SQLITE_PATH')
+    migrate_storage.set_defaults(func=cmd_migrate_storage)
+
+    convert_snapshot = subparsers.add_parser(
+        'convert-snapshot', help='在JSON文件和二进制快照之间转换')
+    convert_snapshot.add_argument('--to', required=True, choices=['snapshot', 'json'],
+                                  help='目标格式')
+    convert_snapshot.add_argument('--data-dir', default='data', help='未指定文件时扫描的数据目录')
+    convert_snapshot.add_argument('files', nargs='*', help='JSON文件路径（快照路径由其推出）')
+    convert_snapshot.set_defaults(func=cmd_convert_snapshot)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
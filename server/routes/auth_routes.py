@@ -1,16 +1,12 @@
 import time
 import json
 import uuid
-import requests
 from flask import Blueprint, request, jsonify
-from utils.auth import generate_session_token, verify_session_token
-from utils.file_storage import save_data, load_data
+from utils.auth import generate_session_token, verify_session_token, session_index
+from utils.bilibili import bilibili_client, BilibiliError, BilibiliBusy
 
 auth_bp = Blueprint('auth', __name__)
 
-# 用户会话存储
-SESSIONS_FILE = 'data/sessions.json'
-
 @auth_bp.route('/login', methods=['POST'])
 def login():
     try:
@@ -26,24 +22,31 @@ def login():
         bilibili_uid = data['bilibili_uid']
         token = data['token']  # 这是加密的SESSDATA
         
-        # 向B站API发送请求验证用户
-        cookies = {'SESSDATA': token}
-        bili_response = requests.get(
-            'https://api.bilibili.com/x/web-interface/nav',
-            cookies=cookies
-        )
-        
-        bili_data = bili_response.json()
+        # 向B站API发送请求验证用户（有界线程池执行，相同令牌合并，带超时、重试和短时缓存）
+        try:
+            user_info = bilibili_client.verify_sessdata(token)
+        except BilibiliBusy:
+            # 被拒绝的次数记录在 nb_bilibili_verify_total 指标中，不逐条输出日志
+            response = jsonify({
+                "success": False,
+                "error": {"code": 503, "message": "登录请求过多，请稍后重试"}
+            })
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        except BilibiliError as e:
+            print(f"Bilibili verify error: {str(e)}")
+            return jsonify({
+                "success": False,
+                "error": {"code": 503, "message": "B站服务暂时不可用，请稍后重试"}
+            }), 503
         
-        # 验证B站返回的UID是否匹配
-        if bili_response.status_code != 200 or bili_data.get('code') != 0:
+        if user_info is None:
             return jsonify({
                 "success": False,
                 "error": {"code": 401, "message": "B站验证失败"}
             }), 401
         
-        # 提取B站用户信息
-        user_info = bili_data.get('data', {})
+        # 验证B站返回的UID是否匹配
         if str(user_info.get('mid', '')) != str(bilibili_uid):
             return jsonify({
                 "success": False,
@@ -53,15 +56,13 @@ def login():
         # 生成会话令牌
         session_token = generate_session_token(bilibili_uid)
         
-        # 保存会话信息
-        sessions = load_data(SESSIONS_FILE, default={})
-        sessions[session_token] = {
+        # 保存会话信息（增量写入会话索引）
+        session_index.add(session_token, {
             'uid': bilibili_uid,
             'created_at': time.time(),
             'nickname': user_info.get('uname', ''),
             'avatar': user_info.get('face', '')
-        }
-        save_data(SESSIONS_FILE, sessions)
+        })
         
         return jsonify({
             "success": True,
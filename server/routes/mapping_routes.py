@@ -1,13 +1,69 @@
 import time
 import uuid
-from flask import Blueprint, request, jsonify
-from utils.auth import authenticate
-from utils.file_storage import save_data, load_data
+import json
+import base64
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from utils.auth import authenticate, verify_session_token
+from utils.mapping_store import mapping_repo, sort_key, parse_timestamp, SORT_ORDERS
+from utils.play_counter import play_counts
+from utils.playlist_store import playlist_repo
+from utils.play_rollup import play_rollups, TRENDING_WINDOWS, TRENDING_MAX
+from utils.response_cache import cached_json_response
 
 mapping_bp = Blueprint('mappings', __name__)
 
-# 映射数据存储文件
-MAPPINGS_FILE = 'data/mappings.json'
+# 创建映射的必要字段
+REQUIRED_FIELDS = ['bvid', 'songName', 'artist', 'neteasecloudId']
+# 必须为字符串的字段（用于索引和搜索）
+STRING_FIELDS = ('bvid', 'songName', 'artist')
+# 批量导入单次最多条数
+BULK_MAX_ITEMS = 10000
+# 批量解析单次最多 bvid 数
+RESOLVE_MAX_BVIDS = 5000
+
+def non_string_field(data):
+    """返回第一个不是字符串的 STRING_FIELDS 字段名，全部合法时返回 None"""
+    for field in STRING_FIELDS:
+        if not isinstance(data[field], str):
+            return field
+    return None
+
+def build_mapping(data, uploader_uid, now):
+    """由请求数据构造新映射"""
+    return {
+        'id': str(uuid.uuid4()),
+        'bvid': data['bvid'],
+        'songName': data['songName'],
+        'artist': data['artist'],
+        'cover': data.get('cover', ''),
+        'neteasecloudId': data['neteasecloudId'],
+        'uploader_uid': uploader_uid,
+        'play_count': 0,
+        'created_at': now,
+        'updated_at': now,
+        'is_public': data.get('is_public', True)
+    }
+
+def encode_cursor(sort, key):
+    """把排序键编码为不透明的分页游标"""
+    raw = json.dumps([sort, list(key)], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """解析分页游标，游标无效或与排序方式不符时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('invalid cursor')
+    # 只有维护了排序视图的排序方式才有游标，其余 sort 一律拒绝
+    if sort not in SORT_ORDERS or cursor_sort != sort or not isinstance(key, list):
+        raise ValueError('cursor sort mismatch')
+    # 校验键的类型，避免与排序视图比较时出错
+    expected = (str, str) if sort == 'newest' else (int, str, str)
+    if len(key) != len(expected) or not all(isinstance(k, t) for k, t in zip(key, expected)):
+        raise ValueError('invalid cursor key')
+    return tuple(key)
 
 @mapping_bp.route('', methods=['GET'])
 def get_mappings():
@@ -17,34 +73,77 @@ def get_mappings():
     sort = request.args.get('sort', 'newest')
     search = request.args.get('search', None)
     bvid = request.args.get('bvid', None)
+    uploader_uid = request.args.get('uploader_uid', None)
+    cursor = request.args.get('cursor', None)
+    
+    # 响应取决于映射集合和未落盘的播放次数，两者都没变时直接用缓存或返回 304
+    key = ('mappings', page, limit, sort, search, bvid, uploader_uid, cursor)
+    versions = (mapping_repo.version(), play_counts.version())
+    return cached_json_response(key, versions, lambda: _list_mappings(
+        page, limit, sort, search, bvid, uploader_uid, cursor))
+
+def _list_mappings(page, limit, sort, search, bvid, uploader_uid, cursor):
+    # 游标分页只支持维护了排序视图的排序方式
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor, sort)
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "无效的分页游标"}
+            }), 400
+    # 使用游标时忽略 page
+    offset = 0 if after is not None else (page - 1) * limit
     
-    # 加载全部映射
-    mappings = load_data(MAPPINGS_FILE, default=[])
+    # 尚未落盘的播放次数增量
+    pending_counts = play_counts.pending()
     
-    # 过滤
+    # 过滤（bvid / 上传者走哈希索引）
     if bvid:
-        filtered = [m for m in mappings if m.get('bvid') == bvid]
+        mapping = mapping_repo.get_by_bvid(bvid)
+        filtered = [mapping] if mapping else []
+    elif uploader_uid:
+        filtered = mapping_repo.list_by_uploader(uploader_uid)
     elif search:
-        search = search.lower()
-        filtered = [
-            m for m in mappings 
-            if search in m.get('songName', '').lower() or 
-               search in m.get('artist', '').lower()
-        ]
+        # 走 n-gram 倒排索引
+        filtered = mapping_repo.search(search)
     else:
-        filtered = mappings
+        filtered = None
     
-    # 排序
-    if sort == 'newest':
-        filtered.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    elif sort == 'popular':
-        filtered.sort(key=lambda x: x.get('play_count', 0), reverse=True)
+    if filtered is None and sort in SORT_ORDERS:
+        # 无过滤条件时直接从维护好的排序视图取页
+        total = mapping_repo.count()
+        result = mapping_repo.page(sort, limit, offset=offset, after=after,
+                                   play_deltas=pending_counts)
+    else:
+        if filtered is None:
+            filtered = mapping_repo.all()
+        
+        # 过滤结果较小，按同样的排序键排序（sorted 生成新列表，不会改动缓存）
+        if sort in SORT_ORDERS:
+            def key(m):
+                return sort_key(sort, m, pending_counts)
+            filtered = sorted(filtered, key=key, reverse=True)
+        
+        # 计算分页
+        total = len(filtered)
+        if after is not None:
+            filtered = [m for m in filtered if key(m) < after]
+        result = filtered[offset:offset + limit]
+    
+    # 本页已满时给出下一页游标
+    next_cursor = None
+    if sort in SORT_ORDERS and result and len(result) == limit:
+        next_cursor = encode_cursor(sort, sort_key(sort, result[-1], pending_counts))
     
-    # 计算分页
-    total = len(filtered)
-    start = (page - 1) * limit
-    end = start + limit
-    result = filtered[start:end]
+    # 合并未落盘的播放次数
+    if pending_counts:
+        result = [
+            dict(m, play_count=m.get('play_count', 0) + pending_counts[m.get('bvid')])
+            if m.get('bvid') in pending_counts else m
+            for m in result
+        ]
     
     return jsonify({
         "success": True,
@@ -52,10 +151,62 @@ def get_mappings():
             "mappings": result,
             "total": total,
             "page": page,
-            "limit": limit
+            "limit": limit,
+            "next_cursor": next_cursor
+        }
+    })
+
+@mapping_bp.route('/trending', methods=['GET'])
+def get_trending():
+    window = request.args.get('window', '24h')
+    limit = min(int(request.args.get('limit', 20)), TRENDING_MAX)
+    
+    if window not in TRENDING_WINDOWS:
+        return jsonify({
+            "success": False,
+            "error": {"code": 400, "message": f"window 只支持 {', '.join(TRENDING_WINDOWS)}"}
+        }), 400
+    
+    # 热门榜由分桶计数维护，这里只按顺序查映射，跳过已删除的映射直到取满 limit 个
+    result = []
+    for bvid, plays in play_rollups.trending(window, TRENDING_MAX):
+        if len(result) >= limit:
+            break
+        mapping = mapping_repo.get_by_bvid(bvid)
+        if mapping is not None:
+            result.append(dict(mapping, window_play_count=plays))
+    
+    return jsonify({
+        "success": True,
+        "data": {
+            "window": window,
+            "mappings": result
         }
     })
 
+@mapping_bp.route('/export', methods=['GET'])
+def export_mappings():
+    updated_since = request.args.get('updated_since', None)
+    
+    since = None
+    if updated_since:
+        try:
+            # 查询串里未编码的 + 会被解析成空格
+            since = parse_timestamp(updated_since.replace(' ', '+'))
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "无效的 updated_since"}
+            }), 400
+    
+    def generate():
+        # 按修改时间逐批输出，每批拼成一块写出，内存占用与目录大小无关
+        for batch in mapping_repo.iter_updated_since(since):
+            yield ''.join(
+                json.dumps(m, ensure_ascii=False, separators=(',', ':')) + '\n' for m in batch)
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @mapping_bp.route('', methods=['POST'])
 @authenticate
 def create_mapping(user):
@@ -63,42 +214,29 @@ def create_mapping(user):
         data = request.json
         
         # 验证必要字段
-        required_fields = ['bvid', 'songName', 'artist', 'neteasecloudId']
-        if not data or not all(field in data for field in required_fields):
+        if not data or not all(field in data for field in REQUIRED_FIELDS):
             return jsonify({
                 "success": False,
                 "error": {"code": 400, "message": "缺少必要字段"}
             }), 400
-        
-        # 检查是否已存在同BV号的映射
-        mappings = load_data(MAPPINGS_FILE, default=[])
-        if any(m.get('bvid') == data['bvid'] for m in mappings):
+        field = non_string_field(data)
+        if field:
             return jsonify({
                 "success": False,
-                "error": {"code": 409, "message": "该B站视频已有映射"}
-            }), 409
-            
-        # 创建映射
-        mapping_id = str(uuid.uuid4())
-        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+                "error": {"code": 400, "message": f"{field} 必须为字符串"}
+            }), 400
         
         # 构造新映射
-        new_mapping = {
-            'id': mapping_id,
-            'bvid': data['bvid'],
-            'songName': data['songName'],
-            'artist': data['artist'],
-            'cover': data.get('cover', ''),
-            'neteasecloudId': data['neteasecloudId'],
-            'uploader_uid': user['uid'],
-            'play_count': 0,
-            'created_at': now,
-            'is_public': data.get('is_public', True)
-        }
+        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        new_mapping = build_mapping(data, user['uid'], now)
+        mapping_id = new_mapping['id']
         
-        # 保存
-        mappings.append(new_mapping)
-        save_data(MAPPINGS_FILE, mappings)
+        # 保存，同BV号已有映射时返回冲突
+        if not mapping_repo.insert(new_mapping):
+            return jsonify({
+                "success": False,
+                "error": {"code": 409, "message": "该B站视频已有映射"}
+            }), 409
         
         return jsonify({
             "success": True,
@@ -115,33 +253,181 @@ def create_mapping(user):
             "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
         }), 500
 
+def _read_bulk_items():
+    """读取批量导入的请求体，支持JSON数组和NDJSON
+
+    返回条目列表，无法解析的NDJSON行以 None 占位；请求体不合法时抛出 ValueError。
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        items = []
+        # 逐行读取请求流，不把整个请求体读入内存
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            if len(items) >= BULK_MAX_ITEMS:
+                raise OverflowError
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise ValueError('body must be a JSON array')
+    if len(items) > BULK_MAX_ITEMS:
+        raise OverflowError
+    return items
+
+@mapping_bp.route('/bulk', methods=['POST'])
+@authenticate
+def bulk_create_mappings(user):
+    try:
+        try:
+            items = _read_bulk_items()
+        except OverflowError:
+            return jsonify({
+                "success": False,
+                "error": {"code": 413, "message": f"单次最多导入 {BULK_MAX_ITEMS} 条映射"}
+            }), 413
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "请求体应为JSON数组或NDJSON"}
+            }), 400
+        
+        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        results = [None] * len(items)
+        candidates = []
+        for i, data in enumerate(items):
+            # 逐条校验，不合法的条目不影响其他条目
+            if not isinstance(data, dict) or not all(field in data for field in REQUIRED_FIELDS):
+                results[i] = {"index": i, "status": "invalid", "message": "缺少必要字段"}
+            elif non_string_field(data):
+                results[i] = {"index": i, "status": "invalid",
+                              "message": f"{non_string_field(data)} 必须为字符串"}
+            else:
+                candidates.append((i, build_mapping(data, user['uid'], now)))
+        
+        # 与已有映射和本批内部去重后一次写入
+        inserted = mapping_repo.insert_many([mapping for _, mapping in candidates])
+        for (i, mapping), created in zip(candidates, inserted):
+            if created:
+                results[i] = {"index": i, "status": "created", "id": mapping['id']}
+            else:
+                results[i] = {"index": i, "status": "conflict", "bvid": mapping['bvid']}
+        
+        counts = {"created": 0, "conflict": 0, "invalid": 0}
+        for result in results:
+            counts[result['status']] += 1
+        
+        return jsonify({
+            "success": True,
+            "data": dict(counts, created_at=now, results=results)
+        })
+        
+    except Exception as e:
+        print(f"Bulk create mappings error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
+        }), 500
+
+@mapping_bp.route('/resolve', methods=['POST'])
+def resolve_mappings():
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or ('bvids' in data) == ('playlist_id' in data):
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "需要提供 bvids 或 playlist_id 之一"}
+            }), 400
+        
+        if 'playlist_id' in data:
+            # 歌单只对所有者可见，按歌单解析时需要认证
+            auth_header = request.headers.get('Authorization') or ''
+            user = verify_session_token(auth_header[7:]) if auth_header.startswith('Bearer ') else None
+            if not user:
+                return jsonify({
+                    "success": False,
+                    "error": {"code": 401, "message": "认证令牌无效或已过期"}
+                }), 401
+            playlist = playlist_repo.get(data['playlist_id'])
+            if playlist is None:
+                return jsonify({
+                    "success": False,
+                    "error": {"code": 404, "message": "歌单不存在"}
+                }), 404
+            if playlist.get('user_id') != user['uid']:
+                return jsonify({
+                    "success": False,
+                    "error": {"code": 403, "message": "无权查看此歌单"}
+                }), 403
+            bvids = [song.get('bvid') for song in playlist_repo.get_songs(playlist['id'])]
+        else:
+            bvids = data['bvids']
+            if not isinstance(bvids, list) or not all(isinstance(b, str) for b in bvids):
+                return jsonify({
+                    "success": False,
+                    "error": {"code": 400, "message": "bvids 应为字符串数组"}
+                }), 400
+            if len(bvids) > RESOLVE_MAX_BVIDS:
+                return jsonify({
+                    "success": False,
+                    "error": {"code": 413, "message": f"单次最多解析 {RESOLVE_MAX_BVIDS} 个 bvid"}
+                }), 413
+        
+        # 去重并保持顺序，整批走 bvid 哈希索引
+        bvids = list(dict.fromkeys(b for b in bvids if b))
+        pending_counts = play_counts.pending()
+        mappings = []
+        missing = []
+        for bvid, mapping in zip(bvids, mapping_repo.get_many_by_bvid(bvids)):
+            if mapping is None:
+                missing.append(bvid)
+            elif bvid in pending_counts:
+                mappings.append(dict(mapping, play_count=mapping.get('play_count', 0) + pending_counts[bvid]))
+            else:
+                mappings.append(mapping)
+        
+        return jsonify({
+            "success": True,
+            "data": {
+                "mappings": mappings,
+                "missing": missing
+            }
+        })
+        
+    except Exception as e:
+        print(f"Resolve mappings error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
+        }), 500
+
 @mapping_bp.route('/<mapping_id>', methods=['DELETE'])
 @authenticate
 def delete_mapping(user, mapping_id):
     try:
-        # 加载映射
-        mappings = load_data(MAPPINGS_FILE, default=[])
-        
-        # 查找映射
-        mapping_index = next((i for i, m in enumerate(mappings) 
-                             if m.get('id') == mapping_id), None)
+        # 按主键查找映射
+        mapping = mapping_repo.get(mapping_id)
         
-        if mapping_index is None:
+        if mapping is None:
             return jsonify({
                 "success": False,
                 "error": {"code": 404, "message": "映射不存在"}
             }), 404
             
         # 检查权限
-        if mappings[mapping_index].get('uploader_uid') != user['uid']:
+        if mapping.get('uploader_uid') != user['uid']:
             return jsonify({
                 "success": False,
                 "error": {"code": 403, "message": "无权删除此映射"}
             }), 403
             
         # 删除映射
-        deleted = mappings.pop(mapping_index)
-        save_data(MAPPINGS_FILE, mappings)
+        mapping_repo.delete(mapping_id)
         
         return jsonify({
             "success": True,
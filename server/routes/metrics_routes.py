@@ -0,0 +1,41 @@
+from flask import Blueprint, request, jsonify, Response
+from utils import metrics
+from utils.file_storage import get_cache_stats, get_write_stats
+from utils.response_cache import response_cache
+from utils.play_counter import play_counts
+from utils.bilibili import bilibili_client
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# 已有的统计信息以仪表形式输出，取值时才读取
+metrics.GaugeFunc(
+    'nb_file_cache_events', 'JSON文件解析缓存的命中/未命中/失效次数',
+    lambda: {(k,): v for k, v in get_cache_stats().items() if k in ('hits', 'misses', 'invalidations')},
+    ('event',))
+metrics.GaugeFunc(
+    'nb_file_writes', '文件写入次数及组提交合并的写入次数',
+    lambda: {(k,): v for k, v in get_write_stats().items() if k in ('writes', 'coalesced')},
+    ('kind',))
+metrics.GaugeFunc(
+    'nb_response_cache_events', '列表响应缓存的命中/未命中/304次数及当前条目数',
+    lambda: {(k,): v for k, v in response_cache.stats().items()},
+    ('event',))
+metrics.GaugeFunc(
+    'nb_play_counts_pending', '尚未落盘的播放次数增量',
+    lambda: {(): sum(play_counts.pending().values())})
+metrics.GaugeFunc(
+    'nb_bilibili_verify_pending', '排队和执行中的B站登录验证请求数',
+    lambda: {(): bilibili_client.pending()})
+
+@metrics_bp.route('', methods=['GET'])
+def get_metrics():
+    from config import METRICS_TOKEN
+    
+    # 配置了令牌时才要求认证，便于只对内网的抓取器开放
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({
+            "success": False,
+            "error": {"code": 401, "message": "未授权"}
+        }), 401
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,13 +1,16 @@
 import time
 from flask import Blueprint, request, jsonify
 from utils.auth import authenticate
-from utils.file_storage import save_data, load_data
+from utils.play_store import add_play_record, add_play_records
+from utils.play_counter import play_counts
+from utils.mapping_store import parse_timestamp
 
 play_bp = Blueprint('play', __name__)
 
-# 播放记录数据存储文件
-PLAY_RECORDS_FILE = 'data/play_records.json'
-MAPPINGS_FILE = 'data/mappings.json'
+# 批量上报单次最多条数
+BATCH_MAX_PLAYS = 1000
+# 幂等键最大长度
+MAX_PLAY_ID_LENGTH = 128
 
 @play_bp.route('/record', methods=['POST'])
 @authenticate
@@ -28,7 +31,6 @@ def record_play(user):
         playlist_id = data.get('playlist_id')
         
         # 记录播放
-        play_records = load_data(PLAY_RECORDS_FILE, default=[])
         now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
         
         play_record = {
@@ -43,17 +45,11 @@ def record_play(user):
         if playlist_id:
             play_record['playlist_id'] = playlist_id
             
-        play_records.append(play_record)
-        save_data(PLAY_RECORDS_FILE, play_records)
+        # 追加写入播放记录，不再重写全部记录
+        add_play_record(play_record)
         
-        # 更新映射的播放次数
-        mappings = load_data(MAPPINGS_FILE, default=[])
-        mapping_index = next((i for i, m in enumerate(mappings) 
-                             if m.get('bvid') == bvid), None)
-                             
-        if mapping_index is not None:
-            mappings[mapping_index]['play_count'] = mappings[mapping_index].get('play_count', 0) + 1
-            save_data(MAPPINGS_FILE, mappings)
+        # 更新映射的播放次数（先在内存中聚合，批量落盘）
+        play_counts.increment(bvid)
         
         return jsonify({
             "success": True,
@@ -68,3 +64,101 @@ def record_play(user):
             "success": False,
             "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
         }), 500
+
+def _parse_play(data, user_id, now, received_at):
+    """校验一条批量上报的播放，返回播放记录，不合法时抛出 ValueError"""
+    if not isinstance(data, dict) or 'bvid' not in data or 'duration' not in data:
+        raise ValueError("缺少必要字段")
+    if not isinstance(data['bvid'], str):
+        raise ValueError("bvid 必须为字符串")
+    play_id = data.get('play_id')
+    if play_id is not None and (not isinstance(play_id, str) or not play_id
+                                or len(play_id) > MAX_PLAY_ID_LENGTH):
+        raise ValueError("无效的 play_id")
+    
+    # 客户端时间，缺省或晚于服务器时间时使用服务器时间
+    timestamp = received_at
+    if data.get('played_at') is not None:
+        try:
+            played_at = parse_timestamp(data['played_at'])
+        except ValueError:
+            raise ValueError("无效的 played_at")
+        if played_at < now:
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(played_at))
+    
+    play_record = {
+        'user_id': user_id,
+        'bvid': data['bvid'],
+        'duration': data['duration'],
+        'timestamp': timestamp
+    }
+    if data.get('song_id'):
+        play_record['song_id'] = data['song_id']
+    if data.get('playlist_id'):
+        play_record['playlist_id'] = data['playlist_id']
+    if play_id is not None:
+        play_record['play_id'] = play_id
+        play_record['received_at'] = received_at
+    return play_record
+
+@play_bp.route('/records', methods=['POST'])
+@authenticate
+def record_plays(user):
+    try:
+        data = request.get_json(silent=True)
+        plays = data.get('plays') if isinstance(data, dict) else data
+        if not isinstance(plays, list):
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "plays 应为数组"}
+            }), 400
+        if len(plays) > BATCH_MAX_PLAYS:
+            return jsonify({
+                "success": False,
+                "error": {"code": 413, "message": f"单次最多上报 {BATCH_MAX_PLAYS} 条播放"}
+            }), 413
+        
+        now = time.time()
+        received_at = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(now))
+        results = [None] * len(plays)
+        valid = []
+        for i, item in enumerate(plays):
+            try:
+                valid.append((i, _parse_play(item, user['uid'], now, received_at)))
+            except ValueError as e:
+                results[i] = {"index": i, "status": "invalid", "message": str(e)}
+        
+        records = []
+        if valid:
+            # 一次写入保存整批记录，已上报过的播放（包括本批内重复的）由存储按幂等键跳过
+            written = add_play_records([record for _, record in valid])
+            for (i, record), ok in zip(valid, written):
+                if ok:
+                    records.append(record)
+                    results[i] = {"index": i, "status": "recorded"}
+                else:
+                    results[i] = {"index": i, "status": "duplicate"}
+        
+        if records:
+            # 按 bvid 聚合后更新播放次数
+            counts = {}
+            for record in records:
+                counts[record['bvid']] = counts.get(record['bvid'], 0) + 1
+            for bvid, count in counts.items():
+                play_counts.increment(bvid, count)
+        
+        summary = {"recorded": 0, "duplicate": 0, "invalid": 0}
+        for result in results:
+            summary[result['status']] += 1
+        
+        return jsonify({
+            "success": True,
+            "data": dict(summary, results=results)
+        })
+        
+    except Exception as e:
+        print(f"Record plays error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
+        }), 500
@@ -2,35 +2,38 @@ import time
 import uuid
 from flask import Blueprint, request, jsonify
 from utils.auth import authenticate
-from utils.file_storage import save_data, load_data
+from utils.playlist_store import playlist_repo
+from utils.response_cache import cached_json_response
 
 playlist_bp = Blueprint('playlists', __name__)
 
-# 歌单数据存储文件
-PLAYLISTS_FILE = 'data/playlists.json'
-
 @playlist_bp.route('', methods=['GET'])
 @authenticate
 def get_playlists(user):
     try:
         include_songs = request.args.get('include_songs', 'false').lower() == 'true'
         
-        # 加载用户的歌单
-        all_playlists = load_data(PLAYLISTS_FILE, default=[])
-        user_playlists = [pl for pl in all_playlists if pl.get('user_id') == user['uid']]
+        def build():
+            # 按所有者索引加载用户的歌单（不含歌曲）
+            user_playlists = playlist_repo.list_by_user(user['uid'])
+            
+            # 需要包含歌曲时才加载各歌单的歌曲列表
+            if include_songs:
+                user_playlists = [
+                    dict(playlist, songs=playlist_repo.get_songs(playlist['id']))
+                    for playlist in user_playlists
+                ]
+            
+            return jsonify({
+                "success": True,
+                "data": {
+                    "playlists": user_playlists
+                }
+            })
         
-        # 如果不需要包含歌曲，则移除songs字段
-        if not include_songs:
-            for playlist in user_playlists:
-                if 'songs' in playlist:
-                    del playlist['songs']
-        
-        return jsonify({
-            "success": True,
-            "data": {
-                "playlists": user_playlists
-            }
-        })
+        # 用户所在分片的歌单没变时直接用缓存或返回 304
+        key = ('playlists', user['uid'], include_songs)
+        return cached_json_response(key, (playlist_repo.version(user['uid']),), build)
         
     except Exception as e:
         print(f"Get playlists error: {str(e)}")
@@ -57,22 +60,21 @@ def create_playlist(user):
         now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
         
         # 构造新歌单
+        songs = data.get('songs', [])
         new_playlist = {
             'id': playlist_id,
             'name': data['name'],
             'description': data.get('description', ''),
             'cover': data.get('cover', ''),
-            'songs': data.get('songs', []),
-            'song_count': len(data.get('songs', [])),
+            'song_count': len(songs),
+            'version': 0,
             'user_id': user['uid'],
             'created_at': now,
             'updated_at': now
         }
         
-        # 保存
-        playlists = load_data(PLAYLISTS_FILE, default=[])
-        playlists.append(new_playlist)
-        save_data(PLAYLISTS_FILE, playlists)
+        # 保存（歌曲列表单独存储）
+        playlist_repo.create(new_playlist, songs)
         
         return jsonify({
             "success": True,
@@ -111,72 +113,167 @@ def update_playlist_songs(user, playlist_id):
                 "error": {"code": 400, "message": "无效的操作类型"}
             }), 400
             
-        # 加载歌单
-        playlists = load_data(PLAYLISTS_FILE, default=[])
-        
         # 查找歌单
-        playlist_index = next((i for i, p in enumerate(playlists) 
-                              if p.get('id') == playlist_id), None)
+        playlist = playlist_repo.get(playlist_id)
         
-        if playlist_index is None:
+        if playlist is None:
             return jsonify({
                 "success": False,
                 "error": {"code": 404, "message": "歌单不存在"}
             }), 404
             
         # 检查权限
-        if playlists[playlist_index].get('user_id') != user['uid']:
+        if playlist.get('user_id') != user['uid']:
             return jsonify({
                 "success": False,
                 "error": {"code": 403, "message": "无权修改此歌单"}
             }), 403
             
-        playlist = playlists[playlist_index]
-        current_songs = playlist.get('songs', [])
-        
-        # 执行操作
+        # 执行操作（借助 bvid 索引，开销与提交的歌曲数线性相关）
+        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
         if action == 'replace':
-            playlist['songs'] = songs
+            stats, version = playlist_repo.change_songs(playlist_id, now, replace=songs)
             updated_count = len(songs)
         elif action == 'add':
             # 添加不存在的歌曲
-            added = 0
-            for song in songs:
-                if not any(s.get('bvid') == song.get('bvid') for s in current_songs):
-                    current_songs.append(song)
-                    added += 1
-            playlist['songs'] = current_songs
-            updated_count = added
+            stats, version = playlist_repo.change_songs(playlist_id, now, add=songs)
+            updated_count = stats['added']
         elif action == 'remove':
             # 移除匹配的歌曲
-            removed = 0
-            bvids_to_remove = [s.get('bvid') for s in songs]
-            new_songs = []
-            for song in current_songs:
-                if song.get('bvid') not in bvids_to_remove:
-                    new_songs.append(song)
-                else:
-                    removed += 1
-            playlist['songs'] = new_songs
-            updated_count = removed
+            bvids_to_remove = {s.get('bvid') for s in songs}
+            stats, version = playlist_repo.change_songs(playlist_id, now, remove=bvids_to_remove)
+            updated_count = stats['removed']
+        
+        return jsonify({
+            "success": True,
+            "data": {
+                "updated_count": updated_count,
+                "version": version
+            }
+        })
+        
+    except Exception as e:
+        print(f"Update playlist songs error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
+        }), 500
+
+@playlist_bp.route('/<playlist_id>/songs', methods=['PATCH'])
+@authenticate
+def diff_playlist_songs(user, playlist_id):
+    try:
+        data = request.json
+        
+        # 验证字段类型
+        if not isinstance(data, dict):
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "缺少必要字段"}
+            }), 400
+        
+        add = data.get('add', [])
+        remove = data.get('remove', [])
+        move = data.get('move', [])
+        base_version = data.get('base_version')
+        
+        if (not isinstance(add, list) or not all(isinstance(s, dict) for s in add)
+                or not isinstance(remove, list) or not all(isinstance(b, str) for b in remove)
+                or not isinstance(move, list)
+                or not all(isinstance(m, dict) and isinstance(m.get('bvid'), str)
+                           and isinstance(m.get('to'), int) for m in move)):
+            return jsonify({
+                "success": False,
+                "error": {"code": 400, "message": "无效的修改内容"}
+            }), 400
+        
+        # 查找歌单
+        playlist = playlist_repo.get(playlist_id)
+        
+        if playlist is None:
+            return jsonify({
+                "success": False,
+                "error": {"code": 404, "message": "歌单不存在"}
+            }), 404
             
-        # 更新歌曲数量和时间戳
-        playlist['song_count'] = len(playlist['songs'])
-        playlist['updated_at'] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        # 检查权限
+        if playlist.get('user_id') != user['uid']:
+            return jsonify({
+                "success": False,
+                "error": {"code": 403, "message": "无权修改此歌单"}
+            }), 403
         
-        # 保存更改
-        playlists[playlist_index] = playlist
-        save_data(PLAYLISTS_FILE, playlists)
+        # 删除、添加、移动在一次写入中完成，base_version 在写锁内与当前版本比较
+        stats, version = playlist_repo.change_songs(
+            playlist_id, time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            add=add, remove=remove, moves=[(m['bvid'], m['to']) for m in move],
+            base_version=base_version)
+        
+        # 客户端基于旧版本修改时拒绝，需先同步
+        if stats is None:
+            return jsonify({
+                "success": False,
+                "error": {"code": 409, "message": "歌单已被修改，请同步后重试"},
+                "data": {"version": version}
+            }), 409
         
         return jsonify({
             "success": True,
             "data": {
-                "updated_count": updated_count
+                "added": stats['added'],
+                "removed": stats['removed'],
+                "moved": stats['moved'],
+                "song_count": playlist_repo.get(playlist_id)['song_count'],
+                "version": version
             }
         })
         
     except Exception as e:
-        print(f"Update playlist songs error: {str(e)}")
+        print(f"Diff playlist songs error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
+        }), 500
+
+@playlist_bp.route('/<playlist_id>/songs', methods=['GET'])
+@authenticate
+def get_playlist_songs(user, playlist_id):
+    try:
+        page = int(request.args.get('page', 1))
+        limit = int(request.args.get('limit', 100))
+        
+        # 查找歌单
+        playlist = playlist_repo.get(playlist_id)
+        
+        if playlist is None:
+            return jsonify({
+                "success": False,
+                "error": {"code": 404, "message": "歌单不存在"}
+            }), 404
+            
+        # 检查权限
+        if playlist.get('user_id') != user['uid']:
+            return jsonify({
+                "success": False,
+                "error": {"code": 403, "message": "无权查看此歌单"}
+            }), 403
+        
+        # 分页返回歌曲
+        songs = playlist_repo.get_songs(playlist_id)
+        start = (page - 1) * limit
+        
+        return jsonify({
+            "success": True,
+            "data": {
+                "songs": songs[start:start + limit],
+                "total": len(songs),
+                "page": page,
+                "limit": limit
+            }
+        })
+        
+    except Exception as e:
+        print(f"Get playlist songs error: {str(e)}")
         return jsonify({
             "success": False,
             "error": {"code": 500, "message": f"服务器错误: {str(e)}"}
@@ -43,8 +43,10 @@ def save_data(file_path, data):
         print(f"保存数据错误: {e}")
         return False
 
-# 初始化示例数据
-if not os.path.exists(MAPPINGS_FILE):
+# 初始化示例数据（只在直接运行时执行，导入模块不会写入数据文件）
+def init_example_data():
+    if os.path.exists(MAPPINGS_FILE):
+        return
     # 创建一些示例映射
     example_mappings = [
         {
@@ -100,6 +102,7 @@ def get_mappings():
 
 # 主函数
 if __name__ == '__main__':
+    init_example_data()
     print("NB-Music API服务器启动...")
     print(f"访问 http://127.0.0.1:5000/v1/health 检查服务状态")
     app.run(host='127.0.0.1', port=5000, debug=True)
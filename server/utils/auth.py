@@ -2,12 +2,184 @@ import time
 import uuid
 import hashlib
 import functools
+import threading
+from collections import OrderedDict
 from flask import request, jsonify
-from .file_storage import load_data
+from .file_storage import freeze
+from .storage import get_backend
 
 # 会话令牌过期时间（秒）
 TOKEN_EXPIRY = 30 * 24 * 60 * 60  # 30天
 
+# 内存中最多保留的会话数，超出时淘汰最久未使用的会话
+MAX_SESSIONS = 100000
+# 清理过期会话并压缩持久化文件的间隔（秒）
+SWEEP_INTERVAL = 10 * 60
+
+def _is_expired(session, now):
+    return now - session['created_at'] > TOKEN_EXPIRY
+
+class SessionIndex:
+    """令牌到会话的内存索引
+
+    带容量上限的 LRU，并按 TOKEN_EXPIRY 过期。容量只限制内存占用：
+    被淘汰的会话仍保存在存储中，未命中时回退到存储查找，不会被注销。
+    登录只增量写入一个会话，过期会话在请求路径上按间隔顺带清理，同时压缩持久化存储。
+    """
+
+    def __init__(self, backend=None, max_sessions=MAX_SESSIONS, sweep_interval=SWEEP_INTERVAL):
+        self._backend = backend
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        # 只保护内存中的索引，持有期间不读写存储
+        self._lock = threading.Lock()
+        # 串行化加载和读取其他进程的新会话，使游标按顺序推进；查找已缓存的令牌不需要
+        self._refresh_lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._sessions = None
+        # 存储后端的会话游标，用于读取其他进程新写入的会话
+        self._cursor = None
+        self._last_sweep = time.time()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    def _load(self):
+        """从存储读取全部会话，返回 (只含最新会话的 LRU, 游标)，不持有 self._lock"""
+        sessions, cursor = self.backend.load_sessions_with_cursor()
+        now = time.time()
+        # 只把最新的会话放进内存，其余的在首次使用时从存储读取
+        live = sorted(
+            ((token, s) for token, s in sessions.items() if not _is_expired(s, now)),
+            key=lambda item: item[1]['created_at']
+        )[-self.max_sessions:]
+        return OrderedDict((token, freeze(s)) for token, s in live), cursor
+
+    def _ensure_loaded(self):
+        if self._sessions is not None:
+            return
+        with self._refresh_lock:
+            if self._sessions is not None:
+                return
+            sessions, cursor = self._load()
+            with self._lock:
+                self._sessions, self._cursor = sessions, cursor
+
+    def _remember(self, token, session):
+        """放入内存 LRU，超出容量时只从内存中淘汰最久未使用的会话，调用方持有 self._lock"""
+        self._sessions[token] = session
+        self._sessions.move_to_end(token)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _refresh(self):
+        """读取其他进程（多 worker 部署）新写入的会话
+
+        读取存储时不持有 self._lock，读完后在锁内合并，查找已缓存令牌的请求不会等待文件读写。
+        """
+        self._ensure_loaded()
+        with self._refresh_lock:
+            changes, cursor = self.backend.session_changes(self._cursor)
+            if changes is None:
+                sessions, cursor = self._load()
+                with self._lock:
+                    self._sessions, self._cursor = sessions, cursor
+                return
+            now = time.time()
+            with self._lock:
+                for token, session in changes.items():
+                    if session is None or _is_expired(session, now):
+                        self._sessions.pop(token, None)
+                    else:
+                        self._remember(token, freeze(session))
+                self._cursor = cursor
+
+    def _cached(self, token):
+        """返回内存中的有效会话并标记为最近使用，过期的顺带删除"""
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if _is_expired(session, time.time()):
+                del self._sessions[token]
+                return None
+            self._sessions.move_to_end(token)
+            return session
+
+    def preload(self):
+        """立即从存储加载会话，避免首个请求承担加载耗时"""
+        self._ensure_loaded()
+
+    def get(self, token):
+        """返回有效的会话，令牌不存在或已过期时返回 None"""
+        self._maybe_sweep()
+        self._ensure_loaded()
+        session = self._cached(token)
+        if session is not None:
+            return session
+
+        # 可能是在其他 worker 进程登录的
+        self._refresh()
+        session = self._cached(token)
+        if session is not None:
+            return session
+
+        # 可能是被挤出内存的会话，查找存储时不占用索引锁
+        session = self.backend.get_session(token)
+        if session is None or _is_expired(session, time.time()):
+            return None
+        session = freeze(session)
+        with self._lock:
+            self._remember(token, session)
+        return session
+
+    def add(self, token, session):
+        """登录成功后增量写入一个会话，写入存储时不占用索引锁"""
+        self._ensure_loaded()
+        self.backend.add_session(token, session)
+        with self._lock:
+            self._remember(token, freeze(session))
+
+    def _maybe_sweep(self):
+        if time.time() - self._last_sweep < self.sweep_interval:
+            return
+        # 只让一个请求顺带执行清理，其他请求不等待
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            if time.time() - self._last_sweep >= self.sweep_interval:
+                self._sweep()
+        except Exception as e:
+            print(f"Sweep sessions error: {str(e)}")
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self):
+        """立即清理过期会话并压缩持久化文件"""
+        with self._sweep_lock:
+            self._sweep()
+
+    def _sweep(self):
+        self._last_sweep = time.time()
+
+        self._ensure_loaded()
+        handle = self.backend.begin_session_compaction()
+        # 换出日志之后再读一次，快照要包含其他进程已写入的会话
+        self._refresh()
+        now = time.time()
+        with self._lock:
+            for token in [t for t, s in self._sessions.items() if _is_expired(s, now)]:
+                del self._sessions[token]
+
+        # 压缩以存储中的全部会话为准（内存中只有一部分），写入时不占用索引锁，不阻塞认证请求
+        self.backend.finish_session_compaction(handle, now - TOKEN_EXPIRY)
+
+# 进程级共享的会话索引
+session_index = SessionIndex()
+
 def generate_session_token(uid):
     """生成会话令牌"""
     # 使用用户ID、时间戳和随机UUID生成令牌
@@ -20,18 +192,7 @@ def generate_session_token(uid):
 
 def verify_session_token(token):
     """验证会话令牌是否有效并返回用户信息"""
-    sessions = load_data('data/sessions.json', default={})
-    
-    # 检查令牌是否存在
-    if token not in sessions:
-        return None
-        
-    # 检查令牌是否过期
-    session = sessions[token]
-    if time.time() - session['created_at'] > TOKEN_EXPIRY:
-        return None
-        
-    return session
+    return session_index.get(token)
 
 def authenticate(f):
     """认证装饰器"""
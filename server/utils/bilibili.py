@@ -0,0 +1,186 @@
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.cookiejar import DefaultCookiePolicy
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .metrics import BILIBILI_LATENCY, BILIBILI_VERIFY_EVENTS
+
+# 连接 / 读取超时（秒）
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 5
+# 连接失败或5xx时的最大重试次数
+MAX_RETRIES = 2
+# 连接池大小
+POOL_SIZE = 16
+# 验证结果缓存时间（秒）和容量
+VERIFY_CACHE_TTL = 60
+VERIFY_CACHE_SIZE = 10000
+# 等待验证结果的最长时间（秒），覆盖连接、读取和重试退避
+VERIFY_WAIT_TIMEOUT = (CONNECT_TIMEOUT + READ_TIMEOUT) * (MAX_RETRIES + 1) + 1
+
+class BilibiliError(Exception):
+    """B站接口不可用（超时、连接失败、返回异常）"""
+
+class BilibiliBusy(BilibiliError):
+    """等待中的验证请求已满，本次请求被拒绝"""
+
+class BilibiliClient:
+    """B站API客户端
+
+    复用带连接池和 keep-alive 的 requests.Session，设置超时和有限次重试；
+    验证通过的 SESSDATA 按哈希短时间缓存，重复登录不再请求B站。
+
+    验证请求在固定大小的线程池中执行，同时请求B站的数量不超过 max_concurrency；
+    相同 SESSDATA 的并发验证合并为一次请求（single-flight），
+    排队和执行中的验证超过 max_pending 时直接拒绝（BilibiliBusy），
+    登录高峰时请求线程不会全部阻塞在B站上。max_concurrency 为 0 时在调用线程中直接请求。
+    """
+
+    def __init__(self, base_url=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 max_retries=MAX_RETRIES, cache_ttl=VERIFY_CACHE_TTL, cache_size=VERIFY_CACHE_SIZE,
+                 max_concurrency=None, max_pending=None, wait_timeout=VERIFY_WAIT_TIMEOUT):
+        if base_url is None:
+            from config import BILIBILI_API_BASE
+            base_url = BILIBILI_API_BASE
+        if max_concurrency is None:
+            from config import BILIBILI_MAX_CONCURRENCY
+            max_concurrency = BILIBILI_MAX_CONCURRENCY
+        if max_pending is None:
+            from config import BILIBILI_MAX_PENDING
+            max_pending = BILIBILI_MAX_PENDING
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        self.max_concurrency = max_concurrency
+        self.max_pending = max(max_pending, max_concurrency)
+        self.wait_timeout = wait_timeout
+        self._executor = None
+        if max_concurrency > 0:
+            self._executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                                thread_name_prefix='bilibili-verify')
+        # 缓存键 -> 进行中的验证 Future
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        retry = Retry(total=max_retries, backoff_factor=0.2,
+                      status_forcelist=(500, 502, 503, 504), allowed_methods=['GET'],
+                      raise_on_status=False)
+        pool_size = max(POOL_SIZE, max_concurrency)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 不保存任何响应 Cookie，避免不同用户之间串号
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    @staticmethod
+    def _cache_key(sessdata):
+        return hashlib.sha256(sessdata.encode()).hexdigest()
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[1]
+
+    def _cache_put(self, key, value):
+        with self._cache_lock:
+            self._cache[key] = (time.time() + self.cache_ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def fetch_nav(self, sessdata):
+        """请求 /x/web-interface/nav，返回解析后的JSON"""
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            try:
+                response = self.session.get(
+                    f"{self.base_url}/x/web-interface/nav",
+                    headers={'Cookie': f"SESSDATA={sessdata}"},
+                    timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                raise BilibiliError(str(e))
+            if response.status_code != 200:
+                outcome = f"http_{response.status_code}"
+                raise BilibiliError(f"HTTP {response.status_code}")
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise BilibiliError(f"无效的响应: {str(e)}")
+            outcome = 'ok'
+            return data
+        finally:
+            BILIBILI_LATENCY.observe(time.perf_counter() - start, 'nav', outcome)
+
+    def verify_sessdata(self, sessdata):
+        """验证 SESSDATA，有效时返回B站用户信息（含 mid/uname/face），无效时返回 None
+
+        B站不可用或等待超时时抛出 BilibiliError，验证请求已满时抛出 BilibiliBusy。
+        """
+        key = self._cache_key(sessdata)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        if self._executor is None:
+            return self._verify(key, sessdata)
+
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                BILIBILI_VERIFY_EVENTS.inc('coalesced')
+            elif len(self._inflight) >= self.max_pending:
+                BILIBILI_VERIFY_EVENTS.inc('shed')
+                raise BilibiliBusy(f"等待中的验证请求已达上限 {self.max_pending}")
+            else:
+                BILIBILI_VERIFY_EVENTS.inc('started')
+                future = self._executor.submit(self._verify, key, sessdata)
+                self._inflight[key] = future
+                future.add_done_callback(lambda f: self._finish(key, f))
+
+        try:
+            return future.result(timeout=self.wait_timeout)
+        except FutureTimeoutError:
+            raise BilibiliError(f"等待验证结果超时（{self.wait_timeout} 秒）")
+
+    def _finish(self, key, future):
+        with self._inflight_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def pending(self):
+        """排队和执行中的验证请求数"""
+        with self._inflight_lock:
+            return len(self._inflight)
+
+    def _verify(self, key, sessdata):
+        bili_data = self.fetch_nav(sessdata)
+        if bili_data.get('code') != 0:
+            return None
+
+        data = bili_data.get('data') or {}
+        user_info = {
+            'mid': data.get('mid'),
+            'uname': data.get('uname', ''),
+            'face': data.get('face', '')
+        }
+        self._cache_put(key, user_info)
+        return user_info
+
+# 进程级共享的B站客户端
+bilibili_client = BilibiliClient()
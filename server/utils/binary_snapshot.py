@@ -0,0 +1,199 @@
+import os
+import json
+import sys
+import mmap
+import zlib
+import struct
+import marshal
+import threading
+from itertools import repeat
+from .file_storage import ReadOnlyDict, freeze, thaw, locked, save_data, flush_pending, _stat_key
+
+# 文件头: 魔数, 格式版本, marshal 版本, Python 主/次版本, 布局,
+#         源JSON文件的 (mtime_ns, size, inode), 数据长度, 数据的 CRC32
+MAGIC = b'NBSNAP\r\n'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sHHBBBxQQQQI')
+# 快照文件扩展名，与JSON文件同目录同名
+SUFFIX = '.snap'
+
+# 数据布局
+LAYOUT_VALUE = 0    # 任意值，整体 marshal，加载后再转为只读视图
+LAYOUT_RECORDS = 1  # 字典列表，按键集合分组后按列存储
+LAYOUT_KEYED = 2    # 值全部为字典的字典（如会话），键单独一列，值按 LAYOUT_RECORDS 存储
+
+class SnapshotError(Exception):
+    """快照文件损坏或与当前运行环境不兼容"""
+
+def snapshot_path(filename):
+    """返回JSON文件对应的快照路径，如 data/mappings.json -> data/mappings.snap"""
+    return os.path.splitext(filename)[0] + SUFFIX
+
+def _is_nested(value):
+    return isinstance(value, (dict, list, tuple))
+
+def _encode_records(records):
+    """把字典列表编码为按列存储的分组
+
+    键（及其顺序）相同的记录归为一组，每组保存键元组、行号（只有一组时省略）
+    和每个键的一列值；含有嵌套对象的列单独标记，加载时才需要逐个转换。
+    每列单独 marshal，编码大文件时不会长时间占用 GIL。
+    """
+    groups = {}
+    for index, record in enumerate(records):
+        keys = tuple(record)
+        group = groups.get(keys)
+        if group is None:
+            group = groups[keys] = ([], [[] for _ in keys])
+        group[0].append(index)
+        for column, value in zip(group[1], record.values()):
+            column.append(value)
+
+    encoded = []
+    for keys, (indices, columns) in groups.items():
+        nested = tuple(any(_is_nested(v) for v in column) for column in columns)
+        columns = tuple(
+            marshal.dumps([thaw(v) for v in column] if is_nested else column)
+            for column, is_nested in zip(columns, nested))
+        encoded.append((keys, None if len(groups) == 1 else indices, columns, nested))
+    return (len(records), encoded)
+
+def _decode_records(payload):
+    count, groups = payload
+    if len(groups) == 1 and groups[0][1] is None:
+        return tuple(_decode_group(groups[0], count))
+    result = [None] * count
+    for group in groups:
+        for index, record in zip(group[1], _decode_group(group, len(group[1]))):
+            result[index] = record
+    return tuple(result)
+
+def _decode_group(group, count):
+    keys, _, columns, nested = group
+    if not keys:
+        return [ReadOnlyDict() for _ in range(count)]
+    columns = [marshal.loads(column) for column in columns]
+    columns = [list(map(freeze, column)) if is_nested else column
+               for column, is_nested in zip(columns, nested)]
+    # 逐行用 zip 拼出字典，不在 Python 层逐个字段赋值
+    return map(ReadOnlyDict, map(zip, repeat(keys), zip(*columns)))
+
+def encode(data):
+    """返回 (布局, marshal 后的数据)，data 可以是只读视图或普通对象"""
+    if isinstance(data, (list, tuple)) and all(isinstance(r, dict) for r in data):
+        return LAYOUT_RECORDS, marshal.dumps(_encode_records(data))
+    if isinstance(data, dict) and all(isinstance(v, dict) for v in data.values()):
+        return LAYOUT_KEYED, marshal.dumps((list(data), _encode_records(list(data.values()))))
+    return LAYOUT_VALUE, marshal.dumps(thaw(data))
+
+def decode(layout, payload):
+    """把 marshal 解出的数据还原为只读视图"""
+    if layout == LAYOUT_RECORDS:
+        return _decode_records(payload)
+    if layout == LAYOUT_KEYED:
+        keys, records = payload
+        return ReadOnlyDict(zip(keys, _decode_records(records)))
+    if layout == LAYOUT_VALUE:
+        return freeze(payload)
+    raise SnapshotError(f"未知的数据布局 {layout}")
+
+def write_snapshot(path, data, source_key=(0, 0, 0)):
+    """原子写入快照文件，source_key 为对应JSON文件的 (mtime_ns, size, inode)，返回写入的字节数"""
+    layout, payload = encode(data)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, marshal.version,
+                         sys.version_info[0], sys.version_info[1], layout,
+                         *source_key, len(payload), zlib.crc32(payload))
+    directory = os.path.dirname(path)
+    tmp = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(header) + len(payload)
+
+def read_header(path):
+    """读取快照文件头，返回字段字典；文件不是快照时抛出 SnapshotError"""
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER.size)
+    return _parse_header(raw)
+
+def _parse_header(raw):
+    if len(raw) < HEADER.size:
+        raise SnapshotError('文件过短')
+    (magic, version, marshal_version, py_major, py_minor, layout,
+     mtime_ns, size, inode, length, crc) = HEADER.unpack_from(raw, 0)
+    if magic != MAGIC:
+        raise SnapshotError('不是快照文件')
+    return {
+        'format_version': version,
+        'marshal_version': marshal_version,
+        'python': (py_major, py_minor),
+        'layout': layout,
+        'source_key': (mtime_ns, size, inode),
+        'length': length,
+        'crc32': crc,
+    }
+
+def compatible(header):
+    """marshal 格式只保证同一 Python 版本内兼容，版本不同时应回退到JSON"""
+    return (header['format_version'] == FORMAT_VERSION
+            and header['marshal_version'] == marshal.version
+            and header['python'] == tuple(sys.version_info[:2]))
+
+def read_snapshot(path, source_key=None):
+    """用 mmap 读取快照并返回只读视图
+
+    文件不存在、与运行环境不兼容或与 source_key 对应的JSON文件版本不一致时返回 None，
+    文件损坏时抛出 SnapshotError。
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise SnapshotError('文件过短')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = _parse_header(mm[:HEADER.size])
+            if not compatible(header):
+                return None
+            if source_key is not None and header['source_key'] != tuple(source_key):
+                return None
+            end = HEADER.size + header['length']
+            if end > len(mm):
+                raise SnapshotError('文件被截断')
+            view = memoryview(mm)[HEADER.size:end]
+            try:
+                if zlib.crc32(view) != header['crc32']:
+                    raise SnapshotError('校验和不匹配')
+                try:
+                    payload = marshal.loads(view)
+                except (EOFError, ValueError, TypeError) as e:
+                    raise SnapshotError(f"无法解析: {str(e)}")
+            finally:
+                view.release()
+    return decode(header['layout'], payload)
+
+def build_from_json(filename):
+    """为JSON文件生成快照（不受 SNAPSHOT_MIN_BYTES 限制），返回快照路径和字节数"""
+    path = snapshot_path(filename)
+    # 持有写锁，保证读取的JSON和记录的版本一致
+    with locked(filename):
+        key = _stat_key(filename)
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return path, write_snapshot(path, data, key)
+
+def restore_json(filename):
+    """由快照还原JSON文件（例如JSON丢失或需要人工查看），快照会随写入更新为新版本"""
+    data = read_snapshot(snapshot_path(filename))
+    if data is None:
+        raise SnapshotError('快照不存在或与当前 Python 版本不兼容')
+    save_data(filename, data)
+    flush_pending(filename)
+    return len(data)
@@ -0,0 +1,336 @@
+import math
+import bisect
+from itertools import accumulate, chain
+from operator import itemgetter
+
+_NO_DELTA = (frozenset(), frozenset())
+
+class CowDict:
+    """按键的哈希分成固定数量子字典的映射，用于快照之间共享结构
+
+    copy() 只复制子字典列表，副本第一次修改某个子字典时才复制它，
+    因此从一个版本派生下一个版本并修改少量键的开销与总键数基本无关。
+    副本派生之后原对象不应再修改，否则会影响共享的子字典。迭代顺序不是插入顺序。
+    """
+
+    PARTS = 256
+    __slots__ = ('_parts', '_owned', '_len')
+
+    def __init__(self, items=()):
+        self._parts = [{} for _ in range(self.PARTS)]
+        # 已复制为自己所有的子字典编号，None 表示全部归自己所有
+        self._owned = None
+        parts = self._parts
+        count = self.PARTS
+        for key, value in items.items() if isinstance(items, dict) else items:
+            parts[hash(key) % count][key] = value
+        self._len = sum(map(len, parts))
+
+    def _index(self, key):
+        return hash(key) % self.PARTS
+
+    def _own(self, index):
+        """返回可以原地修改的子字典，与其他副本共享时先复制"""
+        part = self._parts[index]
+        if self._owned is None or index in self._owned:
+            return part
+        part = self._parts[index] = dict(part)
+        self._owned.add(index)
+        return part
+
+    def copy(self):
+        other = CowDict.__new__(CowDict)
+        other._parts = list(self._parts)
+        other._owned = set()
+        other._len = self._len
+        return other
+
+    def get(self, key, default=None):
+        return self._parts[hash(key) % self.PARTS].get(key, default)
+
+    def get_many(self, keys):
+        """按顺序返回多个键的值，不存在的为 None"""
+        parts = self._parts
+        count = self.PARTS
+        return [parts[hash(key) % count].get(key) for key in keys]
+
+    def __getitem__(self, key):
+        return self._parts[hash(key) % self.PARTS][key]
+
+    def __contains__(self, key):
+        return key in self._parts[hash(key) % self.PARTS]
+
+    def __setitem__(self, key, value):
+        part = self._own(self._index(key))
+        if key not in part:
+            self._len += 1
+        part[key] = value
+
+    def __delitem__(self, key):
+        part = self._own(self._index(key))
+        del part[key]
+        self._len -= 1
+
+    def pop(self, key, *default):
+        index = self._index(key)
+        if key not in self._parts[index]:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._len -= 1
+        return self._own(index).pop(key)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._parts)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return chain.from_iterable(part.values() for part in self._parts)
+
+    def items(self):
+        return chain.from_iterable(part.items() for part in self._parts)
+
+class CowSortedList:
+    """分块存储的升序列表，用于快照之间共享结构
+
+    元素按顺序分成若干块，copy() 只复制块列表，副本修改某一块时才复制这一块，
+    插入和删除的开销约为 O(块数 + 块大小)，而不是整个列表的长度。
+    按下标访问和二分查找先定位块再在块内查找。副本派生之后原对象不应再修改。
+    """
+
+    CHUNK = 1024
+    __slots__ = ('_chunks', '_maxes', '_offsets', '_owned', '_len')
+
+    def __init__(self, iterable=()):
+        self._owned = None
+        self._assign(sorted(iterable))
+
+    def _assign(self, items):
+        """用已排序的 items 重新分块，所有块归自己所有"""
+        self._chunks = [items[i:i + self.CHUNK] for i in range(0, len(items), self.CHUNK)]
+        self._owned = None
+        self._reindex()
+
+    def _reindex(self):
+        self._maxes = list(map(itemgetter(-1), self._chunks))
+        # 每块第一个元素的下标
+        self._offsets = [0]
+        self._offsets.extend(accumulate(map(len, self._chunks)))
+        self._len = self._offsets.pop()
+
+    def _own(self, pos):
+        chunk = self._chunks[pos]
+        if self._owned is None or id(chunk) in self._owned:
+            return chunk
+        chunk = self._chunks[pos] = list(chunk)
+        # 保存引用，块的 id 在副本存活期间不会被复用
+        self._owned[id(chunk)] = chunk
+        return chunk
+
+    def copy(self):
+        other = CowSortedList.__new__(CowSortedList)
+        other._chunks = list(self._chunks)
+        other._maxes = self._maxes
+        other._offsets = self._offsets
+        other._owned = {}
+        other._len = self._len
+        return other
+
+    def add(self, value):
+        if not self._chunks:
+            self._chunks = [[value]]
+            if self._owned is not None:
+                self._owned[id(self._chunks[0])] = self._chunks[0]
+            self._reindex()
+            return
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos == len(self._chunks):
+            pos -= 1
+        chunk = self._own(pos)
+        bisect.insort(chunk, value)
+        if len(chunk) > 2 * self.CHUNK:
+            # 过大的块一分为二，两半都是新列表
+            half = len(chunk) // 2
+            self._chunks[pos:pos + 1] = [chunk[:half], chunk[half:]]
+            if self._owned is not None:
+                for new in self._chunks[pos:pos + 2]:
+                    self._owned[id(new)] = new
+        self._reindex()
+
+    def discard(self, value):
+        """删除一个等于 value 的元素，返回是否存在"""
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos == len(self._chunks):
+            return False
+        i = bisect.bisect_left(self._chunks[pos], value)
+        if i == len(self._chunks[pos]) or self._chunks[pos][i] != value:
+            return False
+        chunk = self._own(pos)
+        del chunk[i]
+        if not chunk:
+            del self._chunks[pos]
+        self._reindex()
+        return True
+
+    def update(self, values):
+        """批量插入，整体重新分块，适合一次插入很多元素"""
+        items = list(self)
+        items.extend(values)
+        items.sort()
+        self._assign(items)
+
+    def bisect_left(self, value):
+        pos = bisect.bisect_left(self._maxes, value)
+        if pos == len(self._chunks):
+            return self._len
+        return self._offsets[pos] + bisect.bisect_left(self._chunks[pos], value)
+
+    def bisect_right(self, value):
+        pos = bisect.bisect_right(self._maxes, value)
+        if pos == len(self._chunks):
+            return self._len
+        return self._offsets[pos] + bisect.bisect_right(self._chunks[pos], value)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            result = []
+            if start >= stop:
+                return result
+            pos = bisect.bisect_right(self._offsets, start) - 1
+            offset = start - self._offsets[pos]
+            while len(result) < stop - start and pos < len(self._chunks):
+                chunk = self._chunks[pos]
+                result.extend(chunk[offset:offset + stop - start - len(result)])
+                pos += 1
+                offset = 0
+            return result
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('CowSortedList index out of range')
+        pos = bisect.bisect_right(self._offsets, index) - 1
+        return self._chunks[pos][index - self._offsets[pos]]
+
+class CowSetMap:
+    """键 -> 集合 的映射，用于快照之间共享结构（倒排表、按上传者的映射集合等）
+
+    副本不复制与其他版本共享的集合，而是把增删记录在两个小的 frozenset 里，
+    积累到集合大小的平方根时才合并成归自己所有的新集合，之后在副本内原地修改。
+    单次增删只复制很小的增删集合，合并的开销分摊到多次修改上。
+    副本派生之后原对象不应再修改。
+    """
+
+    # 共享集合的增删至少积累到这么多条才合并
+    DELTA_MIN = 32
+    __slots__ = ('_sets', '_deltas', '_owned')
+
+    def __init__(self, items=()):
+        # 键 -> 集合，与其他副本共享的集合不会被原地修改
+        self._sets = CowDict(items)
+        # 键 -> (新增, 删除)，两者都是 frozenset；新增与集合不相交，删除是集合的子集
+        self._deltas = CowDict()
+        # 归自己所有、可以原地修改的键，None 表示全部归自己所有
+        self._owned = None
+
+    def copy(self):
+        other = CowSetMap.__new__(CowSetMap)
+        other._sets = self._sets.copy()
+        other._deltas = self._deltas.copy()
+        other._owned = set()
+        return other
+
+    def add(self, key, member):
+        members = self._sets.get(key)
+        if members is None:
+            self._sets[key] = {member}
+            if self._owned is not None:
+                self._owned.add(key)
+        elif self._owned is None or key in self._owned:
+            members.add(member)
+        else:
+            added, removed = self._deltas.get(key, _NO_DELTA)
+            if member in removed:
+                self._set_delta(key, members, added, removed - {member})
+            elif member not in members:
+                self._set_delta(key, members, added | {member}, removed)
+
+    def discard(self, key, member):
+        members = self._sets.get(key)
+        if members is None:
+            return
+        if self._owned is None or key in self._owned:
+            members.discard(member)
+            if not members:
+                del self._sets[key]
+            return
+        added, removed = self._deltas.get(key, _NO_DELTA)
+        if member in added:
+            self._set_delta(key, members, added - {member}, removed)
+        elif member in members:
+            self._set_delta(key, members, added, removed | {member})
+
+    def _set_delta(self, key, members, added, removed):
+        if len(added) + len(removed) > max(self.DELTA_MIN, math.isqrt(len(members))):
+            self._deltas.pop(key, None)
+            members = (members - removed) | added
+            if members:
+                self._sets[key] = members
+                self._owned.add(key)
+            else:
+                del self._sets[key]
+        elif added or removed:
+            self._deltas[key] = (added, removed)
+        else:
+            self._deltas.pop(key, None)
+
+    def count(self, key):
+        """返回键对应集合的大小，不存在时为 0"""
+        members = self._sets.get(key)
+        if members is None:
+            return 0
+        added, removed = self._deltas.get(key, _NO_DELTA)
+        return len(members) + len(added) - len(removed)
+
+    def get(self, key):
+        """返回键对应的集合（新建的集合，调用方可以修改），不存在时为空集合"""
+        members = self._sets.get(key)
+        if members is None:
+            return set()
+        delta = self._deltas.get(key)
+        if delta is None:
+            return set(members)
+        added, removed = delta
+        return (members - removed) | added
+
+    def intersect(self, key, candidates):
+        """返回 candidates 与键对应集合的交集，candidates 是调用方可以修改的集合"""
+        members = self._sets.get(key)
+        if members is None:
+            return set()
+        delta = self._deltas.get(key)
+        if delta is None:
+            candidates &= members
+            return candidates
+        added, removed = delta
+        return ((candidates & members) - removed) | (candidates & added)
+
+    def items(self):
+        """逐个返回 (键, 集合)，集合为空的键不返回"""
+        for key in self._sets:
+            members = self.get(key)
+            if members:
+                yield key, members
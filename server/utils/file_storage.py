@@ -1,11 +1,71 @@
 import os
 import json
 import time
+import atexit
 import threading
+from contextlib import contextmanager
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，只能使用进程内的锁（仅支持单进程部署）
+    fcntl = None
+
+# 写入后是否 fsync 文件和目录，保证断电后数据不丢
+FSYNC_WRITES = False
+# 是否以缩进格式写入（便于人工查看，但更大更慢）
+PRETTY_JSON = False
+# 组提交窗口（秒），窗口内对同一文件的多次写入合并为一次落盘；0 表示同步写入
+# 尚未落盘的数据只对本进程可见，多进程部署时应保持为 0
+GROUP_COMMIT_WINDOW = 0
+# 是否用操作系统文件锁（fcntl.flock）协调多个进程，例如 gunicorn 多 worker
+CROSS_PROCESS_LOCKS = True
+# 是否为较大的JSON文件在旁边维护二进制快照（见 binary_snapshot），冷启动时优先读取
+BINARY_SNAPSHOTS = True
+# 小于此大小的文件直接解析JSON，不生成快照
+SNAPSHOT_MIN_BYTES = 256 * 1024
+# 快照由后台线程在文件最后一次写入后延迟这么多秒生成，连续写入只生成一次
+SNAPSHOT_DELAY = 2.0
+# 序列化大列表/字典时每块的元素数。C 编码器执行期间不释放 GIL，
+# 整个文件一次编码会让其他线程（包括只读请求）停顿，分块后可以在块之间切换
+ENCODE_CHUNK = 1000
 
 # 文件锁，防止并发写入问题
 file_locks = {}
 lock_for_locks = threading.Lock()
+# 跨进程锁: 锁文件路径 -> ProcessLock
+process_locks = {}
+
+# 进程内已解析文件缓存: filename -> (mtime_ns, size, inode, 只读数据)
+_cache = {}
+_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+# 正在替换的文件: filename -> (新文件的 mtime_ns, size, inode, 只读数据)
+# 替换完成到更新缓存之间，读取方看到的新文件也能命中，不必等待写锁
+_replacing = {}
+
+# 组提交中等待落盘的数据: filename -> 只读数据
+_pending_writes = {}
+_pending_lock = threading.Lock()
+# 保证同一时间只有一个落盘过程，避免旧版本覆盖新版本
+_flush_lock = threading.Lock()
+_pending_event = threading.Event()
+_flusher = None
+
+# 等待后台生成快照的文件: filename -> (mtime_ns, size, inode, 只读数据)，只保留最新版本
+_snapshot_pending = {}
+_snapshot_lock = threading.Lock()
+_snapshot_event = threading.Event()
+_snapshot_writer = None
+
+# 写入统计
+_write_stats = {
+    'writes': 0,
+    'bytes_written': 0,
+    'write_seconds': 0.0,
+    'max_write_seconds': 0.0,
+    'coalesced': 0,
+}
 
 def get_file_lock(filename):
     with lock_for_locks:
@@ -13,28 +73,438 @@ def get_file_lock(filename):
             file_locks[filename] = threading.Lock()
         return file_locks[filename]
 
+class ProcessLock:
+    """基于 fcntl.flock 的跨进程读写锁
+
+    共享模式允许多个进程同时持有（并行读取），排他模式用于写入和读-改-写。
+    同一线程可重入，重入时沿用最外层的模式；每次加锁使用独立的文件描述符，
+    同一进程的不同线程之间也会按读写语义互斥。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def acquire(self, exclusive=True, blocking=True):
+        """加锁，非阻塞模式下锁被占用时返回 False"""
+        depth = getattr(self._local, 'depth', 0)
+        if depth or fcntl is None or not CROSS_PROCESS_LOCKS:
+            self._local.depth = depth + 1
+            return True
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+        self._local.fd = fd
+        self._local.depth = 1
+        return True
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            fd = getattr(self._local, 'fd', None)
+            self._local.fd = None
+            if fd is not None:
+                # 关闭描述符即释放 flock
+                os.close(fd)
+
+    @contextmanager
+    def hold(self, exclusive=True):
+        self.acquire(exclusive)
+        try:
+            yield
+        finally:
+            self.release()
+
+def get_process_lock(path):
+    with lock_for_locks:
+        if path not in process_locks:
+            process_locks[path] = ProcessLock(path)
+        return process_locks[path]
+
+def directory_lock(directory):
+    """返回目录的跨进程锁，锁文件为目录下的 .lock"""
+    return get_process_lock(os.path.join(directory or '.', '.lock'))
+
+def locked(filename, exclusive=True):
+    """持有 filename 所在目录的跨进程锁
+
+    文件写入时会被替换成新的 inode，所以锁加在固定的锁文件上。
+    """
+    return directory_lock(os.path.dirname(filename)).hold(exclusive)
+
+class ReadOnlyDict(dict):
+    """只读字典，缓存中的对象都以这种形式交给调用方"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("缓存数据只读，需要修改请使用 load_data 获取副本")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        return thaw(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+def freeze(obj):
+    """递归地把 dict/list 转换为只读视图 (ReadOnlyDict/tuple)"""
+    if isinstance(obj, ReadOnlyDict):
+        return obj
+    if isinstance(obj, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+def thaw(obj):
+    """递归地把只读视图还原为普通的 dict/list 副本"""
+    if isinstance(obj, dict):
+        return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [thaw(v) for v in obj]
+    return obj
+
+def _stat_key(filename):
+    # 原子替换会换成新的 inode，即使 mtime 和大小相同也能发现其他进程的写入
+    st = os.stat(filename)
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+_compact_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def _encode(data):
+    if PRETTY_JSON:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    if isinstance(data, (list, tuple)) and len(data) > ENCODE_CHUNK:
+        parts = [_compact_encoder.encode(data[i:i + ENCODE_CHUNK])[1:-1].encode('utf-8')
+                 for i in range(0, len(data), ENCODE_CHUNK)]
+        return b'[' + b','.join(parts) + b']'
+    if isinstance(data, dict) and len(data) > ENCODE_CHUNK:
+        items = list(data.items())
+        parts = [_compact_encoder.encode(dict(items[i:i + ENCODE_CHUNK]))[1:-1].encode('utf-8')
+                 for i in range(0, len(items), ENCODE_CHUNK)]
+        return b'{' + b','.join(parts) + b'}'
+    return _compact_encoder.encode(data).encode('utf-8')
+
+def _fsync_dir(directory):
+    # Windows 不支持对目录 fsync
+    if os.name == 'nt':
+        return
+    fd = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _write_file(filename, frozen):
+    """先写临时文件再原子替换，崩溃时目标文件要么是旧内容要么是新内容"""
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    label = metrics.file_label(filename)
+    start = time.perf_counter()
+    payload = _encode(frozen)
+    metrics.STORAGE_SERIALIZE.observe(time.perf_counter() - start, label)
+
+    lock = get_file_lock(filename)
+    start = time.perf_counter()
+    # 先取跨进程锁再取进程内锁，与事务（先持有目录锁再读写文件）的顺序一致
+    with locked(filename), lock:
+        acquired = time.perf_counter()
+        metrics.STORAGE_LOCK_WAIT.observe(acquired - start, label, 'write')
+        tmp = os.path.join(
+            directory, f".{os.path.basename(filename)}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(payload)
+                if FSYNC_WRITES:
+                    f.flush()
+                    os.fsync(f.fileno())
+            # 重命名不改变 inode 和 mtime，临时文件的版本就是替换后的版本
+            key = _stat_key(tmp)
+            _replacing[filename] = key + (frozen,)
+            os.replace(tmp, filename)
+        except BaseException:
+            _replacing.pop(filename, None)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        # 自己写入的数据直接更新缓存，避免下次读取重新解析
+        _cache[filename] = key + (frozen,)
+        _replacing.pop(filename, None)
+        if FSYNC_WRITES:
+            _fsync_dir(directory)
+    # 快照不在写锁内生成，交给后台线程合并写入
+    _schedule_snapshot(filename, frozen, key)
+
+    elapsed = time.perf_counter() - start
+    metrics.STORAGE_WRITE.observe(time.perf_counter() - acquired, label)
+    metrics.STORAGE_BYTES.inc(label, 'write', amount=len(payload))
+    _write_stats['writes'] += 1
+    _write_stats['bytes_written'] += len(payload)
+    _write_stats['write_seconds'] += elapsed
+    _write_stats['max_write_seconds'] = max(_write_stats['max_write_seconds'], elapsed)
+
+def _refresh_snapshot(filename, frozen, key):
+    """按JSON文件的 key 版本重写快照，文件较小时删除已过期的快照
+
+    不需要持有 filename 的锁：快照头记录了对应的JSON版本，版本不一致的快照读取时会被忽略。
+    快照只是加速读取的副本，写入失败不影响JSON。
+    """
+    if not BINARY_SNAPSHOTS:
+        return
+    from . import binary_snapshot
+    path = binary_snapshot.snapshot_path(filename)
+    try:
+        if key[1] >= SNAPSHOT_MIN_BYTES:
+            written = binary_snapshot.write_snapshot(path, frozen, key)
+            metrics.STORAGE_SNAPSHOT.inc(metrics.file_label(filename), 'written')
+            metrics.STORAGE_BYTES.inc(metrics.file_label(filename), 'snapshot_write', amount=written)
+        elif os.path.exists(path):
+            os.remove(path)
+    except Exception as e:
+        print(f"Snapshot write error: {path} ({str(e)})")
+
+def _schedule_snapshot(filename, frozen, key):
+    """登记需要（重新）生成快照的文件版本，由后台线程在 SNAPSHOT_DELAY 秒后写入"""
+    global _snapshot_writer
+    if not BINARY_SNAPSHOTS:
+        return
+    with _snapshot_lock:
+        _snapshot_pending[filename] = key + (frozen,)
+        if _snapshot_writer is None:
+            _snapshot_writer = threading.Thread(
+                target=_run_snapshot_writer, name='snapshot-writer', daemon=True)
+            _snapshot_writer.start()
+    _snapshot_event.set()
+
+def _run_snapshot_writer():
+    while True:
+        _snapshot_event.wait()
+        # 等待写入平静下来，期间同一文件的多次写入只生成最后一个版本的快照
+        time.sleep(SNAPSHOT_DELAY)
+        _snapshot_event.clear()
+        try:
+            flush_snapshots()
+        except Exception as e:
+            print(f"Snapshot writer error: {str(e)}")
+
+def flush_snapshots():
+    """立即生成所有等待中的快照，进程退出时自动调用"""
+    with _snapshot_lock:
+        batch = list(_snapshot_pending.items())
+        _snapshot_pending.clear()
+    for filename, entry in batch:
+        key, frozen = entry[:3], entry[3]
+        try:
+            current = _stat_key(filename)
+        except FileNotFoundError:
+            continue
+        # 文件已被再次修改（本进程的新版本已登记，其他进程的由其自己生成），旧版本的快照没有用处
+        if current != key:
+            continue
+        _refresh_snapshot(filename, frozen, key)
+
+def _load_snapshot(filename, key):
+    """读取与JSON文件当前版本一致的快照，没有可用的快照时返回 None"""
+    if not BINARY_SNAPSHOTS or key[1] < SNAPSHOT_MIN_BYTES:
+        return None
+    from . import binary_snapshot
+    path = binary_snapshot.snapshot_path(filename)
+    label = metrics.file_label(filename)
+    try:
+        data = binary_snapshot.read_snapshot(path, key)
+    except Exception as e:
+        print(f"Snapshot load error: {path} 已损坏，改为解析JSON ({str(e)})")
+        data = None
+    metrics.STORAGE_SNAPSHOT.inc(label, 'hit' if data is not None else 'miss')
+    return data
+
+def _run_flusher():
+    while True:
+        _pending_event.wait()
+        # 等待窗口结束，让窗口内的写入合并
+        time.sleep(GROUP_COMMIT_WINDOW)
+        _pending_event.clear()
+        try:
+            flush_pending()
+        except Exception as e:
+            print(f"Group commit flush error: {str(e)}")
+
+def flush_pending(filename=None):
+    """立即落盘组提交中等待的数据，filename 为空时落盘全部"""
+    with _flush_lock:
+        with _pending_lock:
+            if filename is None:
+                batch = list(_pending_writes.items())
+            elif filename in _pending_writes:
+                batch = [(filename, _pending_writes[filename])]
+            else:
+                batch = []
+
+        for name, frozen in batch:
+            _write_file(name, frozen)
+            with _pending_lock:
+                # 落盘期间可能又有新的写入，只移除已写入的这一版
+                if _pending_writes.get(name) is frozen:
+                    del _pending_writes[name]
+
 def save_data(filename, data):
-    """将数据保存到JSON文件"""
-    # 确保目录存在
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    
-    # 获取文件锁并写入
-    with get_file_lock(filename):
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    """将数据保存到JSON文件
 
-def load_data(filename, default=None):
-    """从JSON文件加载数据，如果文件不存在则返回默认值"""
+    默认同步原子写入；开启组提交后先进入内存，窗口结束时合并落盘，
+    期间的读取直接返回最新数据。
+    """
+    global _flusher
+    frozen = freeze(data)
+
+    if GROUP_COMMIT_WINDOW <= 0:
+        _write_file(filename, frozen)
+        return
+
+    with _pending_lock:
+        if filename in _pending_writes:
+            _write_stats['coalesced'] += 1
+        _pending_writes[filename] = frozen
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run_flusher, name='group-commit', daemon=True)
+            _flusher.start()
+    _pending_event.set()
+
+def _cached(filename, key):
+    """返回与文件版本 key 一致的缓存数据，没有时返回 None"""
+    # 先查正在替换的版本：写入方先更新缓存再移除它，按这个顺序读取不会两边都错过
+    replacing = _replacing.get(filename)
+    if replacing is not None and replacing[:3] == key:
+        return replacing[3]
+    entry = _cache.get(filename)
+    if entry is not None and entry[:3] == key:
+        return entry[3]
+    return None
+
+def load_view(filename, default=None):
+    """返回文件内容的只读缓存视图，文件未变化时不会重新解析"""
     if default is None:
         default = {}
-        
-    if not os.path.exists(filename):
-        return default
-    
-    with get_file_lock(filename):
+
+    # 组提交中尚未落盘的数据优先
+    pending = _pending_writes.get(filename)
+    if pending is not None:
+        _cache_stats['hits'] += 1
+        return pending
+
+    # 读取文件状态和查缓存之间本进程可能刚替换了文件，未命中时重新读取一次状态
+    for _ in range(2):
+        try:
+            key = _stat_key(filename)
+        except FileNotFoundError:
+            return freeze(default)
+        data = _cached(filename, key)
+        if data is not None:
+            _cache_stats['hits'] += 1
+            return data
+
+    label = metrics.file_label(filename)
+    lock = get_file_lock(filename)
+    start = time.perf_counter()
+    # 共享锁：多个进程可以同时解析，但不会读到正在进行的读-改-写之前的旧数据
+    with locked(filename, exclusive=False), lock:
+        metrics.STORAGE_LOCK_WAIT.observe(time.perf_counter() - start, label, 'read')
+        # 等锁期间可能已有其他线程完成了解析
+        entry = _cache.get(filename)
+        try:
+            key = _stat_key(filename)
+        except FileNotFoundError:
+            return freeze(default)
+        if entry is not None and entry[:3] == key:
+            _cache_stats['hits'] += 1
+            return entry[3]
+
+        _cache_stats['misses'] += 1
+        if entry is not None:
+            _cache_stats['invalidations'] += 1
+
+        start = time.perf_counter()
+        # 优先读取与JSON文件版本一致的二进制快照
+        data = _load_snapshot(filename, key)
+        if data is not None:
+            metrics.STORAGE_PARSE.observe(time.perf_counter() - start, label)
+            _cache[filename] = key + (data,)
+            return data
+
         try:
             with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            # 文件损坏或不存在时返回默认值
-            return default
+                data = freeze(json.load(f))
+        except FileNotFoundError:
+            _cache.pop(filename, None)
+            return freeze(default)
+        except json.JSONDecodeError as e:
+            # 文件损坏时返回默认值
+            print(f"Load data error: {filename} 已损坏 ({str(e)})")
+            _cache.pop(filename, None)
+            return freeze(default)
+
+        metrics.STORAGE_PARSE.observe(time.perf_counter() - start, label)
+        metrics.STORAGE_BYTES.inc(label, 'read', amount=key[1])
+        _cache[filename] = key + (data,)
+        # 没有可用快照的大文件（升级前的数据或手动编辑过的JSON）在后台补写快照，下次启动直接读取
+        if BINARY_SNAPSHOTS and key[1] >= SNAPSHOT_MIN_BYTES:
+            _schedule_snapshot(filename, data, key)
+        return data
+
+def load_data(filename, default=None):
+    """从JSON文件加载数据，如果文件不存在则返回默认值
+
+    返回的是可自由修改的副本；只读场景请使用 load_view
+    """
+    if default is None:
+        default = {}
+
+    if filename not in _pending_writes and not os.path.exists(filename):
+        return default
+
+    view = load_view(filename, default=default)
+    return thaw(view)
+
+def invalidate_cache(filename=None):
+    """丢弃缓存，filename 为空时清空全部"""
+    with lock_for_locks:
+        if filename is None:
+            _cache_stats['invalidations'] += len(_cache)
+            _cache.clear()
+        elif _cache.pop(filename, None) is not None:
+            _cache_stats['invalidations'] += 1
+
+def get_cache_stats():
+    """返回缓存命中统计"""
+    stats = dict(_cache_stats)
+    stats['entries'] = len(_cache)
+    return stats
+
+def get_write_stats():
+    """返回写入延迟和字节数统计"""
+    stats = dict(_write_stats)
+    stats['pending'] = len(_pending_writes)
+    stats['avg_write_seconds'] = stats['write_seconds'] / stats['writes'] if stats['writes'] else 0.0
+    return stats
+
+# 退出时确保组提交中的数据落盘，再写出等待中的快照（atexit 按注册的相反顺序执行）
+atexit.register(flush_snapshots)
+atexit.register(flush_pending)
@@ -0,0 +1,364 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from .file_storage import (save_data, load_data, load_view, freeze, thaw, flush_pending,
+                           invalidate_cache, locked, directory_lock, get_process_lock)
+from .play_log import ShardedPlayLog, PLAY_LOG_DIR
+from .user_shards import USERS_DIR, USER_SHARDS, user_shard, shard_directory
+from .storage import StorageBackend, PLAY_KEY_TTL
+
+# 映射数据存储文件
+MAPPINGS_FILE = 'data/mappings.json'
+# 压缩后的会话快照
+SESSIONS_FILE = 'data/sessions.json'
+# 登录时追加写入的会话日志，压缩时并入快照
+SESSIONS_JOURNAL = 'data/sessions.journal'
+# 旧版的全局歌单元数据文件，首次访问歌单时拆分到用户分片并重命名为 *.migrated
+PLAYLISTS_FILE = 'data/playlists.json'
+# 旧版的歌曲列表目录: <playlist_id>.json，随歌单一起移入分片
+PLAYLIST_SONGS_DIR = 'data/playlist_songs'
+# 分片目录下的歌单元数据文件和歌曲列表目录:
+# data/users/<分片号>/playlists.json, data/users/<分片号>/songs/<playlist_id>.json
+SHARD_PLAYLISTS_FILE = 'playlists.json'
+SHARD_SONGS_DIR = 'songs'
+
+class JsonBackend(StorageBackend):
+    """基于 data/ 下JSON文件的存储后端
+
+    映射作为一个文件读写，写入开销与集合大小成正比。歌单和播放记录按用户哈希分片
+    存放在 data/users/<分片号>/ 下，写入只重写所在分片的文件。
+    读-改-写在事务中持有相应目录（映射为数据目录，歌单为分片目录）的跨进程排他锁，
+    多个 worker 进程不会互相覆盖，不同分片的用户互不等待。
+    """
+
+    name = 'json'
+
+    def __init__(self, mappings_file=MAPPINGS_FILE, sessions_file=SESSIONS_FILE,
+                 sessions_journal=SESSIONS_JOURNAL, playlists_file=PLAYLISTS_FILE,
+                 playlist_songs_dir=PLAYLIST_SONGS_DIR, play_log_dir=PLAY_LOG_DIR,
+                 users_dir=USERS_DIR, user_shards=USER_SHARDS):
+        self.mappings_file = mappings_file
+        self.sessions_file = sessions_file
+        self.sessions_journal = sessions_journal
+        self.playlists_file = playlists_file
+        self.playlist_songs_dir = playlist_songs_dir
+        self.users_dir = users_dir
+        self.user_shards = user_shards
+        # 幂等键保存在各分片播放日志旁，在分片锁内与追加记录一起检查
+        self.play_log = ShardedPlayLog(users_dir, user_shards, legacy_directory=play_log_dir,
+                                       key_ttl=PLAY_KEY_TTL)
+        # 确认过旧版歌单文件已拆分后不再检查
+        self._playlists_split = False
+        self._journal_lock = threading.Lock()
+        # 会话快照和日志单独使用一个锁文件，不与映射事务的数据目录锁（data/.lock）互相等待
+        self._sessions_lock = get_process_lock(sessions_journal + '.lock')
+        # 同一时间只允许一个进程压缩会话日志
+        self._compaction_lock = get_process_lock(sessions_journal + '.compaction.lock')
+
+    @contextmanager
+    def transaction(self):
+        # 锁住映射所在的目录，期间其他进程的读-改-写会等待；歌单按分片加锁，见 playlist_transaction
+        with directory_lock(os.path.dirname(self.mappings_file)).hold():
+            yield
+
+    def change_token(self, collection, shard=None):
+        # 缓存视图只在文件变化时换成新对象，正好可以作为令牌
+        if collection == 'mappings':
+            return load_view(self.mappings_file, default=[])
+        return load_view(self._playlists_file(shard), default=[])
+
+    # 映射
+    def load_mappings(self):
+        return load_view(self.mappings_file, default=[])
+
+    def insert_mapping(self, mapping):
+        self.insert_mappings([mapping])
+
+    def insert_mappings(self, mappings):
+        with self.transaction():
+            existing = list(load_view(self.mappings_file, default=[]))
+            existing.extend(mappings)
+            save_data(self.mappings_file, existing)
+
+    def delete_mapping(self, mapping_id):
+        with self.transaction():
+            mappings = [m for m in load_view(self.mappings_file, default=[]) if m['id'] != mapping_id]
+            save_data(self.mappings_file, mappings)
+
+    def update_mappings(self, mappings):
+        updates = {m['id']: m for m in mappings}
+        with self.transaction():
+            save_data(self.mappings_file, [
+                updates.get(m['id'], m) for m in load_view(self.mappings_file, default=[])
+            ])
+
+    # 会话：快照 + 追加日志
+    def _replay_journal(self, path, sessions, offset=0):
+        """把日志从 offset 开始的完整行应用到 sessions，返回读到的位置"""
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return offset
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 其他进程正在写入的行，下次再读
+                    break
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 写入中途崩溃留下的不完整行
+                    continue
+                if entry.get('deleted'):
+                    sessions[entry['token']] = None
+                else:
+                    sessions[entry['token']] = entry['session']
+        return offset
+
+    @staticmethod
+    def _inode(path):
+        try:
+            return os.stat(path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _snapshot_key(self):
+        try:
+            st = os.stat(self.sessions_file)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load_sessions(self):
+        sessions, _ = self.load_sessions_with_cursor()
+        return sessions
+
+    def load_sessions_with_cursor(self):
+        with self._sessions_lock.hold(exclusive=False):
+            cursor_snapshot = self._snapshot_key()
+            sessions = load_data(self.sessions_file, default={})
+            changes = {}
+            self._replay_journal(self.sessions_journal + '.compacting', changes)
+            inode = self._inode(self.sessions_journal)
+            offset = self._replay_journal(self.sessions_journal, changes)
+        for token, session in changes.items():
+            if session is None:
+                sessions.pop(token, None)
+            else:
+                sessions[token] = session
+        return sessions, (cursor_snapshot, inode, offset)
+
+    def session_changes(self, cursor):
+        if cursor is None or cursor[0] != self._snapshot_key():
+            # 其他进程压缩过会话，需要全量重新加载
+            return None, cursor
+        _, inode, offset = cursor
+        changes = {}
+        with self._sessions_lock.hold(exclusive=False):
+            journal_inode = self._inode(self.sessions_journal)
+            if inode is not None and journal_inode != inode:
+                # 日志已被换出，先读完换出前的部分，再从头读新日志
+                compacting = self.sessions_journal + '.compacting'
+                if self._inode(compacting) != inode:
+                    return None, cursor
+                self._replay_journal(compacting, changes, offset)
+                offset = 0
+            elif inode is None:
+                offset = 0
+            offset = self._replay_journal(self.sessions_journal, changes, offset)
+        return changes, (cursor[0], journal_inode, offset)
+
+    def _find_in_journal(self, path, token, session):
+        """在日志中查找令牌的最后一条记录，没有记录时返回传入的 session"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return session
+        # 先整体查找子串，大多数日志里根本没有这个令牌，不必逐行解析
+        needle = json.dumps(token).encode('utf-8')
+        if needle not in data:
+            return session
+        for line in data.split(b'\n'):
+            if needle not in line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('token') == token:
+                session = None if entry.get('deleted') else entry['session']
+        return session
+
+    def get_session(self, token):
+        with self._sessions_lock.hold(exclusive=False):
+            session = load_view(self.sessions_file, default={}).get(token)
+            session = self._find_in_journal(self.sessions_journal + '.compacting', token, session)
+            return self._find_in_journal(self.sessions_journal, token, session)
+
+    def add_session(self, token, session):
+        payload = json.dumps({'token': token, 'session': session}, ensure_ascii=False) + '\n'
+
+        os.makedirs(os.path.dirname(self.sessions_journal), exist_ok=True)
+        with self._sessions_lock.hold(), self._journal_lock:
+            with open(self.sessions_journal, 'a', encoding='utf-8') as f:
+                f.write(payload)
+
+    def begin_session_compaction(self):
+        # 其他进程正在压缩时跳过本次压缩
+        if not self._compaction_lock.acquire(blocking=False):
+            return None
+        # 换出当前日志，压缩期间的新登录写入新日志
+        compacting = self.sessions_journal + '.compacting'
+        with self._sessions_lock.hold(), self._journal_lock:
+            if os.path.exists(self.sessions_journal):
+                if os.path.exists(compacting):
+                    # 上次压缩中断留下的日志，合并到一起
+                    with open(self.sessions_journal, 'rb') as src, open(compacting, 'ab') as dst:
+                        dst.write(src.read())
+                    os.remove(self.sessions_journal)
+                else:
+                    os.replace(self.sessions_journal, compacting)
+        return compacting
+
+    def finish_session_compaction(self, handle, expired_before):
+        if handle is None:
+            return
+        try:
+            # 快照 + 换出的日志即为换出时刻的全部会话，之后的登录在新日志里，不受影响
+            with self._sessions_lock.hold():
+                sessions = load_data(self.sessions_file, default={})
+                changes = {}
+                self._replay_journal(handle, changes)
+                for token, session in changes.items():
+                    if session is None:
+                        sessions.pop(token, None)
+                    else:
+                        sessions[token] = session
+                live = {token: session for token, session in sessions.items()
+                        if session['created_at'] >= expired_before}
+                save_data(self.sessions_file, live)
+                if os.path.exists(handle):
+                    os.remove(handle)
+        finally:
+            self._compaction_lock.release()
+
+    # 歌单：按所有者分片，每个分片一个元数据文件，歌曲列表每个歌单一个文件
+    def _shard_dir(self, shard):
+        return shard_directory(self.users_dir, shard)
+
+    def _playlists_file(self, shard):
+        return os.path.join(self._shard_dir(shard), SHARD_PLAYLISTS_FILE)
+
+    def _songs_file(self, shard, playlist_id):
+        return os.path.join(self._shard_dir(shard), SHARD_SONGS_DIR, f"{playlist_id}.json")
+
+    def playlist_shard(self, user_id):
+        return user_shard(user_id, self.user_shards)
+
+    def playlist_shards(self):
+        return range(self.user_shards)
+
+    @contextmanager
+    def playlist_transaction(self, shard):
+        # 拆分旧文件要按 数据目录 -> 分片 的顺序加锁，必须在持有分片锁之前完成
+        self._split_legacy_playlists()
+        with directory_lock(self._shard_dir(shard)).hold():
+            yield
+
+    def _split_legacy_playlists(self):
+        """把旧版全局歌单文件拆分到各用户分片，返回拆分的歌单数
+
+        歌曲列表文件直接移动到分片目录，更早的格式（歌曲存在 songs 字段里）顺便拆出；
+        分片中已有的歌单不会重复添加，中途失败后可以重新执行。
+        """
+        if self._playlists_split:
+            return 0
+        if not os.path.exists(self.playlists_file):
+            self._playlists_split = True
+            return 0
+
+        # 组提交中尚未落盘的数据先写入；落盘线程也要取目录锁，不能在持锁时等待它
+        flush_pending()
+        with locked(self.playlists_file):
+            legacy = load_view(self.playlists_file, default=[])
+            by_shard = {}
+            for playlist in legacy:
+                by_shard.setdefault(self.playlist_shard(playlist.get('user_id')), []).append(playlist)
+
+            for shard, playlists in by_shard.items():
+                with directory_lock(self._shard_dir(shard)).hold():
+                    existing = list(load_view(self._playlists_file(shard), default=[]))
+                    known = {p['id'] for p in existing}
+                    for playlist in playlists:
+                        songs_file = self._songs_file(shard, playlist['id'])
+                        legacy_songs = os.path.join(self.playlist_songs_dir, f"{playlist['id']}.json")
+                        if 'songs' in playlist:
+                            save_data(songs_file, thaw(playlist['songs']))
+                            playlist = freeze({k: v for k, v in playlist.items() if k != 'songs'})
+                        elif os.path.exists(legacy_songs):
+                            os.makedirs(os.path.dirname(songs_file), exist_ok=True)
+                            os.replace(legacy_songs, songs_file)
+                        if playlist['id'] not in known:
+                            existing.append(playlist)
+                    save_data(self._playlists_file(shard), existing)
+
+        # 分片文件落盘后再换掉旧文件
+        flush_pending()
+        with locked(self.playlists_file):
+            if os.path.exists(self.playlists_file):
+                os.replace(self.playlists_file, self.playlists_file + '.migrated')
+                if os.path.isdir(self.playlist_songs_dir):
+                    os.replace(self.playlist_songs_dir, self.playlist_songs_dir + '.migrated')
+            invalidate_cache(self.playlists_file)
+        self._playlists_split = True
+        return len(legacy)
+
+    def split_legacy_data(self):
+        """把旧版全局歌单文件和播放日志拆分到用户分片，返回 (歌单数, 播放记录数)"""
+        return self._split_legacy_playlists(), self.play_log.split_legacy()
+
+    def load_playlists(self, shard=None):
+        self._split_legacy_playlists()
+        if shard is not None:
+            return load_view(self._playlists_file(shard), default=[])
+        return [p for s in self.playlist_shards() for p in load_view(self._playlists_file(s), default=[])]
+
+    def load_playlist_songs(self, playlist_id, owner=None):
+        if owner is not None:
+            shard = self.playlist_shard(owner)
+        else:
+            # 不知道所有者时逐个分片查找歌曲文件
+            shard = next((s for s in self.playlist_shards()
+                          if os.path.exists(self._songs_file(s, playlist_id))), 0)
+        return load_view(self._songs_file(shard, playlist_id), default=[])
+
+    def save_playlist(self, playlist, songs=None):
+        shard = self.playlist_shard(playlist.get('user_id'))
+        with self.playlist_transaction(shard):
+            if songs is not None:
+                save_data(self._songs_file(shard, playlist['id']), songs)
+
+            playlists = list(load_view(self._playlists_file(shard), default=[]))
+            index = next((i for i, p in enumerate(playlists) if p['id'] == playlist['id']), None)
+            if index is None:
+                playlists.append(playlist)
+            else:
+                playlists[index] = playlist
+            save_data(self._playlists_file(shard), playlists)
+
+    # 播放记录：按用户分片的只追加分段日志
+    def append_play_records(self, records):
+        return self.play_log.append_many(records)
+
+    def play_record_changes(self, cursor):
+        # 按分片记录读到的分段和偏移，像会话日志一样只读取新追加的部分
+        return self.play_log.read_changes(cursor)
+
+    def iter_play_records(self, user_id=None):
+        if user_id is not None:
+            return self.play_log.iter_user_records(user_id)
+        return self.play_log.iter_records()
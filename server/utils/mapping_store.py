@@ -0,0 +1,418 @@
+import time
+import threading
+from datetime import datetime
+from operator import itemgetter
+from .cow import CowDict, CowSetMap, CowSortedList
+from .file_storage import freeze
+from .search_index import NGramIndex
+from .storage import get_backend
+
+# 维护排序视图的排序方式，键末尾带上 id 保证唯一且跨重启稳定
+SORT_ORDERS = ('newest', 'popular')
+
+# 导出时每次持锁取出的映射条数
+EXPORT_BATCH_SIZE = 500
+
+# insert_many 一次插入至少这么多条时整体重建排序视图，否则逐条插入
+BULK_INSERT_SIZE = 1000
+
+def parse_timestamp(value):
+    """把 ISO8601 时间或秒级时间戳解析为秒数，无法解析时抛出 ValueError"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        pass
+    # 旧版本 Python 的 fromisoformat 不支持 +0800 这样的时区写法
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid timestamp: {value!r}")
+
+def updated_key(mapping):
+    """返回映射在导出顺序中的键 (最后修改时间, id)，旧数据没有 updated_at 时用 created_at"""
+    try:
+        updated = parse_timestamp(mapping.get('updated_at') or mapping.get('created_at'))
+    except ValueError:
+        updated = 0.0
+    return (updated, mapping['id'])
+
+def sort_key(sort, mapping, play_deltas=None):
+    """返回映射在指定排序下的键，按键降序即为列表顺序
+
+    play_deltas 为尚未落盘的播放次数增量 {bvid: count}
+    """
+    if sort == 'newest':
+        return (mapping.get('created_at', ''), mapping['id'])
+    play_count = mapping.get('play_count', 0)
+    if play_deltas:
+        play_count += play_deltas.get(mapping.get('bvid'), 0)
+    return (play_count, mapping.get('created_at', ''), mapping['id'])
+
+class MappingSnapshot:
+    """映射集合某一版本的只读快照，包含全部索引和排序视图
+
+    快照发布后不再修改：写入方用 derive() 复制出下一版本，修改完成后整体替换，
+    读取方拿到的快照在使用期间始终一致，不需要加锁。
+    所有容器都是写时复制的（见 utils/cow.py），相邻版本共享未修改的部分，
+    派生和修改的开销与改动的条数相关，而不是整个映射集合的大小。
+    """
+
+    def __init__(self, source=None, version=0):
+        # 建立快照时存储后端的变更令牌，用于发现外部修改
+        self.source = source
+        # 内容每次变化（本进程写入或发现外部修改）加一，用于生成 ETag
+        self.version = version
+        # id -> 映射
+        self.by_id = CowDict()
+        # bvid -> id
+        self.by_bvid = CowDict()
+        # uploader_uid -> {id}
+        self.by_uploader = CowSetMap()
+        # id -> 插入序号，用于按目录顺序输出
+        self.seq = CowDict()
+        self.next_seq = 0
+        # 升序排列的 (插入序号, id)，即目录顺序
+        self.order = CowSortedList()
+        # 歌名/艺术家的 n-gram 倒排索引
+        self.search = NGramIndex()
+        # 排序方式 -> 升序排列的排序键列表，倒序遍历即为降序
+        self.views = {sort: CowSortedList() for sort in SORT_ORDERS}
+        # 按最后修改时间升序排列的 (时间, id)，用于增量导出
+        self.by_updated = CowSortedList()
+
+    @classmethod
+    def build(cls, mappings, source, version):
+        # 全量重建时先用普通字典建立索引，最后一次性转换和排序，避免逐条插入
+        by_id = {}
+        by_bvid = {}
+        by_uploader = {}
+        seq = {}
+        next_seq = 0
+        for next_seq, mapping in enumerate(mappings, 1):
+            mapping_id = mapping['id']
+            by_id[mapping_id] = mapping
+            seq[mapping_id] = next_seq - 1
+            by_bvid[mapping.get('bvid')] = mapping_id
+            by_uploader.setdefault(mapping.get('uploader_uid'), set()).add(mapping_id)
+
+        snapshot = cls(source, version)
+        snapshot.by_id = CowDict(by_id)
+        snapshot.by_bvid = CowDict(by_bvid)
+        snapshot.by_uploader = CowSetMap(by_uploader)
+        snapshot.seq = CowDict(seq)
+        snapshot.next_seq = next_seq
+        snapshot.order = CowSortedList((s, i) for i, s in seq.items())
+        snapshot.search = NGramIndex.build(
+            (m['id'], m.get('songName', ''), m.get('artist', '')) for m in by_id.values())
+        snapshot.views = {
+            sort: CowSortedList(sort_key(sort, m) for m in by_id.values())
+            for sort in SORT_ORDERS
+        }
+        snapshot.by_updated = CowSortedList(updated_key(m) for m in by_id.values())
+        return snapshot
+
+    def derive(self):
+        """复制出可修改的下一版本，只复制各容器的顶层结构，映射对象本身只读可以共享"""
+        snapshot = MappingSnapshot.__new__(MappingSnapshot)
+        snapshot.source = self.source
+        snapshot.version = self.version + 1
+        snapshot.by_id = self.by_id.copy()
+        snapshot.by_bvid = self.by_bvid.copy()
+        snapshot.by_uploader = self.by_uploader.copy()
+        snapshot.seq = self.seq.copy()
+        snapshot.next_seq = self.next_seq
+        snapshot.order = self.order.copy()
+        snapshot.search = self.search.copy()
+        snapshot.views = {sort: view.copy() for sort, view in self.views.items()}
+        snapshot.by_updated = self.by_updated.copy()
+        return snapshot
+
+    def index(self, mapping):
+        mapping_id = mapping['id']
+        self.by_id[mapping_id] = mapping
+        self.seq[mapping_id] = self.next_seq
+        self.order.add((self.next_seq, mapping_id))
+        self.next_seq += 1
+        self.by_bvid[mapping.get('bvid')] = mapping_id
+        self.by_uploader.add(mapping.get('uploader_uid'), mapping_id)
+        self.search.add(mapping_id, mapping.get('songName', ''), mapping.get('artist', ''))
+
+    def unindex(self, mapping):
+        mapping_id = mapping['id']
+        del self.by_id[mapping_id]
+        self.order.discard((self.seq.pop(mapping_id), mapping_id))
+        self.search.remove(mapping_id)
+        if self.by_bvid.get(mapping.get('bvid')) == mapping_id:
+            del self.by_bvid[mapping.get('bvid')]
+        self.by_uploader.discard(mapping.get('uploader_uid'), mapping_id)
+
+    def insort_views(self, mapping):
+        for sort, view in self.views.items():
+            view.add(sort_key(sort, mapping))
+        self.by_updated.add(updated_key(mapping))
+
+    def remove_updated(self, mapping):
+        self.by_updated.discard(updated_key(mapping))
+
+    def remove_from_views(self, mapping, sorts=SORT_ORDERS):
+        for sort in sorts:
+            self.views[sort].discard(sort_key(sort, mapping))
+
+class MappingRepository:
+    """映射仓库，维护 id / bvid / uploader_uid 哈希索引
+
+    数据和索引以不可变的 MappingSnapshot 发布：读取只取当前快照，不加锁，
+    也不会等待正在序列化整个文件的写入；写入串行执行，先写存储，
+    再在复制出的新快照上更新索引并整体替换。存储被其他进程修改时会自动重建快照。
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        # 只用于串行化写入和快照重建，读取不需要
+        self._lock = threading.RLock()
+        self._snapshot = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    def _sync(self):
+        """发现外部修改时重建快照，调用方持有 self._lock"""
+        token = self.backend.change_token('mappings')
+        snapshot = self._snapshot
+        if snapshot is not None and token is snapshot.source:
+            return snapshot
+        view = self.backend.load_mappings()
+        version = snapshot.version + 1 if snapshot is not None else 1
+        self._snapshot = MappingSnapshot.build(view, token, version)
+        return self._snapshot
+
+    def _publish(self, snapshot):
+        # 自己的写入会更新令牌，记下它以免下次误判为外部修改；替换引用是原子的
+        snapshot.source = self.backend.change_token('mappings')
+        self._snapshot = snapshot
+
+    def snapshot(self):
+        """返回当前快照，不等待写入
+
+        令牌变化时尝试重建；如果此时有写入正在进行（令牌多半正是它改变的），
+        直接返回当前快照，写入完成后新快照自然可见。
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and self.backend.change_token('mappings') is snapshot.source:
+            return snapshot
+        if snapshot is not None:
+            if not self._lock.acquire(blocking=False):
+                return snapshot
+        else:
+            # 首次加载时只能等待
+            self._lock.acquire()
+        try:
+            return self._sync()
+        finally:
+            self._lock.release()
+
+    def version(self):
+        """返回映射集合的版本号，只检查变更令牌，不重新读取数据"""
+        return self.snapshot().version
+
+    def all(self):
+        """按目录顺序返回全部映射（只读）"""
+        snapshot = self.snapshot()
+        return snapshot.by_id.get_many(map(itemgetter(1), snapshot.order))
+
+    def get(self, mapping_id):
+        return self.snapshot().by_id.get(mapping_id)
+
+    def get_by_bvid(self, bvid):
+        snapshot = self.snapshot()
+        mapping_id = snapshot.by_bvid.get(bvid)
+        return snapshot.by_id.get(mapping_id) if mapping_id is not None else None
+
+    def get_many_by_bvid(self, bvids):
+        """按顺序返回每个 bvid 对应的映射，不存在的为 None，整批使用同一个快照"""
+        snapshot = self.snapshot()
+        return snapshot.by_id.get_many(snapshot.by_bvid.get_many(bvids))
+
+    def list_by_uploader(self, uploader_uid):
+        snapshot = self.snapshot()
+        ids = sorted(snapshot.by_uploader.get(uploader_uid), key=snapshot.seq.get)
+        return [snapshot.by_id[i] for i in ids]
+
+    def search(self, query):
+        """返回歌名或艺术家包含 query（忽略大小写）的映射，按目录顺序"""
+        snapshot = self.snapshot()
+        ids = sorted(snapshot.search.search(query), key=snapshot.seq.get)
+        return [snapshot.by_id[i] for i in ids]
+
+    def count(self):
+        return len(self.snapshot().by_id)
+
+    def page(self, sort, limit, offset=0, after=None, play_deltas=None):
+        """按排序视图取一页映射
+
+        after 为上一页最后一条的排序键（键集分页），定位只需一次二分；
+        play_deltas 中播放次数有变化的映射按合并后的键参与排序。
+        """
+        snapshot = self.snapshot()
+        view = snapshot.views[sort]
+        by_id = snapshot.by_id
+
+        # 播放次数尚未落盘的映射单独排序，与基础视图归并
+        bumped = []
+        skip = set()
+        if sort == 'popular' and play_deltas:
+            for bvid in play_deltas:
+                mapping_id = snapshot.by_bvid.get(bvid)
+                if mapping_id is not None:
+                    skip.add(mapping_id)
+                    key = sort_key(sort, by_id[mapping_id], play_deltas)
+                    if after is None or key < after:
+                        bumped.append(key)
+            bumped.sort()
+
+        i = len(view) if after is None else view.bisect_left(after)
+        j = len(bumped)
+        if not skip:
+            # 没有需要归并的映射时直接按偏移定位
+            i = max(i - offset, 0)
+            offset = 0
+        result = []
+        while len(result) < limit and (i > 0 or j > 0):
+            if j > 0 and (i == 0 or bumped[j - 1] > view[i - 1]):
+                j -= 1
+                mapping_id = bumped[j][-1]
+            else:
+                i -= 1
+                mapping_id = view[i][-1]
+                if mapping_id in skip:
+                    continue
+            if offset > 0:
+                offset -= 1
+                continue
+            result.append(by_id[mapping_id])
+        return result
+
+    def iter_updated_since(self, since=None, batch_size=EXPORT_BATCH_SIZE):
+        """按最后修改时间升序逐批返回映射，since 为秒数（含）
+
+        每批取当前快照二分定位一次，批与批之间按上一批最后的键续读，
+        导出期间被修改的映射会在后面以新时间再出现一次。
+        """
+        last = None
+        while True:
+            snapshot = self.snapshot()
+            view = snapshot.by_updated
+            if last is None:
+                i = 0 if since is None else view.bisect_left((since,))
+            else:
+                i = view.bisect_right(last)
+            keys = view[i:i + batch_size]
+            batch = [snapshot.by_id[key[-1]] for key in keys]
+            if not batch:
+                return
+            yield batch
+            last = keys[-1]
+
+    def insert(self, mapping):
+        """插入新映射，bvid 已存在时返回 False"""
+        with self._lock, self.backend.transaction():
+            current = self._sync()
+            if mapping.get('bvid') in current.by_bvid:
+                return False
+            mapping = freeze(mapping)
+            # 先建立新快照再写存储，建立索引出错时不会留下已保存却无法加载的映射
+            snapshot = current.derive()
+            snapshot.index(mapping)
+            snapshot.insort_views(mapping)
+            self.backend.insert_mapping(mapping)
+            self._publish(snapshot)
+            return True
+
+    def insert_many(self, mappings):
+        """在一次写入中插入多条映射，返回与输入对应的布尔列表
+
+        bvid 已存在或在本批中重复的映射不插入，对应位置为 False。
+        """
+        with self._lock, self.backend.transaction():
+            current = self._sync()
+            accepted = []
+            seen = set()
+            results = []
+            for mapping in mappings:
+                bvid = mapping.get('bvid')
+                if bvid in current.by_bvid or bvid in seen:
+                    results.append(False)
+                    continue
+                seen.add(bvid)
+                accepted.append(freeze(mapping))
+                results.append(True)
+            if not accepted:
+                return results
+
+            snapshot = current.derive()
+            for mapping in accepted:
+                snapshot.index(mapping)
+            if len(accepted) < BULK_INSERT_SIZE:
+                for mapping in accepted:
+                    snapshot.insort_views(mapping)
+            else:
+                # 条数较多时整体重新分块，已有部分有序，开销接近线性
+                for sort, view in snapshot.views.items():
+                    view.update(sort_key(sort, m) for m in accepted)
+                snapshot.by_updated.update(updated_key(m) for m in accepted)
+            self.backend.insert_mappings(accepted)
+            self._publish(snapshot)
+            return results
+
+    def delete(self, mapping_id):
+        """删除映射并返回被删除的映射，不存在时返回 None"""
+        with self._lock, self.backend.transaction():
+            current = self._sync()
+            mapping = current.by_id.get(mapping_id)
+            if mapping is None:
+                return None
+            self.backend.delete_mapping(mapping_id)
+            snapshot = current.derive()
+            snapshot.unindex(mapping)
+            snapshot.remove_from_views(mapping)
+            snapshot.remove_updated(mapping)
+            self._publish(snapshot)
+            return mapping
+
+    def apply_play_counts(self, deltas):
+        """批量累加播放次数 {bvid: count}，未知的 bvid 被忽略"""
+        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        with self._lock, self.backend.transaction():
+            current = self._sync()
+            updated_mappings = []
+            for bvid, delta in deltas.items():
+                mapping_id = current.by_bvid.get(bvid)
+                if mapping_id is None or not delta:
+                    continue
+                mapping = current.by_id[mapping_id]
+                updated_mappings.append(
+                    freeze(dict(mapping, play_count=mapping.get('play_count', 0) + delta,
+                                updated_at=now)))
+            if not updated_mappings:
+                return
+
+            # 先写入存储，成功后再在新快照上更新映射和排序视图
+            self.backend.update_mappings(updated_mappings)
+            snapshot = current.derive()
+            for updated in updated_mappings:
+                snapshot.remove_from_views(current.by_id[updated['id']], sorts=('popular',))
+                snapshot.remove_updated(current.by_id[updated['id']])
+                snapshot.by_id[updated['id']] = updated
+                snapshot.views['popular'].add(sort_key('popular', updated))
+                snapshot.by_updated.add(updated_key(updated))
+            self._publish(snapshot)
+
+# 进程级共享的映射仓库
+mapping_repo = MappingRepository()
@@ -0,0 +1,190 @@
+import os
+import time
+import bisect
+import threading
+
+# 延迟直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 全部指标，按注册顺序输出
+_registry = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    """只增计数器，按标签值分别计数"""
+
+    type = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labels, k, None, v) for k, v in sorted(self._values.items())]
+
+class Histogram:
+    """固定桶的直方图，输出与 Prometheus 相同的累计桶、_sum 和 _count"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # 标签值 -> [各桶计数（不累计，最后一个为 +Inf）, 总和, 次数]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in sorted(self._values.items())]
+        samples = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', self.labels, key, ('le', _format_value(float(bound))), cumulative))
+            samples.append((self.name + '_sum', self.labels, key, None, total))
+            samples.append((self.name + '_count', self.labels, key, None, count))
+        return samples
+
+    def register(self):
+        _registry.append(self)
+        return self
+
+class GaugeFunc:
+    """取值时才计算的仪表，func 返回 {标签值元组: 数值}"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help_text, func, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.func = func
+        _registry.append(self)
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            print(f"Metrics gauge error: {self.name} ({str(e)})")
+            return []
+        return [(self.name, self.labels, k, None, v) for k, v in sorted(values.items())]
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return Histogram(name, help_text, labels, buckets).register()
+
+def render():
+    """以 Prometheus 文本格式输出全部指标"""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, label_names, label_values, extra, value in metric.samples():
+            lines.append(f"{name}{_format_labels(label_names, label_values, extra)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+def file_label(filename):
+    """把文件路径归并为低基数的标签，每个歌单一个的文件合并为 目录/*"""
+    parent = os.path.dirname(filename)
+    if os.path.basename(parent) in ('', 'data'):
+        return os.path.basename(filename)
+    return os.path.basename(parent) + '/*'
+
+# HTTP 请求
+REQUEST_LATENCY = histogram(
+    'nb_http_request_duration_seconds', '请求处理耗时（到生成响应对象为止）',
+    ('blueprint', 'route', 'method'))
+REQUEST_COUNT = Counter(
+    'nb_http_requests_total', '请求数（按状态码）', ('blueprint', 'route', 'method', 'status'))
+
+# JSON 文件存储
+STORAGE_LOCK_WAIT = histogram(
+    'nb_storage_lock_wait_seconds', '等待 get_file_lock 的时间', ('file', 'op'))
+STORAGE_PARSE = histogram(
+    'nb_storage_parse_seconds', '读取并解析JSON文件或二进制快照的时间（缓存未命中时）', ('file',))
+STORAGE_SERIALIZE = histogram(
+    'nb_storage_serialize_seconds', '写入前序列化JSON的时间', ('file',))
+STORAGE_WRITE = histogram(
+    'nb_storage_write_seconds', '写临时文件并原子替换的时间', ('file',))
+STORAGE_BYTES = Counter(
+    'nb_storage_bytes_total', '读写的字节数', ('file', 'op'))
+STORAGE_SNAPSHOT = Counter(
+    'nb_storage_snapshot_total', '二进制快照的命中/未命中（回退到JSON）/写入次数', ('file', 'event'))
+
+# B站接口
+BILIBILI_LATENCY = histogram(
+    'nb_bilibili_request_duration_seconds', 'B站接口调用耗时（含重试）', ('endpoint', 'outcome'))
+BILIBILI_VERIFY_EVENTS = Counter(
+    'nb_bilibili_verify_total', '登录验证请求数（发起/合并到进行中的请求/因排队已满被拒绝）', ('event',))
+
+_slow_request_ms = None
+
+def _slow_threshold():
+    global _slow_request_ms
+    if _slow_request_ms is None:
+        from config import SLOW_REQUEST_MS
+        _slow_request_ms = SLOW_REQUEST_MS
+    return _slow_request_ms
+
+def install_request_metrics(app):
+    """注册请求中间件，记录每个蓝图/路由的耗时和状态码，并按阈值输出慢请求日志"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        # 用路由模板而不是实际路径作为标签，避免基数爆炸
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        blueprint = request.blueprint or 'app'
+        REQUEST_LATENCY.observe(elapsed, blueprint, route, request.method)
+        REQUEST_COUNT.inc(blueprint, route, request.method, str(response.status_code))
+
+        threshold = _slow_threshold()
+        if threshold and elapsed * 1000 >= threshold:
+            print(f"Slow request: {request.method} {request.full_path.rstrip('?')} "
+                  f"{response.status_code} {elapsed * 1000:.1f} ms")
+        return response
@@ -0,0 +1,96 @@
+import atexit
+import threading
+from .mapping_store import mapping_repo
+
+# 距离上次落盘超过多少秒后刷新
+FLUSH_INTERVAL = 5.0
+# 累计多少次未落盘的播放后立即刷新
+FLUSH_MAX_PENDING = 500
+
+class PlayCountBuffer:
+    """按 bvid 聚合播放次数增量，定时或达到阈值时批量落盘"""
+
+    def __init__(self, flush_func, interval=FLUSH_INTERVAL, max_pending=FLUSH_MAX_PENDING):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._pending_total = 0
+        # 正在落盘的增量，落盘完成前读取时仍需计入
+        self._flushing = {}
+        # 每次记录播放或落盘结束时加一，未落盘的增量会计入列表响应
+        self._version = 0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='play-count-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Flush play counts error: {str(e)}")
+
+    def increment(self, bvid, count=1):
+        """记录一次（或多次）播放"""
+        with self._lock:
+            self._pending[bvid] = self._pending.get(bvid, 0) + count
+            self._pending_total += count
+            self._version += 1
+            should_flush = self._pending_total >= self.max_pending
+            self._ensure_thread()
+        if should_flush:
+            self._wake.set()
+
+    def version(self):
+        """返回增量的版本号，每次 increment 或落盘结束后变化"""
+        with self._lock:
+            return self._version
+
+    def pending(self):
+        """返回尚未落盘的增量 {bvid: count}"""
+        with self._lock:
+            if not self._flushing:
+                return dict(self._pending)
+            merged = dict(self._flushing)
+            for bvid, count in self._pending.items():
+                merged[bvid] = merged.get(bvid, 0) + count
+            return merged
+
+    def flush(self):
+        """把累计的增量一次性写入存储"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing = self._pending
+                self._pending = {}
+                self._pending_total = 0
+
+            try:
+                self.flush_func(self._flushing)
+            except Exception:
+                # 写入失败时把增量放回缓冲区，等待下次重试
+                with self._lock:
+                    for bvid, count in self._flushing.items():
+                        self._pending[bvid] = self._pending.get(bvid, 0) + count
+                        self._pending_total += count
+                raise
+            finally:
+                # 落盘期间新映射快照已发布而增量仍计入 pending()，这段时间生成的响应会重复计数；
+                # 换版本号使其缓存和 ETag 失效
+                with self._lock:
+                    self._flushing = {}
+                    self._version += 1
+
+# 进程级共享的播放次数缓冲区，退出时确保落盘
+play_counts = PlayCountBuffer(mapping_repo.apply_play_counts)
+atexit.register(play_counts.flush)
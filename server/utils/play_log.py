@@ -0,0 +1,463 @@
+import os
+import json
+import time
+import threading
+from .file_storage import directory_lock
+from .mapping_store import parse_timestamp
+from .user_shards import USERS_DIR, USER_SHARDS, user_shard, shard_directory
+
+# 旧版的全局播放日志目录，按大小滚动为多个分段文件，每行一条JSON记录
+PLAY_LOG_DIR = 'data/play_log'
+# 分片目录下播放日志的子目录: data/users/<分片号>/plays
+SHARD_PLAYS_DIR = 'plays'
+# 旧版播放记录文件（整个JSON数组）
+LEGACY_PLAY_RECORDS_FILE = 'data/play_records.json'
+# 单个分段的最大字节数，超过后滚动到新分段
+MAX_SEGMENT_BYTES = 16 * 1024 * 1024
+
+SEGMENT_PREFIX = 'plays-'
+SEGMENT_SUFFIX = '.ndjson'
+# 0 号分段保留给从全局播放日志拆分过来的旧记录，新记录从 1 号分段开始
+MIGRATED_SEGMENT = 0
+# 幂等键文件，与分段文件在同一目录，每行 [user_id, play_id, 接收时间]
+KEYS_FILE = 'keys.ndjson'
+# 幂等键文件至少达到这个大小才会压缩（去掉过期的键）
+KEYS_COMPACT_BYTES = 1024 * 1024
+# 导入旧版播放记录时各日志目录下的临时文件，登记后换成新分段
+LEGACY_IMPORT_FILE = 'legacy-import.ndjson.tmp'
+
+def encode_record(record):
+    """把一条记录编码为一行紧凑的JSON"""
+    line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+    return (line + '\n').encode('utf-8')
+
+class PlayKeys:
+    """一个分片内最近上报过的 (user_id, play_id)，批量上报重试时用于去重
+
+    保存在播放日志旁的只追加文件中，所有进程共享。读写都在调用方持有的
+    分片目录锁内进行，检查键和追加播放记录是一个原子操作。进程内缓存已读到的键和位置，
+    之后只增量读取其他进程追加的部分；文件被压缩（换成新的 inode）后重新读取。
+    """
+
+    def __init__(self, log, ttl):
+        self.log = log
+        self.path = os.path.join(log.directory, KEYS_FILE)
+        self.ttl = ttl
+        # (user_id, play_id) -> 接收时间
+        self._keys = {}
+        self._inode = None
+        self._offset = 0
+        # 文件末尾是崩溃留下的不完整行，下次追加前先补换行
+        self._partial = False
+        self._compact_at = KEYS_COMPACT_BYTES
+
+    def _rebuild(self):
+        """键文件不存在时（升级前的数据）从播放日志中带 play_id 的记录恢复"""
+        cutoff = time.time() - self.ttl
+        keys = {}
+        for record in self.log.iter_records():
+            play_id = record.get('play_id')
+            if not play_id:
+                continue
+            try:
+                received_at = parse_timestamp(record.get('received_at'))
+            except ValueError:
+                continue
+            if received_at >= cutoff:
+                keys[(record.get('user_id'), play_id)] = received_at
+        self._rewrite(keys)
+
+    def _rewrite(self, keys):
+        """用 keys 整体替换键文件"""
+        os.makedirs(self.log.directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(self._encode(key, received_at) for key, received_at in keys.items()))
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self._keys = keys
+        self._inode = st.st_ino
+        self._offset = st.st_size
+        self._partial = False
+        self._compact_at = max(KEYS_COMPACT_BYTES, 2 * st.st_size)
+
+    @staticmethod
+    def _encode(key, received_at):
+        return (json.dumps([key[0], key[1], received_at], ensure_ascii=False) + '\n').encode('utf-8')
+
+    def _catch_up(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._rebuild()
+            return
+        if st.st_ino != self._inode:
+            self._keys = {}
+            self._inode = st.st_ino
+            self._offset = 0
+        if st.st_size <= self._offset:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        self._offset += len(data)
+        self._partial = not data.endswith(b'\n')
+        for line in data.splitlines():
+            try:
+                user_id, play_id, received_at = json.loads(line)
+            except ValueError:
+                # 持有锁时读到的不完整行只能是崩溃留下的
+                continue
+            self._keys[(user_id, play_id)] = received_at
+
+    def check(self, records):
+        """返回 (与 records 对应的布尔列表, 新的键 {键: 接收时间})，调用方持有分片目录锁
+
+        带 play_id 且保留期内记录过的（包括本批中更早出现的）为 False。
+        """
+        self._catch_up()
+        now = time.time()
+        cutoff = now - self.ttl
+        flags = []
+        new_keys = {}
+        for record in records:
+            play_id = record.get('play_id')
+            if play_id is None:
+                flags.append(True)
+                continue
+            key = (record.get('user_id'), play_id)
+            if key in new_keys or self._keys.get(key, cutoff - 1) >= cutoff:
+                flags.append(False)
+                continue
+            new_keys[key] = now
+            flags.append(True)
+        return flags, new_keys
+
+    def commit(self, new_keys):
+        """播放记录写入成功后登记新的键，调用方持有分片目录锁"""
+        payload = b''.join(self._encode(key, received_at) for key, received_at in new_keys.items())
+        if self._partial:
+            payload = b'\n' + payload
+        with open(self.path, 'ab') as f:
+            f.write(payload)
+        self._keys.update(new_keys)
+        self._offset += len(payload)
+        self._partial = False
+        if self._offset >= self._compact_at:
+            cutoff = time.time() - self.ttl
+            self._rewrite({k: t for k, t in self._keys.items() if t >= cutoff})
+
+class PlayLog:
+    """只追加的行式播放日志
+
+    每次记录只是一次小的 append 写入，不再重写整个文件；
+    读取方通过迭代器按顺序流式读取所有分段。
+    """
+
+    def __init__(self, directory=PLAY_LOG_DIR, max_segment_bytes=MAX_SEGMENT_BYTES, key_ttl=None):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment_no = None
+        # key_ttl 不为 None 时按 (user_id, play_id) 去重，见 PlayKeys
+        self.keys = PlayKeys(self, key_ttl) if key_ttl is not None else None
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+
+    def _segment_numbers(self):
+        if not os.path.isdir(self.directory):
+            return []
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                number = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+                if number.isdigit():
+                    numbers.append(int(number))
+        return sorted(numbers)
+
+    def segments(self):
+        """按写入顺序返回所有分段文件路径"""
+        return [self._segment_path(n) for n in self._segment_numbers()]
+
+    def _open_current(self):
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = self._segment_numbers()
+        self._segment_no = max(numbers[-1], 1) if numbers else 1
+        self._file = open(self._segment_path(self._segment_no), 'ab')
+
+        # 上次写入中途崩溃可能留下不完整的一行，先补上换行
+        if self._file.tell() > 0:
+            with open(self._segment_path(self._segment_no), 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write(b'\n')
+
+    def _rotate_if_needed(self):
+        # 按文件实际大小判断，其他进程也会向同一分段追加
+        if os.fstat(self._file.fileno()).st_size < self.max_segment_bytes:
+            return
+        self._file.close()
+        # 其他进程可能已经滚动到更新的分段
+        numbers = self._segment_numbers()
+        if numbers and numbers[-1] > self._segment_no:
+            self._file = None
+            self._open_current()
+            self._rotate_if_needed()
+            return
+        self._segment_no += 1
+        self._file = open(self._segment_path(self._segment_no), 'ab')
+
+    def _write(self, payload):
+        """追加写入，调用方持有 self._lock 和目录锁"""
+        if self._file is None:
+            self._open_current()
+        self._rotate_if_needed()
+        self._file.write(payload)
+        self._file.flush()
+
+    def append(self, record):
+        """追加一条播放记录，返回是否写入（幂等键重复时不写入）"""
+        return self.append_many([record])[0]
+
+    def append_many(self, records):
+        """一次写入追加多条播放记录，返回与输入对应的布尔列表
+
+        开启幂等键时，保留期内已记录过的 (user_id, play_id) 不再写入，对应位置为 False。
+        """
+        encoded = [encode_record(r) for r in records]
+        # 跨进程锁保证较大的批量写入不会与其他进程的写入交错，检查幂等键和写入之间也不会插入其他写入
+        with self._lock, directory_lock(self.directory).hold():
+            if self.keys is None:
+                flags, new_keys = [True] * len(records), None
+            else:
+                flags, new_keys = self.keys.check(records)
+            payload = b''.join(line for line, ok in zip(encoded, flags) if ok)
+            if payload:
+                self._write(payload)
+            if new_keys:
+                self.keys.commit(new_keys)
+        return flags
+
+    def iter_records(self):
+        """按顺序流式读取所有分段中的记录"""
+        for record, _ in self.read_after(None):
+            yield record
+
+    def read_after(self, position):
+        """读取位置 (分段号, 偏移) 之后的记录，产出 (记录, 该记录之后的位置)
+
+        position 为 None 时从头读取；末尾正在写入的不完整行留到下次读取。
+        """
+        start_segment, start_offset = position or (-1, 0)
+        for number in self._segment_numbers():
+            if number < start_segment:
+                continue
+            offset = start_offset if number == start_segment else 0
+            try:
+                f = open(self._segment_path(number), 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                f.seek(offset)
+                for line in f:
+                    # 末尾可能是正在写入的不完整行
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 崩溃留下的损坏行直接跳过
+                        continue
+                    yield record, (number, offset)
+
+    __iter__ = iter_records
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class ShardedPlayLog:
+    """按用户分片的播放日志
+
+    每个分片目录下是一个独立的 PlayLog，有自己的分段文件和跨进程锁，
+    不同分片的用户可以并行写入，读取一个用户的记录只需扫描他所在的分片。
+    旧版全局播放日志中尚未拆分的记录在读取时排在最前面。
+    """
+
+    def __init__(self, root=USERS_DIR, shards=USER_SHARDS, legacy_directory=PLAY_LOG_DIR,
+                 max_segment_bytes=MAX_SEGMENT_BYTES, key_ttl=None):
+        self.root = root
+        self.shards = shards
+        self.max_segment_bytes = max_segment_bytes
+        # 各分片幂等键的保留时长，None 表示不去重（离线导入）
+        self.key_ttl = key_ttl
+        self.legacy = PlayLog(legacy_directory, max_segment_bytes)
+        self._lock = threading.Lock()
+        # 分片号 -> PlayLog，写入时才打开文件，打开的文件数不超过分片数
+        self._logs = {}
+
+    def shard_log(self, shard):
+        """返回分片的播放日志"""
+        log = self._logs.get(shard)
+        if log is None:
+            with self._lock:
+                log = self._logs.get(shard)
+                if log is None:
+                    directory = os.path.join(shard_directory(self.root, shard), SHARD_PLAYS_DIR)
+                    log = self._logs[shard] = PlayLog(directory, self.max_segment_bytes, self.key_ttl)
+        return log
+
+    def append(self, record):
+        """追加一条播放记录，返回是否写入"""
+        return self.append_many([record])[0]
+
+    def append_many(self, records):
+        """按用户所在分片分组，每个分片一次写入，返回与输入对应的布尔列表"""
+        by_shard = {}
+        for index, record in enumerate(records):
+            by_shard.setdefault(user_shard(record.get('user_id'), self.shards), []).append(index)
+        flags = [False] * len(records)
+        for shard, indices in by_shard.items():
+            written = self.shard_log(shard).append_many([records[i] for i in indices])
+            for index, ok in zip(indices, written):
+                flags[index] = ok
+        return flags
+
+    def iter_records(self):
+        """依次读取全局日志和各分片，分片内按写入顺序"""
+        yield from self.legacy.iter_records()
+        for shard in range(self.shards):
+            yield from self.shard_log(shard).iter_records()
+
+    __iter__ = iter_records
+
+    def read_changes(self, cursor):
+        """依次读取全局日志和各分片在 cursor 之后追加的记录（包括其他进程写入的）
+
+        cursor 为 {日志: (分段号, 偏移)}，读取过程中就地更新，空 dict 表示从头读取。
+        """
+        logs = [('legacy', self.legacy)]
+        logs.extend((shard, self.shard_log(shard)) for shard in range(self.shards))
+        for name, log in logs:
+            for record, position in log.read_after(cursor.get(name)):
+                cursor[name] = position
+                yield record
+
+    def iter_user_records(self, user_id):
+        """按写入顺序读取一个用户的记录，只扫描他所在的分片"""
+        for log in (self.legacy, self.shard_log(user_shard(user_id, self.shards))):
+            for record in log.iter_records():
+                if record.get('user_id') == user_id:
+                    yield record
+
+    def split_legacy(self):
+        """把全局播放日志按用户拆分到各分片的 0 号分段，返回拆分的记录数
+
+        每个分片的 0 号分段先写临时文件再整体替换，中途失败后重新执行不会重复导入；
+        全部完成后全局日志目录被重命名为 *.migrated。应在服务停止时执行。
+        """
+        if not self.legacy.segments():
+            return 0
+
+        files = {}
+        count = 0
+        try:
+            for record in self.legacy.iter_records():
+                shard = user_shard(record.get('user_id'), self.shards)
+                f = files.get(shard)
+                if f is None:
+                    log = self.shard_log(shard)
+                    os.makedirs(log.directory, exist_ok=True)
+                    f = files[shard] = open(log._segment_path(MIGRATED_SEGMENT) + '.tmp', 'wb')
+                f.write(encode_record(record))
+                count += 1
+        finally:
+            for f in files.values():
+                f.close()
+
+        for shard in files:
+            log = self.shard_log(shard)
+            path = log._segment_path(MIGRATED_SEGMENT)
+            os.replace(path + '.tmp', path)
+            # 幂等键文件下次使用时连同拆分过来的记录一起重建
+            keys_path = os.path.join(log.directory, KEYS_FILE)
+            if os.path.exists(keys_path):
+                os.remove(keys_path)
+        self.legacy.close()
+        os.replace(self.legacy.directory, self.legacy.directory + '.migrated')
+        return count
+
+    def close(self):
+        self.legacy.close()
+        for log in list(self._logs.values()):
+            log.close()
+
+def migrate_legacy_records(legacy_file=LEGACY_PLAY_RECORDS_FILE, log=None):
+    """把旧版 play_records.json 中的记录导入播放日志
+
+    记录先按目标日志（分片）写入各自目录下的临时文件，全部写完后在 *.progress 中登记，
+    再把临时文件逐个换成新分段，最后把旧文件重命名为 *.migrated，返回导入的记录数；
+    旧文件不存在时返回 0。登记之前中断，重新执行会从头导入；登记之后中断，
+    重新执行只补完剩下的替换，不会重复导入记录。
+    """
+    if log is None:
+        log = ShardedPlayLog()
+
+    progress_file = legacy_file + '.progress'
+    if os.path.exists(progress_file):
+        with open(progress_file, 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+        _finish_legacy_import(legacy_file, progress_file, progress['pending'])
+        return progress['count']
+
+    if not os.path.exists(legacy_file):
+        return 0
+
+    with open(legacy_file, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+
+    # 临时文件名固定，登记之前中断留下的临时文件会被重新写入时覆盖
+    files = {}
+    try:
+        for record in records:
+            if isinstance(log, ShardedPlayLog):
+                target = log.shard_log(user_shard(record.get('user_id'), log.shards))
+            else:
+                target = log
+            f = files.get(target.directory)
+            if f is None:
+                os.makedirs(target.directory, exist_ok=True)
+                f = files[target.directory] = open(os.path.join(target.directory, LEGACY_IMPORT_FILE), 'wb')
+            f.write(encode_record(record))
+    finally:
+        for f in files.values():
+            f.close()
+
+    pending = [os.path.join(directory, LEGACY_IMPORT_FILE) for directory in files]
+    tmp = progress_file + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'count': len(records), 'pending': pending}, f, ensure_ascii=False)
+    os.replace(tmp, progress_file)
+    _finish_legacy_import(legacy_file, progress_file, pending)
+    return len(records)
+
+def _finish_legacy_import(legacy_file, progress_file, pending):
+    """把已登记的临时文件换成各自目录中编号最大的新分段，可以重复执行"""
+    for path in pending:
+        directory = os.path.dirname(path)
+        with directory_lock(directory).hold():
+            # 已经换成分段的临时文件不存在，跳过
+            if not os.path.exists(path):
+                continue
+            log = PlayLog(directory)
+            numbers = log._segment_numbers()
+            number = max(numbers[-1] + 1, 1) if numbers else 1
+            os.replace(path, log._segment_path(number))
+    if os.path.exists(legacy_file):
+        os.replace(legacy_file, legacy_file + '.migrated')
+    os.remove(progress_file)
@@ -0,0 +1,287 @@
+import os
+import time
+import heapq
+import threading
+from array import array
+from .mapping_store import parse_timestamp
+from .storage import get_backend
+
+# 小时桶保留 7 天，日桶保留 30 天
+HOURLY_RETENTION = 7 * 24
+DAILY_RETENTION = 30
+# 支持的热门窗口: 名称 -> (桶粒度秒数, 桶数)
+TRENDING_WINDOWS = {'24h': (3600, 24), '7d': (86400, 7)}
+# 每个窗口缓存的热门条数上限
+TRENDING_MAX = 100
+# 热门榜最短重算间隔（秒），期间新增的播放下次重算时体现
+TRENDING_REFRESH = 5.0
+# 最短每隔多少秒从存储读取一次新写入的播放记录
+TAIL_INTERVAL = 1.0
+# 读取播放记录时每累积多少条持锁累加一次
+LOAD_BATCH = 5000
+
+def _add_into(target, source, sign=1):
+    """target[i] += sign * source[i]，target 不够长时补零"""
+    if len(target) < len(source):
+        target.extend(array('I', [0]) * (len(source) - len(target)))
+    for i, value in enumerate(source):
+        if value:
+            target[i] += sign * value
+
+class RollupRing:
+    """固定数量时间桶的环形计数器
+
+    每个桶是按键编号索引的紧凑 uint32 数组，桶过期时整块清零复用；
+    同时维护最近若干个桶的滚动合计，查询窗口合计不需要逐桶相加。
+    """
+
+    def __init__(self, bucket_seconds, retention, windows=()):
+        self.bucket_seconds = bucket_seconds
+        self.retention = retention
+        self._buckets = [array('I') for _ in range(retention)]
+        # 环中每个位置当前存放的桶编号
+        self._bucket_ids = [None] * retention
+        # 最新的桶编号
+        self._head = None
+        # 窗口桶数 -> 滚动合计数组
+        self._totals = {w: array('I') for w in windows}
+
+    def _advance(self, bucket):
+        if self._head is None:
+            self._head = bucket
+            return
+        if bucket <= self._head:
+            return
+        # 先从滚动合计中减去移出窗口的桶
+        for width, totals in self._totals.items():
+            if bucket - self._head >= width:
+                del totals[:]
+                continue
+            for leaving in range(self._head - width + 1, bucket - width + 1):
+                slot = leaving % self.retention
+                if self._bucket_ids[slot] == leaving:
+                    _add_into(totals, self._buckets[slot], -1)
+        # 再清空被新桶复用的位置
+        for new in range(max(self._head + 1, bucket - self.retention + 1), bucket + 1):
+            slot = new % self.retention
+            del self._buckets[slot][:]
+            self._bucket_ids[slot] = new
+        self._head = bucket
+
+    def add(self, key_no, timestamp, count=1):
+        """把计数记入 timestamp 所在的桶，早于保留期的计数被忽略"""
+        bucket = int(timestamp // self.bucket_seconds)
+        self._advance(bucket)
+        if bucket <= self._head - self.retention:
+            return False
+        slot = bucket % self.retention
+        self._bucket_ids[slot] = bucket
+        counts = self._buckets[slot]
+        if len(counts) <= key_no:
+            counts.extend(array('I', [0]) * (key_no + 1 - len(counts)))
+        counts[key_no] += count
+        for width, totals in self._totals.items():
+            if bucket > self._head - width:
+                if len(totals) <= key_no:
+                    totals.extend(array('I', [0]) * (key_no + 1 - len(totals)))
+                totals[key_no] += count
+        return True
+
+    def window_totals(self, width, now):
+        """返回截至 now 最近 width 个桶的合计数组（只读）"""
+        self._advance(int(now // self.bucket_seconds))
+        return self._totals[width]
+
+    def bucket_counts(self, key_no, now):
+        """返回某个键在各桶的计数，按时间从旧到新"""
+        head = int(now // self.bucket_seconds)
+        self._advance(head)
+        counts = []
+        for bucket in range(head - self.retention + 1, head + 1):
+            slot = bucket % self.retention
+            values = self._buckets[slot]
+            if self._bucket_ids[slot] == bucket and key_no < len(values):
+                counts.append(values[key_no])
+            else:
+                counts.append(0)
+        return counts
+
+class KeyedRollup:
+    """按键（bvid 或 user_id）维护小时和日粒度的播放计数"""
+
+    def __init__(self):
+        # 键 -> 编号，编号即计数数组的下标
+        self._numbers = {}
+        self._keys = []
+        self.hourly = RollupRing(3600, HOURLY_RETENTION, windows=(24,))
+        self.daily = RollupRing(86400, DAILY_RETENTION, windows=(7,))
+
+    def _number(self, key):
+        number = self._numbers.get(key)
+        if number is None:
+            number = len(self._keys)
+            self._numbers[key] = number
+            self._keys.append(key)
+        return number
+
+    def add(self, key, timestamp, count=1):
+        number = self._number(key)
+        self.hourly.add(number, timestamp, count)
+        self.daily.add(number, timestamp, count)
+
+    def _ring(self, bucket_seconds):
+        return self.hourly if bucket_seconds == 3600 else self.daily
+
+    def top(self, bucket_seconds, width, k, now):
+        """返回窗口内计数最高的 k 个 [(键, 次数)]"""
+        totals = self._ring(bucket_seconds).window_totals(width, now)
+        numbers = heapq.nlargest(k, (i for i in range(len(totals)) if totals[i]),
+                                 key=totals.__getitem__)
+        return [(self._keys[i], totals[i]) for i in numbers]
+
+    def series(self, key, bucket_seconds, now):
+        number = self._numbers.get(key)
+        ring = self._ring(bucket_seconds)
+        if number is None:
+            return [0] * ring.retention
+        return ring.bucket_counts(number, now)
+
+class PlayRollups:
+    """按 bvid / 用户的时间分桶计数，从存储中增量读取播放记录
+
+    不在记录播放时累加，而是用游标读取存储中新写入的记录（包括其他 worker 写入的），
+    每条记录恰好累加一次。首次读取（从已有记录恢复保留期内的计数）在后台线程中进行，
+    读取存储时不持有计数锁，只在分批累加时短暂持有；期间写入的记录留在存储中，
+    随后续的增量读取计入。查询不等待读取：恢复完成前返回已恢复的部分，
+    之后最多每 TAIL_INTERVAL 秒读取一次；热门榜按窗口缓存，同一窗口最多每 TRENDING_REFRESH 秒重算一次。
+    """
+
+    def __init__(self, backend=None, refresh=TRENDING_REFRESH, tail_interval=TAIL_INTERVAL):
+        self._backend = backend
+        self.refresh = refresh
+        self.tail_interval = tail_interval
+        self._reset()
+
+    def _reset(self):
+        # 保护计数和热门榜缓存
+        self._lock = threading.Lock()
+        # 同一时间只有一个线程读取存储，保护游标
+        self._tail_lock = threading.Lock()
+        self._loader_lock = threading.Lock()
+        self.by_bvid = KeyedRollup()
+        self.by_user = KeyedRollup()
+        # 存储中已读取到的位置，见 StorageBackend.play_record_changes
+        self._cursor = {}
+        self._last_tail = None
+        self._loader = None
+        self._loaded = threading.Event()
+        # 每次累加后加一，用于判断热门榜缓存是否需要重算
+        self._version = 0
+        # 窗口名 -> (版本号, 计算时间, [(bvid, 次数)])
+        self._trending = {}
+
+    def _after_fork(self):
+        # 后台恢复线程不会进入 fork 出的子进程，未完成时子进程重新开始；锁也可能停留在加锁状态
+        if not self._loaded.is_set():
+            self._reset()
+        else:
+            self._lock = threading.Lock()
+            self._tail_lock = threading.Lock()
+            self._loader_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    def start_loading(self):
+        """在后台线程中从存储恢复计数，重复调用无效果；服务启动时调用"""
+        with self._loader_lock:
+            if self._loader is None:
+                self._loader = threading.Thread(target=self._load, name='play-rollups-load', daemon=True)
+                self._loader.start()
+
+    def wait_loaded(self, timeout=None):
+        """等待首次恢复完成，返回是否已完成"""
+        self.start_loading()
+        return self._loaded.wait(timeout)
+
+    def _load(self):
+        try:
+            self._catch_up(blocking=True)
+        except Exception as e:
+            print(f"Load play rollups error: {str(e)}")
+        finally:
+            self._loaded.set()
+
+    def _catch_up(self, blocking=False):
+        """读取存储中新写入的播放记录并分批累加
+
+        读取期间只持有 self._tail_lock；非阻塞模式下其他线程正在读取（如首次恢复）时直接返回。
+        """
+        now = time.time()
+        if not blocking and self._last_tail is not None and now - self._last_tail < self.tail_interval:
+            return
+        if not self._tail_lock.acquire(blocking=blocking):
+            return
+        try:
+            self._last_tail = now
+            cutoff = now - DAILY_RETENTION * 86400
+            batch = []
+            for record in self.backend.play_record_changes(self._cursor):
+                try:
+                    timestamp = parse_timestamp(record.get('timestamp'))
+                except ValueError:
+                    continue
+                if timestamp >= cutoff:
+                    batch.append((record.get('bvid'), record.get('user_id'), timestamp))
+                if len(batch) >= LOAD_BATCH:
+                    self._add_batch(batch)
+                    batch = []
+            self._add_batch(batch)
+        finally:
+            self._tail_lock.release()
+
+    def _add_batch(self, batch):
+        if not batch:
+            return
+        with self._lock:
+            for bvid, user_id, timestamp in batch:
+                self.by_bvid.add(bvid, timestamp)
+                self.by_user.add(user_id, timestamp)
+            self._version += 1
+
+    def _refresh(self):
+        """查询前读取新记录，首次恢复未完成时不等待"""
+        if self._loaded.is_set():
+            self._catch_up()
+        else:
+            self.start_loading()
+
+    def trending(self, window, limit):
+        """返回窗口内播放最多的 [(bvid, 次数)]，window 为 TRENDING_WINDOWS 中的名称"""
+        bucket_seconds, width = TRENDING_WINDOWS[window]
+        self._refresh()
+        now = time.time()
+        with self._lock:
+            cached = self._trending.get(window)
+            if cached is None or (cached[0] != self._version and now - cached[1] >= self.refresh) \
+                    or int(now // bucket_seconds) != int(cached[1] // bucket_seconds):
+                cached = (self._version, now,
+                          self.by_bvid.top(bucket_seconds, width, TRENDING_MAX, now))
+                self._trending[window] = cached
+            return cached[2][:limit]
+
+    def user_series(self, user_id, hourly=True):
+        """返回用户在保留期内各小时（或各天）的播放次数，按时间从旧到新"""
+        self._refresh()
+        with self._lock:
+            return self.by_user.series(user_id, 3600 if hourly else 86400, time.time())
+
+# 进程级共享的播放分桶计数
+play_rollups = PlayRollups()
+
+# 预加载应用后 fork 出的 worker 重新开始未完成的恢复
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=play_rollups._after_fork)
@@ -0,0 +1,17 @@
+from .storage import get_backend
+
+def add_play_record(record):
+    """保存一条播放记录"""
+    get_backend().append_play_records([record])
+
+def add_play_records(records):
+    """在一次写入中保存多条播放记录，返回与输入对应的布尔列表
+
+    带 play_id 的记录按 (user_id, play_id) 去重，PLAY_KEY_TTL 内已记录过的不再写入（对应位置为 False）；
+    幂等键保存在存储中，由存储后端在写入的同一个锁或事务内检查，多个进程之间同样有效。
+    """
+    return get_backend().append_play_records(records)
+
+def iter_play_records(user_id=None):
+    """流式返回全部播放记录，user_id 不为 None 时只返回该用户的记录"""
+    return get_backend().iter_play_records(user_id)
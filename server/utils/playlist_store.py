@@ -0,0 +1,246 @@
+import threading
+from .cow import CowDict
+from .file_storage import freeze
+from .storage import get_backend
+
+def _count_bvids(songs):
+    counts = {}
+    for song in songs:
+        bvid = song.get('bvid')
+        counts[bvid] = counts.get(bvid, 0) + 1
+    return counts
+
+def _apply_moves(songs, index, moves):
+    """一次遍历完成所有移动，返回 (新列表, 移动次数)
+
+    被移动的歌曲（同一 bvid 重复出现时取第一首）放到各自的目标位置，
+    其余歌曲保持相对顺序；同一 bvid 多次移动以最后一次为准，
+    目标位置相同时后出现的移动排在前面，超出范围的放到末尾。
+    """
+    targets = {}
+    moved = 0
+    for order, (bvid, position) in enumerate(moves):
+        if bvid in index:
+            targets[bvid] = (max(0, position), -order)
+            moved += 1
+    if not targets:
+        return songs, 0
+
+    moving, rest = {}, []
+    for song in songs:
+        bvid = song.get('bvid')
+        if bvid in targets and bvid not in moving:
+            moving[bvid] = song
+        else:
+            rest.append(song)
+
+    result = []
+    next_rest = 0
+    for (position, _), bvid in sorted((target, bvid) for bvid, target in targets.items()):
+        while len(result) < position and next_rest < len(rest):
+            result.append(rest[next_rest])
+            next_rest += 1
+        result.append(moving[bvid])
+    result.extend(rest[next_rest:])
+    return result, moved
+
+class PlaylistSnapshot:
+    """歌单元数据某一版本的只读快照，发布后不再修改
+
+    容器是写时复制的（见 utils/cow.py），派生下一版本时不复制整个分片的歌单。
+    """
+
+    def __init__(self, source=None, version=0):
+        # 建立快照时存储后端的变更令牌，用于发现外部修改
+        self.source = source
+        # 歌单或歌曲每次变化（本进程写入或发现外部修改）加一，用于生成 ETag
+        self.version = version
+        # id -> 歌单元数据
+        self.by_id = CowDict()
+        # user_id -> (id, ...)，按创建顺序
+        self.by_user = CowDict()
+
+    def derive(self):
+        snapshot = PlaylistSnapshot.__new__(PlaylistSnapshot)
+        snapshot.source = self.source
+        snapshot.version = self.version + 1
+        snapshot.by_id = self.by_id.copy()
+        snapshot.by_user = self.by_user.copy()
+        return snapshot
+
+    def index(self, playlist):
+        self.by_id[playlist['id']] = playlist
+        user_id = playlist.get('user_id')
+        self.by_user[user_id] = self.by_user.get(user_id, ()) + (playlist['id'],)
+
+class PlaylistRepository:
+    """歌单仓库，按所有者索引歌单，歌曲列表单独存储、按需加载
+
+    元数据按存储分片以不可变的 PlaylistSnapshot 发布，读取不加锁，只检查所在分片的变更令牌；
+    写入按分片串行执行，在复制出的新快照上修改后整体替换，不同分片的写入可以并行。
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        # 分片 -> 串行化该分片写入和快照重建的锁，读取不需要
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # 分片 -> 当前快照
+        self._snapshots = {}
+        # playlist_id -> 所在分片，按 id 查找歌单时使用
+        self._shard_of = {}
+        # playlist_id -> (歌曲列表视图, {bvid: 出现次数})，视图变化时重建，只在持锁写入时使用
+        self._song_indexes = {}
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend()
+        return self._backend
+
+    def _lock(self, shard):
+        lock = self._locks.get(shard)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(shard, threading.RLock())
+        return lock
+
+    def _sync(self, shard):
+        """发现外部修改时重建分片快照，调用方持有该分片的锁"""
+        token = self.backend.change_token('playlists', shard)
+        snapshot = self._snapshots.get(shard)
+        if snapshot is not None and token is snapshot.source:
+            return snapshot
+        rebuilt = PlaylistSnapshot(token, snapshot.version + 1 if snapshot is not None else 1)
+        for playlist in self.backend.load_playlists(shard):
+            rebuilt.index(playlist)
+            self._shard_of[playlist['id']] = shard
+        self._snapshots[shard] = rebuilt
+        return rebuilt
+
+    def _publish(self, shard, snapshot):
+        # 自己的写入会更新令牌，记下它以免下次误判为外部修改
+        snapshot.source = self.backend.change_token('playlists', shard)
+        self._snapshots[shard] = snapshot
+
+    def snapshot(self, shard):
+        """返回分片的当前快照，有写入正在进行时不等待，直接返回当前版本"""
+        snapshot = self._snapshots.get(shard)
+        if snapshot is not None and self.backend.change_token('playlists', shard) is snapshot.source:
+            return snapshot
+        lock = self._lock(shard)
+        if snapshot is not None:
+            if not lock.acquire(blocking=False):
+                return snapshot
+        else:
+            lock.acquire()
+        try:
+            return self._sync(shard)
+        finally:
+            lock.release()
+
+    def load(self):
+        """加载（或检查）全部分片，返回歌单总数"""
+        return sum(len(self.snapshot(shard).by_id) for shard in self.backend.playlist_shards())
+
+    def version(self, user_id):
+        """返回用户所在分片的版本号，只检查该分片的变更令牌，不重新读取数据"""
+        return self.snapshot(self.backend.playlist_shard(user_id)).version
+
+    def get(self, playlist_id):
+        """返回歌单元数据（不含歌曲）"""
+        if playlist_id not in self._shard_of:
+            # 可能是其他进程新建的歌单，检查全部分片后再查一次
+            self.load()
+            if playlist_id not in self._shard_of:
+                return None
+        return self.snapshot(self._shard_of[playlist_id]).by_id.get(playlist_id)
+
+    def list_by_user(self, user_id):
+        """返回用户的全部歌单元数据，只访问该用户所在的分片"""
+        snapshot = self.snapshot(self.backend.playlist_shard(user_id))
+        return [snapshot.by_id[i] for i in snapshot.by_user.get(user_id, ())]
+
+    def get_songs(self, playlist_id):
+        """返回歌单的歌曲列表（只读）"""
+        playlist = self.get(playlist_id)
+        owner = playlist.get('user_id') if playlist is not None else None
+        return self.backend.load_playlist_songs(playlist_id, owner)
+
+    def create(self, playlist, songs):
+        """保存新歌单，playlist 为不含歌曲的元数据"""
+        shard = self.backend.playlist_shard(playlist.get('user_id'))
+        with self._lock(shard), self.backend.playlist_transaction(shard):
+            base = self._sync(shard)
+            playlist = freeze(playlist)
+            self.backend.save_playlist(playlist, songs)
+            snapshot = base.derive()
+            snapshot.index(playlist)
+            self._shard_of[playlist['id']] = shard
+            self._publish(shard, snapshot)
+
+    def _song_index(self, playlist_id, songs):
+        cached = self._song_indexes.get(playlist_id)
+        if cached is not None and cached[0] is songs:
+            return cached[1]
+        index = _count_bvids(songs)
+        self._song_indexes[playlist_id] = (songs, index)
+        return index
+
+    def change_songs(self, playlist_id, updated_at, replace=None, add=(), remove=(), moves=(),
+                     base_version=None):
+        """在一次写入中修改歌单歌曲，依次执行替换、删除、添加、移动
+
+        借助 bvid 索引，添加和删除的开销与输入规模线性相关。
+        moves 为 [(bvid, 目标位置)]，见 _apply_moves。
+        返回 (统计, 新版本号)；给出 base_version 且与当前版本不一致时不做修改，
+        返回 (None, 当前版本号)。版本在持锁后比较，并发的修改不会同时通过检查。
+        """
+        shard = self._shard_of[playlist_id]
+        with self._lock(shard), self.backend.playlist_transaction(shard):
+            base = self._sync(shard)
+            playlist = base.by_id[playlist_id]
+            if base_version is not None and base_version != playlist.get('version', 0):
+                return None, playlist.get('version', 0)
+            stats = {'added': 0, 'removed': 0, 'moved': 0}
+
+            if replace is None:
+                current = self.get_songs(playlist_id)
+                index = self._song_index(playlist_id, current)
+                songs = list(current)
+            else:
+                songs = list(replace)
+                index = _count_bvids(songs)
+            # 下面会原地修改索引，写入成功后再放回缓存
+            self._song_indexes.pop(playlist_id, None)
+
+            # 删除
+            to_remove = {bvid for bvid in remove if bvid in index}
+            if to_remove:
+                songs = [s for s in songs if s.get('bvid') not in to_remove]
+                for bvid in to_remove:
+                    stats['removed'] += index.pop(bvid)
+
+            # 添加不存在的歌曲
+            for song in add:
+                bvid = song.get('bvid')
+                if bvid not in index:
+                    songs.append(song)
+                    index[bvid] = 1
+                    stats['added'] += 1
+
+            # 移动
+            songs, stats['moved'] = _apply_moves(songs, index, moves)
+
+            version = playlist.get('version', 0) + 1
+            playlist = freeze(dict(
+                playlist, song_count=len(songs), updated_at=updated_at, version=version))
+            self.backend.save_playlist(playlist, songs)
+            snapshot = base.derive()
+            snapshot.by_id[playlist_id] = playlist
+            self._publish(shard, snapshot)
+            self._song_indexes[playlist_id] = (self.get_songs(playlist_id), index)
+            return stats, version
+
+# 进程级共享的歌单仓库
+playlist_repo = PlaylistRepository()
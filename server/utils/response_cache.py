@@ -0,0 +1,99 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request, make_response, Response
+
+# 最多缓存多少个序列化后的响应体
+RESPONSE_CACHE_SIZE = 512
+
+class ResponseCache:
+    """按规范化查询缓存序列化后的响应体（LRU）
+
+    条目记录生成时的 ETag，ETag 由进程纪元、集合版本号和查询参数计算，
+    集合被写入后版本号变化，旧条目在下次访问时即失效。
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (etag, body)
+        self._entries = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                if entry is not None:
+                    del self._entries[key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, etag, body):
+        with self._lock:
+            self._entries[key] = (etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_not_modified(self):
+        with self._lock:
+            self._stats['not_modified'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+# 进程级共享的响应缓存
+response_cache = ResponseCache()
+
+# 本进程的随机纪元，混入 ETag。集合版本号是进程内的计数器，重启后或在其他 worker 上
+# 相同的版本号可能对应不同的数据（响应还包含本进程未落盘的播放次数），纪元不同就不会误返回 304
+_epoch = os.urandom(8).hex()
+
+def _new_epoch():
+    global _epoch
+    _epoch = os.urandom(8).hex()
+
+# 预加载应用后 fork 出的 worker 各自生成新的纪元
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_epoch)
+
+def make_etag(key, versions):
+    """由进程纪元、查询键和相关集合的版本号计算 ETag（不含引号）"""
+    raw = repr((_epoch, key, versions)).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()[:24]
+
+def cached_json_response(key, versions, build):
+    """带条件请求和响应缓存地返回 JSON 响应
+
+    key 为规范化后的查询参数元组，versions 为响应依赖的集合版本号；
+    If-None-Match 命中时直接返回 304，不调用 build。
+    只缓存 200 响应，错误响应原样返回。
+    """
+    etag = make_etag(key, versions)
+    if request.if_none_match.contains_weak(etag):
+        response_cache.record_not_modified()
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body = response_cache.get(key, etag)
+    if body is None:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+        body = response.get_data()
+        response_cache.put(key, etag, body)
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,117 @@
+from .cow import CowDict, CowSetMap
+
+class NGramIndex:
+    """按字符 n-gram 建立的倒排索引，用于歌名/艺术家子串搜索
+
+    每个字段索引单字和相邻两字（bigram）。中文按字切分天然适用，
+    拉丁文字同样按字符处理，因此任意子串都能命中；候选集合最后再做
+    一次子串校验，结果与原来的 `query in text` 语义完全一致。
+    """
+
+    def __init__(self):
+        # gram -> {doc_id}，与 copy() 得到的副本共享，副本的修改先记为增删
+        self._postings = CowSetMap()
+        # doc_id -> 小写后的字段文本
+        self._texts = CowDict()
+
+    @classmethod
+    def build(cls, records):
+        """由 (doc_id, 字段...) 批量建立索引，doc_id 不能重复，比逐条 add 快"""
+        postings = {}
+        texts = {}
+        for doc_id, *fields in records:
+            texts[doc_id] = cls._normalize(fields)
+            grams = set()
+            for text in texts[doc_id]:
+                grams |= cls._grams(text)
+            for gram in grams:
+                ids = postings.get(gram)
+                if ids is None:
+                    postings[gram] = {doc_id}
+                else:
+                    ids.add(doc_id)
+        index = cls()
+        index._postings = CowSetMap(postings)
+        index._texts = CowDict(texts)
+        return index
+
+    @staticmethod
+    def _normalize(fields):
+        """字段转为小写字符串，None 视为空串，其他类型的值按 str() 处理"""
+        return tuple(('' if f is None else str(f)).lower() for f in fields)
+
+    @staticmethod
+    def _grams(text):
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        return grams
+
+    def add(self, doc_id, *fields):
+        """索引一条记录，重复添加同一 doc_id 会先移除旧内容"""
+        if doc_id in self._texts:
+            self.remove(doc_id)
+        texts = self._normalize(fields)
+        self._texts[doc_id] = texts
+        grams = set()
+        for text in texts:
+            grams |= self._grams(text)
+        for gram in grams:
+            self._postings.add(gram, doc_id)
+
+    def remove(self, doc_id):
+        texts = self._texts.pop(doc_id, None)
+        if texts is None:
+            return
+        grams = set()
+        for text in texts:
+            grams |= self._grams(text)
+        for gram in grams:
+            self._postings.discard(gram, doc_id)
+
+    def clear(self):
+        self._postings = CowSetMap()
+        self._texts = CowDict()
+
+    def copy(self):
+        """返回写时复制的副本：外层字典按子字典共享，倒排集合不复制，副本的修改记为增删
+
+        副本修改期间原索引保持不变，可以继续供其他线程查询。
+        """
+        other = NGramIndex.__new__(NGramIndex)
+        other._postings = self._postings.copy()
+        other._texts = self._texts.copy()
+        return other
+
+    def search(self, query):
+        """返回任一字段包含 query（忽略大小写）的 doc_id 集合"""
+        query = query.lower()
+        if not query:
+            return set(self._texts)
+
+        if len(query) == 1:
+            return self._postings.get(query)
+
+        # 从最短的倒排表开始求交集
+        grams = []
+        for gram in {query[i:i + 2] for i in range(len(query) - 1)}:
+            count = self._postings.count(gram)
+            if not count:
+                return set()
+            grams.append((count, gram))
+        grams.sort()
+        candidates = self._postings.get(grams[0][1])
+        for _, gram in grams[1:]:
+            candidates = self._postings.intersect(gram, candidates)
+            if not candidates:
+                return candidates
+
+        # bigram 全部命中不代表连续出现，需要校验子串
+        if len(query) == 2:
+            return candidates
+        return {
+            doc_id for doc_id in candidates
+            if any(query in text for text in self._texts[doc_id])
+        }
+
+    def __len__(self):
+        return len(self._texts)
@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from .file_storage import freeze
+from .storage import StorageBackend, PLAY_KEY_TTL
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mappings (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    bvid TEXT,
+    uploader_uid TEXT,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_mappings_bvid ON mappings(bvid);
+CREATE INDEX IF NOT EXISTS idx_mappings_uploader ON mappings(uploader_uid);
+CREATE INDEX IF NOT EXISTS idx_mappings_created ON mappings(created_at);
+CREATE INDEX IF NOT EXISTS idx_mappings_play_count ON mappings(play_count);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    uid TEXT,
+    created_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions(created_at);
+
+CREATE TABLE IF NOT EXISTS playlists (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_playlists_user ON playlists(user_id);
+
+CREATE TABLE IF NOT EXISTS playlist_songs (
+    playlist_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    bvid TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_playlist_songs_bvid ON playlist_songs(bvid);
+
+CREATE TABLE IF NOT EXISTS play_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT,
+    bvid TEXT,
+    timestamp TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_play_records_bvid ON play_records(bvid);
+CREATE INDEX IF NOT EXISTS idx_play_records_user ON play_records(user_id);
+
+CREATE TABLE IF NOT EXISTS play_keys (
+    user_id TEXT NOT NULL,
+    play_id TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    PRIMARY KEY (user_id, play_id)
+);
+CREATE INDEX IF NOT EXISTS idx_play_keys_received ON play_keys(received_at);
+
+CREATE TABLE IF NOT EXISTS versions (
+    collection TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO versions (collection, version) VALUES ('mappings', 0), ('playlists', 0);
+"""
+
+# 有变更令牌的集合，版本号存放在 versions 表中
+VERSIONED_COLLECTIONS = ('mappings', 'playlists')
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+def _loads(text):
+    return freeze(json.loads(text))
+
+class SqliteBackend(StorageBackend):
+    """基于 SQLite（WAL 模式）的存储后端，每次写入只影响相关的行"""
+
+    name = 'sqlite'
+
+    def __init__(self, path=None):
+        if path is None:
+            from config import SQLITE_PATH
+            path = SQLITE_PATH
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+        self._tx_depth = 0
+        # PRAGMA data_version 只在其他连接提交后变化，变化时再读取各集合的版本号
+        self._data_version = None
+        # 集合 -> 已知的版本号 / 变更令牌，版本号存放在 versions 表中，由写入该集合的事务递增
+        self._versions = {}
+        self._tokens = {collection: object() for collection in VERSIONED_COLLECTIONS}
+        # 当前事务递增过的集合 -> (递增前, 递增后)，提交后更新 _versions
+        self._bumped = {}
+
+    def _connection(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # 自动提交模式，事务由 transaction() 显式控制
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            has_play_keys = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'play_keys'").fetchone()
+            conn.executescript(SCHEMA)
+            if not has_play_keys:
+                self._backfill_play_keys(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _backfill_play_keys(conn):
+        """升级前的数据库没有幂等键表，从保留期内带 play_id 的记录恢复"""
+        from .mapping_store import parse_timestamp
+
+        cutoff = time.time() - PLAY_KEY_TTL
+        keys = []
+        for user_id, data in conn.execute(
+                'SELECT user_id, data FROM play_records WHERE data LIKE \'%"play_id"%\''):
+            record = json.loads(data)
+            try:
+                received_at = parse_timestamp(record.get('received_at'))
+            except ValueError:
+                continue
+            if record.get('play_id') and received_at >= cutoff:
+                keys.append((user_id, record['play_id'], received_at))
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(
+            'INSERT OR IGNORE INTO play_keys (user_id, play_id, received_at) VALUES (?, ?, ?)', keys)
+        conn.execute('COMMIT')
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            conn = self._connection()
+            if self._tx_depth == 0:
+                conn.execute('BEGIN IMMEDIATE')
+            self._tx_depth += 1
+            try:
+                yield conn
+            except BaseException:
+                self._tx_depth -= 1
+                if self._tx_depth == 0:
+                    self._bumped.clear()
+                    conn.execute('ROLLBACK')
+                raise
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                conn.execute('COMMIT')
+                # 自己的提交不改变令牌；递增前的版本号与已知的不一致说明中间还有其他连接的写入，
+                # 保留旧版本号，下次检查时换新令牌
+                for collection, (before, after) in self._bumped.items():
+                    if self._versions.get(collection) == before:
+                        self._versions[collection] = after
+                self._bumped.clear()
+
+    def _bump(self, conn, collection):
+        """在当前事务中递增集合的版本号，调用方在 transaction() 内"""
+        before = conn.execute(
+            'SELECT version FROM versions WHERE collection = ?', (collection,)).fetchone()[0]
+        conn.execute('UPDATE versions SET version = ? WHERE collection = ?', (before + 1, collection))
+        first = self._bumped.get(collection)
+        self._bumped[collection] = (first[0] if first else before, before + 1)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def change_token(self, collection, shard=None):
+        # 本进程正在写入时不等待，直接返回当前令牌，其他连接的提交在下次检查时发现
+        if not self._lock.acquire(blocking=False):
+            return self._tokens[collection]
+        try:
+            conn = self._connection()
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                # 其他连接有提交，只有版本号变化的集合换新令牌（例如只写了播放记录或会话时都不换）
+                self._data_version = data_version
+                for name, version in conn.execute('SELECT collection, version FROM versions'):
+                    if name in self._tokens and self._versions.get(name) != version:
+                        self._versions[name] = version
+                        self._tokens[name] = object()
+            return self._tokens[collection]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # 映射
+    def load_mappings(self):
+        return [_loads(row[0]) for row in self._query('SELECT data FROM mappings ORDER BY seq')]
+
+    def insert_mapping(self, mapping):
+        self.insert_mappings([mapping])
+
+    def insert_mappings(self, mappings):
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO mappings (id, bvid, uploader_uid, play_count, created_at, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(m['id'], m.get('bvid'), m.get('uploader_uid'),
+                  m.get('play_count', 0), m.get('created_at'), _dumps(m)) for m in mappings])
+            self._bump(conn, 'mappings')
+
+    def delete_mapping(self, mapping_id):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM mappings WHERE id = ?', (mapping_id,))
+            self._bump(conn, 'mappings')
+
+    def update_mappings(self, mappings):
+        with self.transaction() as conn:
+            conn.executemany(
+                'UPDATE mappings SET bvid = ?, uploader_uid = ?, play_count = ?, '
+                'created_at = ?, data = ? WHERE id = ?',
+                [(m.get('bvid'), m.get('uploader_uid'), m.get('play_count', 0),
+                  m.get('created_at'), _dumps(m), m['id']) for m in mappings])
+            self._bump(conn, 'mappings')
+
+    # 会话
+    def load_sessions(self):
+        return {token: json.loads(data) for token, data in self._query('SELECT token, data FROM sessions')}
+
+    def load_sessions_with_cursor(self):
+        rows = self._query('SELECT rowid, token, data FROM sessions')
+        cursor = max((row[0] for row in rows), default=0)
+        return {token: json.loads(data) for _, token, data in rows}, cursor
+
+    def session_changes(self, cursor):
+        # INSERT OR REPLACE 会分配新的 rowid，按 rowid 即可读到新增的会话
+        rows = self._query(
+            'SELECT rowid, token, data FROM sessions WHERE rowid > ? ORDER BY rowid', (cursor or 0,))
+        if not rows:
+            return {}, cursor
+        return {token: json.loads(data) for _, token, data in rows}, rows[-1][0]
+
+    def get_session(self, token):
+        rows = self._query('SELECT data FROM sessions WHERE token = ?', (token,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def add_session(self, token, session):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions (token, uid, created_at, data) VALUES (?, ?, ?, ?)',
+                (token, session.get('uid'), session['created_at'], _dumps(session)))
+
+    def finish_session_compaction(self, handle, expired_before):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM sessions WHERE created_at < ?', (expired_before,))
+
+    # 歌单：按 user_id 建了索引，不需要分片
+    def load_playlists(self, shard=None):
+        return [_loads(row[0]) for row in self._query('SELECT data FROM playlists ORDER BY seq')]
+
+    def load_playlist_songs(self, playlist_id, owner=None):
+        rows = self._query(
+            'SELECT data FROM playlist_songs WHERE playlist_id = ? ORDER BY position', (playlist_id,))
+        return tuple(_loads(row[0]) for row in rows)
+
+    def save_playlist(self, playlist, songs=None):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO playlists (id, user_id, data) VALUES (?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET user_id = excluded.user_id, data = excluded.data',
+                (playlist['id'], playlist.get('user_id'), _dumps(playlist)))
+            if songs is not None:
+                conn.execute('DELETE FROM playlist_songs WHERE playlist_id = ?', (playlist['id'],))
+                conn.executemany(
+                    'INSERT INTO playlist_songs (playlist_id, position, bvid, data) VALUES (?, ?, ?, ?)',
+                    [(playlist['id'], i, s.get('bvid'), _dumps(s)) for i, s in enumerate(songs)])
+            self._bump(conn, 'playlists')
+
+    # 播放记录
+    def append_play_records(self, records):
+        now = time.time()
+        flags = []
+        with self.transaction() as conn:
+            if any(r.get('play_id') is not None for r in records):
+                conn.execute('DELETE FROM play_keys WHERE received_at < ?', (now - PLAY_KEY_TTL,))
+            for record in records:
+                play_id = record.get('play_id')
+                if play_id is None:
+                    flags.append(True)
+                    continue
+                # 主键冲突时忽略，rowcount 为 0 说明键已存在
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO play_keys (user_id, play_id, received_at) VALUES (?, ?, ?)',
+                    (record.get('user_id'), play_id, now))
+                flags.append(cursor.rowcount == 1)
+            conn.executemany(
+                'INSERT INTO play_records (user_id, bvid, timestamp, data) VALUES (?, ?, ?, ?)',
+                [(r.get('user_id'), r.get('bvid'), r.get('timestamp'), _dumps(r))
+                 for r, ok in zip(records, flags) if ok])
+        return flags
+
+    def play_record_changes(self, cursor, batch_size=1000):
+        # 自增 id 按提交顺序分配（写事务串行执行），记住读到的最大 id 即可
+        while True:
+            rows = self._query(
+                'SELECT id, data FROM play_records WHERE id > ? ORDER BY id LIMIT ?',
+                (cursor.get('id', 0), batch_size))
+            if not rows:
+                return
+            for row_id, data in rows:
+                cursor['id'] = row_id
+                yield json.loads(data)
+
+    def iter_play_records(self, user_id=None, batch_size=1000):
+        # 分批读取，不在迭代期间一直占用连接
+        last_id = 0
+        while True:
+            if user_id is None:
+                rows = self._query(
+                    'SELECT id, data FROM play_records WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, batch_size))
+            else:
+                rows = self._query(
+                    'SELECT id, data FROM play_records WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?',
+                    (user_id, last_id, batch_size))
+            if not rows:
+                return
+            for row_id, data in rows:
+                yield json.loads(data)
+            last_id = rows[-1][0]
@@ -0,0 +1,182 @@
+import threading
+from contextlib import contextmanager
+
+# 播放幂等键保留时长（秒），客户端离线重放的间隔应小于这个时长
+PLAY_KEY_TTL = 7 * 24 * 3600
+
+class StorageBackend:
+    """存储后端接口
+
+    仓库（mapping_store / playlist_store / auth / play_store）只通过这些方法
+    读写数据，具体实现见 json_backend 和 sqlite_backend。
+    """
+
+    name = None
+
+    @contextmanager
+    def transaction(self):
+        """把多次写入合并为一个事务，不支持事务的后端直接执行"""
+        yield
+
+    def change_token(self, collection, shard=None):
+        """返回集合的变更令牌，数据被其他进程修改后会换成新对象（用 is 比较）
+
+        collection: 'mappings' 或 'playlists'；歌单按分片存储时 shard 为 playlist_shard 返回的分片
+        """
+        raise NotImplementedError
+
+    # 映射
+    def load_mappings(self):
+        """按目录顺序返回全部映射"""
+        raise NotImplementedError
+
+    def insert_mapping(self, mapping):
+        raise NotImplementedError
+
+    def insert_mappings(self, mappings):
+        """在一次写入中插入多条映射"""
+        with self.transaction():
+            for mapping in mappings:
+                self.insert_mapping(mapping)
+
+    def delete_mapping(self, mapping_id):
+        raise NotImplementedError
+
+    def update_mappings(self, mappings):
+        """按 id 替换已存在的映射"""
+        raise NotImplementedError
+
+    # 会话
+    def load_sessions(self):
+        """返回 {token: session}"""
+        raise NotImplementedError
+
+    def load_sessions_with_cursor(self):
+        """返回 ({token: session}, 游标)，游标交给 session_changes 读取之后的变化"""
+        return self.load_sessions(), None
+
+    def session_changes(self, cursor):
+        """返回游标之后其他进程写入的会话 ({token: session 或 None 表示删除}, 新游标)
+
+        变化无法增量读取时返回 (None, cursor)，调用方应全量重新加载。
+        不支持多进程的后端始终返回空的变化。
+        """
+        return {}, cursor
+
+    def get_session(self, token):
+        """返回单个会话，不存在时返回 None；内存索引未命中时调用"""
+        return self.load_sessions().get(token)
+
+    def add_session(self, token, session):
+        """保存新会话"""
+        raise NotImplementedError
+
+    def begin_session_compaction(self):
+        """开始压缩会话存储，调用方持有会话索引锁；返回交给 finish 的句柄"""
+        return None
+
+    def finish_session_compaction(self, handle, expired_before):
+        """压缩持久化内容，删除 created_at 早于 expired_before 的会话，其余会话全部保留"""
+        raise NotImplementedError
+
+    # 歌单
+    def playlist_shard(self, user_id):
+        """返回用户歌单所在的分片，不分片的后端只有一个分片 None"""
+        return None
+
+    def playlist_shards(self):
+        """返回全部歌单分片"""
+        return [None]
+
+    @contextmanager
+    def playlist_transaction(self, shard):
+        """把对一个歌单分片的多次写入合并为一个事务，不同分片的事务互不等待"""
+        with self.transaction():
+            yield
+
+    def load_playlists(self, shard=None):
+        """返回分片（shard 为 None 时为全部分片）的歌单元数据（不含歌曲），分片内按创建顺序"""
+        raise NotImplementedError
+
+    def load_playlist_songs(self, playlist_id, owner=None):
+        """owner 为歌单所有者的 user_id，分片存储据此直接定位，缺省时逐个分片查找"""
+        raise NotImplementedError
+
+    def save_playlist(self, playlist, songs=None):
+        """新建或更新歌单元数据，songs 不为 None 时同时替换歌曲列表"""
+        raise NotImplementedError
+
+    # 播放记录
+    def append_play_records(self, records):
+        """追加播放记录，返回与输入对应的布尔列表
+
+        带 play_id 的记录按 (user_id, play_id) 去重：PLAY_KEY_TTL 内已记录过的
+        （包括其他进程记录的和本批中更早出现的）不再写入，对应位置为 False。
+        检查和写入在同一个锁或事务内完成。
+        """
+        raise NotImplementedError
+
+    def iter_play_records(self, user_id=None):
+        """流式返回全部播放记录（user_id 不为 None 时只返回该用户的），同一用户的记录按写入顺序"""
+        raise NotImplementedError
+
+    def play_record_changes(self, cursor):
+        """流式返回 cursor 之后写入的播放记录，包括其他进程写入的
+
+        cursor 为调用方保存的 dict，读取过程中就地更新，空 dict 表示从头读取；
+        下次传入同一个 dict 只返回之后新写入的记录，每条记录只返回一次。
+        """
+        raise NotImplementedError
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def create_backend(name, **kwargs):
+    """按名称创建存储后端"""
+    if name == 'json':
+        from .json_backend import JsonBackend
+        return JsonBackend(**kwargs)
+    if name == 'sqlite':
+        from .sqlite_backend import SqliteBackend
+        return SqliteBackend(**kwargs)
+    raise ValueError(f"未知的存储后端: {name}")
+
+def get_backend():
+    """返回进程级共享的存储后端，由 config.STORAGE_BACKEND 选择"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                from config import STORAGE_BACKEND
+                _backend = create_backend(STORAGE_BACKEND)
+    return _backend
+
+def migrate(source, target, batch_size=1000):
+    """把 source 后端的全部数据导入 target 后端，返回各集合的导入数量"""
+    counts = {'mappings': 0, 'sessions': 0, 'playlists': 0, 'play_records': 0}
+
+    with target.transaction():
+        for mapping in source.load_mappings():
+            target.insert_mapping(mapping)
+            counts['mappings'] += 1
+
+        for token, session in source.load_sessions().items():
+            target.add_session(token, session)
+            counts['sessions'] += 1
+
+        for playlist in source.load_playlists():
+            target.save_playlist(playlist, source.load_playlist_songs(playlist['id'], playlist.get('user_id')))
+            counts['playlists'] += 1
+
+        batch = []
+        for record in source.iter_play_records():
+            batch.append(record)
+            if len(batch) >= batch_size:
+                target.append_play_records(batch)
+                counts['play_records'] += len(batch)
+                batch = []
+        if batch:
+            target.append_play_records(batch)
+            counts['play_records'] += len(batch)
+
+    return counts
@@ -0,0 +1,18 @@
+import os
+import zlib
+
+# 按用户分片的数据目录，每个分片一个子目录: data/users/<分片号>/
+USERS_DIR = 'data/users'
+# 分片数，修改后已有数据所在的分片会变化，需要重新导入
+USER_SHARDS = 64
+
+def user_shard(user_id, shards=USER_SHARDS):
+    """返回用户所在的分片号
+
+    用 CRC32 而不是 hash()，字符串哈希在每个进程中随机化，不同 worker 的结果会不一致。
+    """
+    return zlib.crc32(str(user_id).encode('utf-8')) % shards
+
+def shard_directory(root, shard):
+    """返回分片目录，如 data/users/0a"""
+    return os.path.join(root, f"{shard:02x}")